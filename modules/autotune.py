@@ -0,0 +1,188 @@
+import json
+import os
+import platform
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+import cv2
+import numpy
+
+import modules.variables.values
+from modules.utilities import resolve_relative_path
+from modules.variables.typing import Face, Frame
+
+PROFILES_DIRECTORY = resolve_relative_path('../profiles')
+CALIBRATION_FRAMES = 24
+CALIBRATION_SIZE = (1280, 720)
+CALIBRATION_FACES = 4
+BATCH_SIZES = [1, 2, 4]
+
+
+def get_profile_path() -> str:
+    return os.path.join(PROFILES_DIRECTORY, f'{platform.node() or "default"}.json')
+
+
+def load_profile() -> bool:
+    """
+    Apply the autotune profile of this host, if one was calibrated for the same execution providers.
+    """
+    profile_path = get_profile_path()
+    if not os.path.isfile(profile_path):
+        return False
+    with open(profile_path) as profile_file:
+        profile = json.load(profile_file)
+    if profile.get('execution_providers') != modules.variables.values.execution_providers:
+        return False
+    modules.variables.values.execution_threads = profile['execution_threads']
+    modules.variables.values.intra_op_threads = profile['intra_op_threads']
+    modules.variables.values.swap_batch_size = profile['swap_batch_size']
+    return True
+
+
+def save_profile(profile: Dict[str, Any]) -> str:
+    os.makedirs(PROFILES_DIRECTORY, exist_ok=True)
+    profile_path = get_profile_path()
+    with open(profile_path, 'w') as profile_file:
+        json.dump(profile, profile_file, indent=2)
+    return profile_path
+
+
+def get_calibration_face_image() -> Optional[Frame]:
+    """ Face pasted on the calibration frames : the --source image, else the --benchmark-face image. """
+    for face_path in (modules.variables.values.source_path, modules.variables.values.benchmark_face):
+        if face_path and os.path.isfile(face_path):
+            face_image = cv2.imread(face_path)
+            if face_image is not None:
+                return face_image
+    return None
+
+
+def create_calibration_frames(face_image: Optional[Frame]) -> List[Frame]:
+    """
+    Noise frames with CALIBRATION_FACES faces on them, so that detection finds faces and their landmarks and
+    recognition are timed as in a real job. Without a face image the drawn faces of the benchmark are used.
+    """
+    from modules.benchmark import draw_face, get_face_layout
+
+    random = numpy.random.default_rng(0)
+    width, height = CALIBRATION_SIZE
+    faces = get_face_layout(width, height, CALIBRATION_FACES)
+    frames = []
+    for _ in range(CALIBRATION_FRAMES):
+        frame = random.integers(0, 256, (height, width, 3), dtype=numpy.uint8)
+        for face in faces:
+            if face_image is None:
+                draw_face(frame, face)
+            else:
+                x1, y1, x2, y2 = face.bbox.astype(int)
+                frame[y1:y2, x1:x2] = cv2.resize(face_image, (x2 - x1, y2 - y1))
+        frames.append(frame)
+    return frames
+
+
+def create_calibration_faces(face_image: Optional[Frame]) -> tuple[Face, List[Face]]:
+    """
+    Source face, detected on the face image when there is one, and synthetic target faces laid out on the calibration
+    frame, swapped on the frames where detection finds none : the swapper does not care about the content of the crop.
+    """
+    from insightface.utils.face_align import arcface_dst
+    from modules.face_analyser import get_one_face
+
+    random = numpy.random.default_rng(0)
+    source_face = get_one_face(face_image) if face_image is not None else None
+    if source_face is None:
+        source_face = Face(embedding=random.standard_normal(512).astype(numpy.float32))
+    width, height = CALIBRATION_SIZE
+    target_faces = []
+    for index in range(CALIBRATION_FACES):
+        offset = numpy.array([(index + 0.5) * width / CALIBRATION_FACES - 112, height / 2 - 112], dtype=numpy.float32)
+        kps = arcface_dst * 2 + offset
+        target_faces.append(Face(bbox=numpy.array([*offset, *(offset + 224)], dtype=numpy.float32), kps=kps, det_score=1.0))
+    return source_face, target_faces
+
+
+def reset_models() -> None:
+    import modules.face_analyser
+    import modules.processors.frame.face_swapper
+
+    modules.face_analyser.FACE_ANALYSER = None
+    modules.processors.frame.face_swapper.FACE_SWAPPER = None
+
+
+def measure(frames: List[Frame], source_face: Face, target_faces: List[Face]) -> float:
+    """ Frames per second of detection and swap over the calibration frames, with the current settings. """
+    from modules.face_analyser import get_face_analyser
+    from modules.processors.frame.face_swapper import swap_faces
+
+    def process(frame: Frame) -> None:
+        frame = frame.copy()
+        swap_faces(source_face, get_face_analyser().get(frame) or target_faces, frame)
+
+    process(frames[0])
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=modules.variables.values.execution_threads) as executor:
+        list(executor.map(process, frames))
+    return len(frames) / (time.perf_counter() - start)
+
+
+def get_thread_candidates() -> List[int]:
+    if any(execution_provider in modules.variables.values.execution_providers
+           for execution_provider in ('DmlExecutionProvider', 'ROCMExecutionProvider')):
+        return [1]
+    cpu_count = os.cpu_count() or 1
+    return sorted({threads for threads in (1, 2, 4, 8, 16, cpu_count) if threads <= cpu_count})
+
+
+def get_intra_op_candidates() -> List[int]:
+    cpu_count = os.cpu_count() or 1
+    return [0] + sorted({threads for threads in (1, 2, 4, cpu_count // 2) if 0 < threads <= cpu_count})
+
+
+def autotune() -> Dict[str, Any]:
+    """
+    Calibrate execution threads, ONNX Runtime intra-op threads and swap batch size with the real models
+    on calibration frames with faces, then save the fastest settings as the profile of this host.
+    """
+    from modules.core import update_status
+    from modules.processors.frame.face_swapper import pre_check
+
+    pre_check()
+    face_image = get_calibration_face_image()
+    if face_image is None:
+        update_status('No --source or --benchmark-face image, calibrating on drawn faces which detection may not find', 'REACTOR.AUTOTUNE')
+    frames = create_calibration_frames(face_image)
+    source_face, target_faces = create_calibration_faces(face_image)
+    trials = []
+
+    def trial() -> Dict[str, Any]:
+        frames_per_second = measure(frames, source_face, target_faces)
+        result = {'execution_threads': modules.variables.values.execution_threads,
+                  'intra_op_threads': modules.variables.values.intra_op_threads,
+                  'swap_batch_size': modules.variables.values.swap_batch_size,
+                  'frames_per_second': round(frames_per_second, 2)}
+        update_status(f'{result}', 'REACTOR.AUTOTUNE')
+        trials.append(result)
+        return result
+
+    modules.variables.values.swap_batch_size = 1
+    for intra_op_threads in get_intra_op_candidates():
+        modules.variables.values.intra_op_threads = intra_op_threads
+        reset_models()
+        for execution_threads in get_thread_candidates():
+            modules.variables.values.execution_threads = execution_threads
+            trial()
+    best = max(trials, key=lambda result: result['frames_per_second'])
+    modules.variables.values.execution_threads = best['execution_threads']
+    modules.variables.values.intra_op_threads = best['intra_op_threads']
+    reset_models()
+    for swap_batch_size in BATCH_SIZES[1:]:
+        modules.variables.values.swap_batch_size = swap_batch_size
+        trial()
+    best = max(trials, key=lambda result: result['frames_per_second'])
+    modules.variables.values.swap_batch_size = best['swap_batch_size']
+    profile = {**best,
+               'host': platform.node(),
+               'execution_providers': modules.variables.values.execution_providers,
+               'trials': trials}
+    update_status(f'Best settings {best} saved to {save_profile(profile)}', 'REACTOR.AUTOTUNE')
+    return profile
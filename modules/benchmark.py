@@ -0,0 +1,248 @@
+import json
+import os
+import platform
+import sys
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+import cv2
+import numpy
+
+import modules.metrics as metrics
+import modules.variables.values
+from modules.utilities import resolve_relative_path
+from modules.variables.typing import Face, Frame
+
+BENCHMARKS_DIRECTORY = resolve_relative_path('../benchmarks')
+RESOLUTIONS = [(640, 360), (1280, 720), (1920, 1080)]
+FACE_COUNTS = [1, 4]
+FRAME_TOTAL = 48
+FPS = 24
+FRAME_PROCESSORS = ['face_swapper', 'face_enhancer']
+# 5 points of the 112x112 arcface template, as in insightface.utils.face_align.arcface_dst
+ARCFACE_TEMPLATE = numpy.array([[38.2946, 51.6963],
+                                [73.5318, 51.5014],
+                                [56.0252, 71.7366],
+                                [41.5493, 92.3655],
+                                [70.7299, 92.2041]], dtype=numpy.float32)
+
+
+def get_face_layout(width: int, height: int, face_total: int) -> List[Face]:
+    """
+    Faces drawn on the synthetic frames, evenly spread on a row. The stub analyser returns them as detected faces.
+    """
+    size = int(min(height * 0.6, width / (face_total + 0.5)))
+    faces = []
+    for index in range(face_total):
+        offset = numpy.array([(index + 0.5) * width / face_total - size / 2, (height - size) / 2], dtype=numpy.float32)
+        embedding = numpy.random.default_rng(index).standard_normal(512).astype(numpy.float32)
+        faces.append(Face(bbox=numpy.array([*offset, *(offset + size)], dtype=numpy.float32),
+                          kps=ARCFACE_TEMPLATE * size / 112 + offset,
+                          det_score=numpy.float32(0.99),
+                          embedding=embedding))
+    return faces
+
+
+def draw_face(frame: Frame, face: Face) -> None:
+    x1, y1, x2, y2 = face.bbox.astype(int)
+    center = ((x1 + x2) // 2, (y1 + y2) // 2)
+    cv2.ellipse(frame, center, ((x2 - x1) * 2 // 5, (y2 - y1) // 2), 0, 0, 360, (150, 180, 220), -1)
+    radius = max((x2 - x1) // 16, 1)
+    for x, y in face.kps[:2].astype(int):
+        cv2.circle(frame, (x, y), radius, (40, 40, 40), -1)
+    cv2.circle(frame, tuple(face.kps[2].astype(int)), radius, (110, 130, 170), -1)
+    cv2.line(frame, tuple(face.kps[3].astype(int)), tuple(face.kps[4].astype(int)), (60, 60, 160), radius)
+
+
+def create_synthetic_video(video_path: str, width: int, height: int, face_total: int, face_image: Optional[Frame] = None) -> None:
+    """
+    Deterministic clip of a moving gradient and noise behind the faces of the layout, so that no two frames are identical.
+    The faces are drawn, or are face_image when benchmarking the real models.
+    """
+    random = numpy.random.default_rng(width * height + face_total)
+    gradient = numpy.linspace(0, 255, width, dtype=numpy.float32)[numpy.newaxis, :, numpy.newaxis]
+    faces = get_face_layout(width, height, face_total)
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'mp4v'), FPS, (width, height))
+    for frame_number in range(FRAME_TOTAL):
+        background = (gradient + frame_number * 4) % 256 * numpy.array([0.6, 0.8, 1.0], dtype=numpy.float32)
+        frame = numpy.broadcast_to(background, (height, width, 3)).astype(numpy.uint8)
+        frame = cv2.add(frame, random.integers(0, 24, (height, width, 3), dtype=numpy.uint8))
+        for face in faces:
+            if face_image is None:
+                draw_face(frame, face)
+            else:
+                x1, y1, x2, y2 = face.bbox.astype(int)
+                frame[y1:y2, x1:x2] = cv2.resize(face_image, (x2 - x1, y2 - y1))
+        writer.write(frame)
+    writer.release()
+
+
+class StubFaceAnalyser:
+    """ Returns the faces of the layout after a detection-like resize and blur, for a deterministic cost. """
+
+    def __init__(self, face_total: int) -> None:
+        self.face_total = face_total
+
+    def get(self, frame: Frame) -> List[Face]:
+        cv2.GaussianBlur(cv2.resize(frame, (640, 640)), (9, 9), 0)
+        height, width = frame.shape[:2]
+        return get_face_layout(width, height, self.face_total)
+
+
+class StubFaceSwapper:
+    """ INSwapper.get(paste_back=False) returning the inverted aligned crop. """
+    input_size = (128, 128)
+    session = SimpleNamespace(get_inputs=lambda: [SimpleNamespace(shape=[1, 3, 128, 128]), SimpleNamespace(shape=[1, 512])])
+
+    def get(self, frame: Frame, target_face: Face, source_face: Face, paste_back: bool = False) -> tuple[Frame, numpy.ndarray[Any, Any]]:
+        from insightface.utils import face_align
+
+        aligned_face, matrix = face_align.norm_crop2(frame, target_face.kps, self.input_size[0])
+        return cv2.bitwise_not(cv2.GaussianBlur(aligned_face, (5, 5), 0)), matrix
+
+
+class StubFaceEnhancer:
+    """ GFPGANer with its restoration network replaced by an average pooling. """
+
+    def __init__(self) -> None:
+        import torch
+
+        self.device = torch.device('cpu')
+        self.gfpgan = lambda face_tensor, return_rgb=False, weight=0.5: (torch.nn.functional.avg_pool2d(face_tensor, 3, 1, 1),)
+
+    def enhance(self, frame: Frame, paste_back: bool = True) -> tuple[None, None, Frame]:
+        return None, None, cv2.GaussianBlur(frame, (5, 5), 0)
+
+
+def install_stub_models(face_total: int) -> None:
+    import modules.face_analyser
+    import modules.processors.frame.face_enhancer
+    import modules.processors.frame.face_swapper
+
+    modules.face_analyser.FACE_ANALYSER = StubFaceAnalyser(face_total)
+    modules.processors.frame.face_swapper.FACE_SWAPPER = StubFaceSwapper()
+    modules.processors.frame.face_enhancer.FACE_ENHANCER = StubFaceEnhancer()
+
+
+def get_environment() -> Dict[str, Any]:
+    import onnxruntime
+
+    return {'host': platform.node(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'python': sys.version.split()[0],
+            'onnxruntime': onnxruntime.__version__,
+            'opencv': cv2.__version__,
+            'execution_providers': modules.variables.values.execution_providers,
+            'execution_threads': modules.variables.values.execution_threads,
+            'io_threads': modules.variables.values.io_threads,
+            'temp_frame_format': modules.variables.values.temp_frame_format}
+
+
+def run_scenario(video_path: str, face_path: str, frame_processors: List[str]) -> Dict[str, Any]:
+    """
+    Extract, process with every frame processor and encode the clip, as a video job without the nsfw check.
+    """
+    from modules.processors.frame.core import load_frame_processor_module
+    from modules.utilities import clean_temp, create_temp, create_video, extract_frames, get_temp_frame_paths
+
+    modules.variables.values.source_path = face_path
+    modules.variables.values.subject_path = face_path
+    modules.variables.values.target_path = video_path
+    metrics.reset(target_path=video_path, frame_processors=frame_processors)
+    create_temp(video_path)
+    with metrics.timer('extract'):
+        extract_frames(video_path)
+    temp_frame_paths = get_temp_frame_paths(video_path)
+    metrics.increment('frames', len(temp_frame_paths))
+    for frame_processor in frame_processors:
+        load_frame_processor_module(frame_processor).process_video(source_path=face_path,
+                                                                   temp_frame_paths=temp_frame_paths,
+                                                                   subject_path=face_path)
+    with metrics.timer('encode'):
+        create_video(video_path, os.path.splitext(video_path)[0] + '.output.mp4')
+    clean_temp(video_path)
+    return metrics.get_report()
+
+
+def benchmark(models: str = 'stub', face_path: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Run the frame pipeline on synthetic clips of every resolution and face count, with deterministic stub models
+    (offline, comparable between machines) or the real ones, and save the throughput of each stage as json.
+    :param face_path: face pasted on the synthetic clips for the real models, which do not detect drawn faces.
+    """
+    from modules.core import update_status
+
+    if models == 'real' and not face_path:
+        raise ValueError('The real models need a face image to paste on the synthetic clips')
+    face_image = cv2.imread(face_path) if face_path else None
+    if models == 'real':
+        from modules.processors.frame.core import load_frame_processor_module
+
+        for frame_processor in FRAME_PROCESSORS:
+            load_frame_processor_module(frame_processor).pre_check()
+    videos_directory = os.path.join(BENCHMARKS_DIRECTORY, 'videos', models)
+    os.makedirs(videos_directory, exist_ok=True)
+    saved_values = {name: getattr(modules.variables.values, name)
+                    for name in ('source_path', 'subject_path', 'target_path', 'face_option', 'enhancer_option', 'keep_frames', 'frame_cache_size')}
+    modules.variables.values.face_option = modules.variables.values.faces_all
+    modules.variables.values.enhancer_option = modules.variables.values.enhancer_faces_only
+    modules.variables.values.keep_frames = False
+    # every frame differs, the cache would only add its lookups to the measures
+    modules.variables.values.frame_cache_size = 0
+    results: Dict[str, Any] = {'models': models, 'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'environment': get_environment(), 'scenarios': {}}
+    try:
+        for width, height in RESOLUTIONS:
+            for face_total in FACE_COUNTS:
+                scenario = f'{width}x{height}-{face_total}faces'
+                video_path = os.path.join(videos_directory, f'{scenario}.mp4')
+                if not os.path.isfile(video_path):
+                    create_synthetic_video(video_path, width, height, face_total, face_image)
+                scenario_face_path = face_path
+                if models == 'stub':
+                    install_stub_models(face_total)
+                    scenario_face_path = os.path.join(videos_directory, f'{scenario}.png')
+                    capture = cv2.VideoCapture(video_path)
+                    cv2.imwrite(scenario_face_path, capture.read()[1])
+                    capture.release()
+                report = run_scenario(video_path, scenario_face_path, FRAME_PROCESSORS)
+                results['scenarios'][scenario] = {key: report[key] for key in ('elapsed_seconds', 'frames_per_second', 'counters', 'stages')}
+                update_status(f'{scenario}: {report["frames_per_second"]} frames/s', 'REACTOR.BENCHMARK')
+    finally:
+        for name, value in saved_values.items():
+            setattr(modules.variables.values, name, value)
+    results_directory = os.path.join(BENCHMARKS_DIRECTORY, 'results')
+    os.makedirs(results_directory, exist_ok=True)
+    results_path = os.path.join(results_directory, f'{time.strftime("%Y%m%d-%H%M%S")}-{platform.node() or "default"}-{models}.json')
+    with open(results_path, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    update_status(f'Benchmark results saved to {results_path}', 'REACTOR.BENCHMARK')
+    return results
+
+
+def compare(baseline_path: str, results_path: str) -> Dict[str, Any]:
+    """
+    Throughput and mean stage time of every scenario of two benchmark runs, as ratios against the baseline.
+    """
+    from modules.core import update_status
+
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    with open(results_path) as results_file:
+        results = json.load(results_file)
+    comparison: Dict[str, Any] = {}
+    for scenario, result in results['scenarios'].items():
+        baseline_result = baseline['scenarios'].get(scenario)
+        if not baseline_result or not baseline_result['frames_per_second']:
+            continue
+        comparison[scenario] = {
+            'frames_per_second': [baseline_result['frames_per_second'], result['frames_per_second']],
+            'speedup': round(result['frames_per_second'] / baseline_result['frames_per_second'], 3),
+            'stages': {stage: round(stage_timer['mean_seconds'] / baseline_result['stages'][stage]['mean_seconds'], 3)
+                       for stage, stage_timer in result['stages'].items()
+                       if baseline_result['stages'].get(stage, {}).get('mean_seconds')}
+        }
+        update_status(f'{scenario}: x{comparison[scenario]["speedup"]} ({baseline_result["frames_per_second"]} -> {result["frames_per_second"]} frames/s), '
+                      f'mean stage time ratios {comparison[scenario]["stages"]}', 'REACTOR.BENCHMARK')
+    return comparison
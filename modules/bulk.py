@@ -0,0 +1,174 @@
+import json
+import os
+import shutil
+import time
+from typing import Any, Dict, List, Optional
+import cv2
+from tqdm import tqdm
+
+import modules.metrics as metrics
+import modules.variables.values
+from modules.face_analyser import get_face_analyser, get_one_face
+from modules.processors.frame.core import get_frame_processors_modules, run_pipeline
+from modules.utilities import has_image_extension
+from modules.variables.typing import Frame
+
+MANIFEST_NAME = 'bulk_manifest.json'
+
+
+def read_targets(targets_path: str) -> List[str]:
+    """
+    Images of a directory, recursively, or listed by a manifest : a text file with one path per line,
+    relative to the manifest, blank lines and lines starting with # ignored.
+    """
+    if os.path.isdir(targets_path):
+        return sorted(os.path.join(directory_path, file_name)
+                      for directory_path, _, file_names in os.walk(targets_path)
+                      for file_name in file_names if has_image_extension(file_name))
+    manifest_directory_path = os.path.dirname(os.path.abspath(targets_path))
+    with open(targets_path) as manifest_file:
+        lines = [line.strip() for line in manifest_file]
+    return [os.path.join(manifest_directory_path, line) for line in lines if line and not line.startswith('#')]
+
+
+def get_output_paths(target_paths: List[str], targets_path: str, output_directory_path: str) -> List[str]:
+    """ Output of every target, at the same place below output_directory_path as the target below the targets. """
+    if os.path.isdir(targets_path):
+        root_path = os.path.abspath(targets_path)
+    else:
+        root_path = os.path.commonpath([os.path.dirname(os.path.abspath(target_path)) for target_path in target_paths])
+    return [os.path.join(output_directory_path, os.path.relpath(os.path.abspath(target_path), root_path)) for target_path in target_paths]
+
+
+def get_default_output_directory_path(targets_path: str) -> str:
+    """ photos/ is processed into photos-output/, photos.txt into photos-output/. """
+    if os.path.isdir(targets_path):
+        return targets_path.rstrip(os.sep) + '-output'
+    return os.path.splitext(targets_path)[0] + '-output'
+
+
+def read_image(target_path: str) -> Optional[Frame]:
+    with metrics.timer('read', frame=target_path):
+        return cv2.imread(target_path)
+
+
+def process_images(frame_processors: List[Any], source_face: Any, subject_embedding: Any, temp_frames: List[Frame]) -> List[Optional[Frame]]:
+    """ Every processor on a batch of images, None for the images left unchanged. """
+    results: List[Optional[Frame]] = [None] * len(temp_frames)
+    for frame_processor in frame_processors:
+        outputs = frame_processor.process_batch(source_face, [result if result is not None else temp_frame for result, temp_frame in zip(results, temp_frames)], subject_embedding)
+        results = [output if output is not None else result for output, result in zip(outputs, results)]
+    return results
+
+
+def check_options(frame_processor_names: List[str]) -> None:
+    """ Refuse to run processors which would leave every frame unchanged. """
+    if 'face_swapper' in frame_processor_names and modules.variables.values.face_option == modules.variables.values.faces_none:
+        raise Exception("No face would be swapped, select the faces with --face-option...")
+    if 'face_enhancer' in frame_processor_names and modules.variables.values.enhancer_option == modules.variables.values.enhancer_none:
+        raise Exception("Nothing would be enhanced, select what with --enhancer-option...")
+
+
+def bulk(targets_path: str, output_directory_path: str, source_path: str, subject_path: str) -> List[Dict[str, Any]]:
+    """
+    Process every image of a directory or manifest with the same source and subject faces, analysed once.
+    The images run through the threads of run_pipeline : decoded ahead, processed by batches of bulk_batch_size
+    and saved behind. The status of every image is written to bulk_manifest.json
+    in the output directory.
+    """
+    from modules.core import update_status
+    from modules.predicter import predict_image
+
+    target_paths = read_targets(targets_path)
+    output_paths = get_output_paths(target_paths, targets_path, output_directory_path)
+    frame_processor_names = modules.variables.values.frame_processors or ['face_swapper']
+    check_options(frame_processor_names)
+    frame_processors = get_frame_processors_modules(frame_processor_names)
+    source_face = get_one_face(cv2.imread(source_path)) if source_path else None
+    if source_face is None and 'face_swapper' in frame_processor_names:
+        raise Exception("Source face does not contain face...")
+    subject_faces = get_face_analyser().get(cv2.imread(subject_path)) if subject_path else []
+    if not subject_faces:
+        raise Exception("Subject face does not contain face...")
+    subject_embedding = subject_faces[0].embedding
+    metrics.reset(mode='bulk',
+                  target_path=targets_path,
+                  output_path=output_directory_path,
+                  frame_processors=list(frame_processor_names),
+                  execution_providers=modules.variables.values.execution_providers,
+                  execution_threads=modules.variables.values.execution_threads)
+    metrics.increment('frames', len(target_paths))
+
+    statuses: List[Dict[str, Any]] = [{'target': target_path, 'output': output_path, 'status': 'pending'}
+                                      for target_path, output_path in zip(target_paths, output_paths)]
+    progress = tqdm(total=len(target_paths), desc='Processing', unit='image', dynamic_ncols=True)
+
+    def read_target(index: int) -> tuple[int, Optional[Frame]]:
+        statuses[index]['start'] = time.perf_counter()
+        return index, read_image(target_paths[index])
+
+    def fail(index: int, status: str, error: str = '') -> tuple[int, None]:
+        statuses[index].update(status=status, error=error)
+        return index, None
+
+    def compute_images(batch: List[tuple[int, Optional[Frame]]]) -> List[tuple[int, Optional[Frame]]]:
+        outputs: Dict[int, tuple[int, Optional[Frame]]] = {}
+        images = []
+        for index, temp_frame in batch:
+            if temp_frame is None:
+                outputs[index] = fail(index, 'failed', 'unreadable image')
+            elif not modules.variables.values.nsfw and predict_image(target_paths[index]):
+                outputs[index] = fail(index, 'nsfw')
+            else:
+                images.append((index, temp_frame))
+        # the processors paste faces into the images they are given, a retry starts again from untouched copies
+        originals = [temp_frame.copy() for _, temp_frame in images]
+        try:
+            results: List[Any] = process_images(frame_processors, source_face, subject_embedding, [temp_frame for _, temp_frame in images])
+        except Exception:
+            # one image breaking the batch should not fail the others
+            results = []
+            for original in originals:
+                try:
+                    results.extend(process_images(frame_processors, source_face, subject_embedding, [original]))
+                except Exception as exception:
+                    metrics.increment('errors')
+                    results.append(exception)
+        for (index, _), result in zip(images, results):
+            if isinstance(result, Exception):
+                outputs[index] = fail(index, 'failed', str(result))
+                continue
+            statuses[index]['status'] = 'processed' if result is not None else 'unchanged'
+            outputs[index] = (index, result)
+        return [outputs[index] for index, _ in batch]
+
+    def write_output(item: tuple[int, Optional[Frame]]) -> None:
+        index, result = item
+        status = statuses[index]
+        try:
+            if status['status'] in ('processed', 'unchanged'):
+                os.makedirs(os.path.dirname(status['output']), exist_ok=True)
+                with metrics.timer('write', frame=status['output']):
+                    if result is None:
+                        shutil.copyfile(status['target'], status['output'])
+                    elif not cv2.imwrite(status['output'], result):
+                        raise OSError(f'could not write {status["output"]}')
+        except OSError as exception:
+            metrics.increment('errors')
+            status.update(status='failed', error=str(exception))
+        status['seconds'] = round(time.perf_counter() - status.pop('start'), 4)
+        metrics.increment('frames_processed')
+        progress.update(1)
+
+    run_pipeline(list(range(len(target_paths))), read_target, compute_images, write_output, modules.variables.values.bulk_batch_size)
+    progress.close()
+
+    counts: Dict[str, int] = {}
+    for status in statuses:
+        counts[status['status']] = counts.get(status['status'], 0) + 1
+    os.makedirs(output_directory_path, exist_ok=True)
+    manifest_path = os.path.join(output_directory_path, MANIFEST_NAME)
+    with open(manifest_path, 'w') as manifest_file:
+        json.dump({'counts': counts, 'report': metrics.get_report(), 'images': statuses}, manifest_file, indent=2)
+    update_status(f'Bulk processing done, {counts}, status of every image in {manifest_path}', 'REACTOR.BULK')
+    return statuses
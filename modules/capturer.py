@@ -1,20 +1,77 @@
-from typing import Any
+import sys
+import threading
+from typing import Any, Optional
 import cv2
 
+from modules.frame_store import get_frame_store
+from modules.utilities import get_temp_directory_path
+from modules.variables.typing import Frame
+from modules.video_metadata import get_cache_key, get_keyframe_index, get_video_metadata
+
+VIDEO_DECODER = None
+THREAD_LOCK = threading.Lock()
+
+
+class VideoDecoder:
+    """
+    Decoder kept open on a video for random frame access. A frame is reached by decoding forward from the current
+    position when that is closer than from the keyframe before it, else by seeking to that keyframe.
+    """
+
+    def __init__(self, video_path: str) -> None:
+        self.video_path = video_path
+        self.cache_key = get_cache_key(video_path)
+        self.capture = cv2.VideoCapture(video_path)
+        self.keyframe_index = get_keyframe_index(video_path)
+        # index of the next frame capture.read() returns
+        self.position = 0
+        self.lock = threading.Lock()
+
+    def read(self, frame_index: int) -> Optional[Frame]:
+        with self.lock:
+            frame_index = max(frame_index, 0)
+            keyframe = self.keyframe_index.get_keyframe_before(frame_index)
+            if frame_index < self.position or frame_index - self.position > frame_index - keyframe:
+                self.capture.set(cv2.CAP_PROP_POS_FRAMES, keyframe)
+                self.position = keyframe
+            while self.position < frame_index and self.capture.grab():
+                self.position += 1
+            has_frame, frame = self.capture.read()
+            if not has_frame:
+                # lost track of the position, start over from the keyframe on the next read
+                self.position = sys.maxsize
+                return None
+            self.position += 1
+            return frame
+
+    def release(self) -> None:
+        with self.lock:
+            self.capture.release()
+
+
+def get_video_decoder(video_path: str) -> VideoDecoder:
+    """ Decoder of the video, reused while the same unchanged video is previewed. """
+    global VIDEO_DECODER
+
+    with THREAD_LOCK:
+        if VIDEO_DECODER is None or VIDEO_DECODER.cache_key != get_cache_key(video_path):
+            if VIDEO_DECODER:
+                VIDEO_DECODER.release()
+            VIDEO_DECODER = VideoDecoder(video_path)
+        return VIDEO_DECODER
+
 
 def get_video_frame(video_path: str, frame_number: int = 0) -> Any:
-    capture = cv2.VideoCapture(video_path)
-    frame_total = capture.get(cv2.CAP_PROP_FRAME_COUNT)
-    capture.set(cv2.CAP_PROP_POS_FRAMES, min(frame_total, frame_number - 1))
-    has_frame, frame = capture.read()
-    capture.release()
-    if has_frame:
-        return frame
-    return None
-
-
-def get_video_frame_total(video_path: str) -> int:
-    capture = cv2.VideoCapture(video_path)
-    video_frame_total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
-    capture.release()
-    return video_frame_total
+    # frames already decomposed in a raw store are read directly, they are the ones the next run will process
+    frame_store = get_frame_store(get_temp_directory_path(video_path))
+    if frame_store and frame_store.count:
+        return frame_store.read(min(max(frame_number - 1, 0), frame_store.count - 1)).copy()
+    return get_video_decoder(video_path).read(frame_number - 1)
+
+
+def get_video_frame_total(video_path: str, exact: bool = True) -> int:
+    """ Frames the next run will process, estimated from the headers unless exact. """
+    frame_store = get_frame_store(get_temp_directory_path(video_path))
+    if frame_store and frame_store.count:
+        return frame_store.count
+    return get_video_metadata(video_path, exact).frame_total
@@ -8,11 +8,12 @@ if any(arg.startswith('--execution-provider') for arg in sys.argv):
 # reduce tensorflow log level
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 import warnings
-from typing import List, Literal
+from typing import Any, Dict, List, Literal, Optional, Tuple
 import platform
 import signal
 import shutil
 import argparse
+import psutil
 import torch
 import onnxruntime
 import tensorflow
@@ -20,9 +21,18 @@ import tensorflow
 import modules.variables.values
 import modules.variables.metadata
 import modules.ui.ui_new as ui
+import modules.autotune as autotune
+import modules.model_manager as model_manager
+import modules.face_index as face_index
+import modules.metrics as metrics
+import modules.profiler as profiler
+import modules.result_cache as result_cache
+import modules.segmenter as segmenter
+from modules.ffmpeg import FFmpegError, get_hwaccel, get_video_encoder
+from modules.inference_session import SESSION_OPTION_KEYS, SESSION_PROCESSORS
 from modules.processors.frame.core import get_frame_processors_modules
 import modules.utilities as utilities
-from modules.utilities import has_image_extension, is_image, is_video, detect_fps, create_unsound_video, extract_frames, get_temp_frame_paths, restore_audio, create_temp, move_temp, clean_temp, \
+from modules.utilities import has_image_extension, is_image, is_video, detect_fps, extract_frames, get_temp_frame_paths, create_temp, clean_temp, \
     normalize_output_path
 
 if 'ROCMExecutionProvider' in modules.variables.values.execution_providers:
@@ -36,13 +46,157 @@ def parse_args() -> None:
     signal.signal(signal.SIGINT, lambda signal_number, frame: destroy())
     program = argparse.ArgumentParser()
 
+    program.add_argument('--frame-processor', help='frame processors of the jobs run from the command line', dest='frame_processors', default=modules.variables.values.frame_processors, choices=['face_swapper', 'face_enhancer'], nargs='+')
+    program.add_argument('--source', help='source face image of the jobs run from the command line', dest='source_path', default=modules.variables.values.source_path, metavar='IMAGE')
+    program.add_argument('--subject', help='subject face image of the jobs run from the command line', dest='subject_path', default=modules.variables.values.subject_path, metavar='IMAGE')
+    program.add_argument('--face-option', help='faces swapped by the jobs run from the command line', dest='face_option', default=modules.variables.values.face_option, choices=modules.variables.values.faces_options)
+    program.add_argument('--enhancer-option', help='faces or frames enhanced by the jobs run from the command line', dest='enhancer_option', default=modules.variables.values.enhancer_option, choices=modules.variables.values.enhancer_options)
+    program.add_argument('--distance-score', help='maximum distance to the subject of the face swapped with the best one face option', dest='distance_score', type=int, default=modules.variables.values.distance_score)
+    program.add_argument('--bulk', help='process every image of a directory, or listed one per line in a manifest, with --source and --subject and exit', dest='bulk_targets', metavar='TARGETS')
+    program.add_argument('--bulk-output', help='directory of the bulk outputs and of their status manifest', dest='bulk_output', metavar='DIRECTORY')
+    program.add_argument('--bulk-batch-size', help='images processed together by each execution thread in bulk mode', dest='bulk_batch_size', type=int, default=modules.variables.values.bulk_batch_size)
+    program.add_argument('--live', help='swap the faces of a live feed with --source and --subject: a video file played at its native rate, a capture device (index or /dev/videoN) or - for raw bgr24 frames on stdin', dest='live_source', metavar='SOURCE')
+    program.add_argument('--live-output', help='where the live frames go: - for raw bgr24 frames on stdout, else a file or stream url encoded by ffmpeg', dest='live_output', default=modules.variables.values.live_output, metavar='TARGET')
+    program.add_argument('--live-latency-budget', help='milliseconds from capture to output allowed for a live frame, frames falling behind are dropped', dest='live_latency_budget', type=int, default=modules.variables.values.live_latency_budget, metavar='MS')
+    program.add_argument('--live-size', help='size of the live frames, required for stdin', dest='live_size', type=decode_size, metavar='WIDTHxHEIGHT')
+    program.add_argument('--live-fps', help='frame rate of the live source, when it does not tell', dest='live_fps', type=float)
+    program.add_argument('--live-report', help='json file of the latency and drop report of the live run', dest='live_report', metavar='PATH')
     program.add_argument('--execution-provider', help='execution provider', dest='execution_provider', default=['cpu'], choices=suggest_execution_providers(), nargs='+')
+    program.add_argument('--autotune', help='calibrate threads and batch size on this host, on frames with the --source face, save them as its profile and exit', dest='autotune', action='store_true')
+    program.add_argument('--no-autotune-profile', help='ignore the autotune profile of this host', dest='autotune_profile', action='store_false')
+    program.add_argument('--no-aligned-enhancer', help='let GFPGAN detect and align faces itself instead of reusing insightface landmarks', dest='enhancer_aligned', action='store_false')
+    program.add_argument('--intra-op-threads', help='onnxruntime threads per inference (0 to share the cores between execution threads)', dest='intra_op_threads', type=int, default=None)
+    program.add_argument('--inter-op-threads', help='onnxruntime threads running independent nodes in parallel execution mode (0 for default)', dest='inter_op_threads', type=int, default=modules.variables.values.inter_op_threads)
+    program.add_argument('--graph-optimization-level', help='onnxruntime graph optimization level', dest='graph_optimization_level', default=modules.variables.values.graph_optimization_level, choices=modules.variables.values.graph_optimization_levels)
+    program.add_argument('--execution-mode', help='onnxruntime execution mode', dest='execution_mode', default=modules.variables.values.execution_mode, choices=modules.variables.values.execution_modes)
+    program.add_argument('--session-option', help='onnxruntime option of one model, as processor.option=value (processors: face_analyser, face_swapper)', dest='session_options', default=[], nargs='+', metavar='PROCESSOR.OPTION=VALUE')
+    program.add_argument('--no-optimized-model-cache', help='optimize model graphs at every start instead of loading them from models/optimized', dest='optimized_model_cache', action='store_false')
+    program.add_argument('--model-precision', help='precision of the swapper and recognition models: fp32, fp16 (gpu providers only) or dynamically quantized int8', dest='model_precision', default=modules.variables.values.model_precision, choices=modules.variables.values.model_precisions)
+    program.add_argument('--precision-report', help='compare speed and output difference of each model precision on the first frames of a reference clip and exit', dest='precision_report', metavar='CLIP')
+    program.add_argument('--io-threads', help='number of threads reading and writing frames around the execution threads', dest='io_threads', type=int, default=modules.variables.values.io_threads)
+    program.add_argument('--io-queue-size', help='number of decoded frames read ahead and waiting to be written', dest='io_queue_size', type=int, default=modules.variables.values.io_queue_size)
+    program.add_argument('--temp-frame-format', help='format of the intermediate frames: png, uncompressed bmp, jpg for drafts, or raw for a single memory-mapped frame store', dest='temp_frame_format', default=modules.variables.values.temp_frame_format, choices=modules.variables.values.temp_frame_formats)
+    program.add_argument('--temp-frame-png-compression', help='png compression level of the intermediate frames (0-9)', dest='temp_frame_png_compression', type=int, default=modules.variables.values.temp_frame_png_compression, choices=range(10), metavar='[0-9]')
+    program.add_argument('--temp-frame-jpeg-quality', help='jpg quality of the intermediate frames (0-100)', dest='temp_frame_jpeg_quality', type=int, default=modules.variables.values.temp_frame_jpeg_quality, choices=range(101), metavar='[0-100]')
+    program.add_argument('--no-enhancer-cpu-mode', help='run the enhancer on cpu with default torch settings instead of inference mode and channels-last layout', dest='enhancer_cpu_mode', action='store_false')
+    program.add_argument('--enhancer-precision', help='precision of the enhancer on cpu: fp32, bf16 autocast or int8 dynamic quantization', dest='enhancer_precision', default=modules.variables.values.enhancer_precision, choices=modules.variables.values.enhancer_precisions)
+    program.add_argument('--torch-threads', help='torch threads of the enhancer on cpu (0 for half the cores)', dest='torch_threads', type=int, default=modules.variables.values.torch_threads)
+    program.add_argument('--enhancer-report', help='compare speed and output difference of the enhancer cpu modes on the first face of an image (or a synthetic face) and exit', dest='enhancer_report', nargs='?', const='', metavar='IMAGE')
+    program.add_argument('--result-cache-size', help='megabytes of image outputs cached by content of the inputs and options, returned as is when the same job comes again (0, the default, disables the cache)', dest='result_cache_size', type=int, default=modules.variables.values.result_cache_size, metavar='MB')
+    program.add_argument('--job-report', help='write the json report of each job next to its output', dest='job_report', action='store_true')
+    program.add_argument('--metrics-textfile', help='prometheus textfile updated with the metrics of each job', dest='metrics_textfile', metavar='PATH')
+    program.add_argument('--trace', help='record the spans of each job per thread into a chrome trace (chrome://tracing, ui.perfetto.dev)', dest='trace_path', metavar='PATH')
+    program.add_argument('--trace-cprofile', help='also profile the execution threads with cProfile into a pstats dump', dest='cprofile_path', metavar='PATH')
+    program.add_argument('--benchmark', help='run the frame pipeline on synthetic clips with stub or real models, save the results in benchmarks/results and exit', dest='benchmark', nargs='?', const='stub', choices=['stub', 'real'])
+    program.add_argument('--benchmark-face', help='face image pasted on the synthetic clips for the real models', dest='benchmark_face', metavar='IMAGE')
+    program.add_argument('--benchmark-compare', help='compare two benchmark results and exit', dest='benchmark_compare', nargs=2, metavar=('BASELINE', 'RESULTS'))
+    program.add_argument('--video-encoder', help='codec of the output video, encoded on the gpu when this host has a working hardware encoder for it', dest='video_encoder', default=modules.variables.values.video_encoder, choices=modules.variables.values.video_encoders)
+    program.add_argument('--video-quality', help='quality of the output video, crf like (0-51, lower is better)', dest='video_quality', type=int, default=modules.variables.values.video_quality, choices=range(52), metavar='[0-51]')
+    program.add_argument('--video-preset', help='speed preset of the output video encoder', dest='video_preset', default=modules.variables.values.video_preset, choices=modules.variables.values.video_presets)
+    program.add_argument('--video-threads', help='threads of the output video encoder (0 for ffmpeg default)', dest='video_threads', type=int, default=modules.variables.values.video_threads)
+    program.add_argument('--no-hardware-acceleration', help='decode and encode videos on cpu only', dest='hardware_acceleration', action='store_false')
+    program.add_argument('--annotate-at', help='debug of a video: seconds at which the score analysis also renders annotated frames', dest='annotate_timestamps', type=float, default=modules.variables.values.annotate_timestamps, nargs='+', metavar='SECONDS')
+    program.add_argument('--segmented-output', help='also write the output video as hls segments, next to it in a .hls directory, as soon as their frames are processed', dest='segmented_output', action='store_true')
+    program.add_argument('--segment-duration', help='seconds of video of each hls segment', dest='segment_duration', type=float, default=modules.variables.values.segment_duration)
+    program.add_argument('--frame-cache-size', help='number of recent processed frames kept to reuse on repeated frames, for static shots or screen recordings: lossy, small motion within the tolerance is frozen (0, the default, to disable)', dest='frame_cache_size', type=int, default=modules.variables.values.frame_cache_size)
+    program.add_argument('--frame-cache-tolerance', help='maximum thumbnail difference (0-255) for two frames to be considered identical', dest='frame_cache_tolerance', type=int, default=modules.variables.values.frame_cache_tolerance)
 
     args = program.parse_args()
-
+    if args.live_source and args.live_output == '-':
+        # stdout carries the live frames, status messages go to stderr
+        sys.stdout = sys.stderr
+
+    modules.variables.values.frame_processors = args.frame_processors
+    modules.variables.values.source_path = args.source_path
+    modules.variables.values.subject_path = args.subject_path
+    modules.variables.values.face_option = args.face_option
+    modules.variables.values.enhancer_option = args.enhancer_option
+    modules.variables.values.distance_score = args.distance_score
+    modules.variables.values.bulk_targets = args.bulk_targets
+    modules.variables.values.bulk_output = args.bulk_output
+    modules.variables.values.bulk_batch_size = max(args.bulk_batch_size, 1)
+    modules.variables.values.live_source = args.live_source
+    modules.variables.values.live_output = args.live_output
+    modules.variables.values.live_latency_budget = max(args.live_latency_budget, 1)
+    modules.variables.values.live_size = args.live_size
+    modules.variables.values.live_fps = args.live_fps
+    modules.variables.values.live_report = args.live_report
     modules.variables.values.execution_providers = decode_execution_providers(args.execution_provider)
     modules.variables.values.execution_threads = suggest_execution_threads()
     modules.variables.values.max_memory = suggest_max_memory()
+    modules.variables.values.autotune = args.autotune
+    if args.autotune_profile and not args.autotune and autotune.load_profile():
+        update_status(f'Loaded autotune profile {autotune.get_profile_path()}')
+    modules.variables.values.enhancer_aligned = args.enhancer_aligned
+    modules.variables.values.enhancer_cpu_mode = args.enhancer_cpu_mode
+    modules.variables.values.enhancer_precision = args.enhancer_precision
+    modules.variables.values.torch_threads = max(args.torch_threads, 0)
+    modules.variables.values.enhancer_report = args.enhancer_report
+    if args.intra_op_threads is not None:
+        modules.variables.values.intra_op_threads = max(args.intra_op_threads, 0)
+    modules.variables.values.inter_op_threads = max(args.inter_op_threads, 0)
+    modules.variables.values.graph_optimization_level = args.graph_optimization_level
+    modules.variables.values.execution_mode = args.execution_mode
+    modules.variables.values.processor_session_options = decode_session_options(program, args.session_options)
+    modules.variables.values.optimized_model_cache = args.optimized_model_cache
+    modules.variables.values.model_precision = args.model_precision
+    modules.variables.values.precision_report = args.precision_report
+    modules.variables.values.io_threads = max(args.io_threads, 1)
+    modules.variables.values.io_queue_size = max(args.io_queue_size, 1)
+    modules.variables.values.temp_frame_format = args.temp_frame_format
+    modules.variables.values.temp_frame_png_compression = args.temp_frame_png_compression
+    modules.variables.values.temp_frame_jpeg_quality = args.temp_frame_jpeg_quality
+    modules.variables.values.result_cache_size = max(args.result_cache_size, 0)
+    modules.variables.values.job_report = args.job_report
+    modules.variables.values.metrics_textfile = args.metrics_textfile
+    modules.variables.values.trace_path = args.trace_path
+    modules.variables.values.cprofile_path = args.cprofile_path
+    modules.variables.values.benchmark = args.benchmark
+    modules.variables.values.benchmark_face = args.benchmark_face
+    modules.variables.values.benchmark_compare = args.benchmark_compare
+    modules.variables.values.video_encoder = args.video_encoder
+    modules.variables.values.video_quality = args.video_quality
+    modules.variables.values.video_preset = args.video_preset
+    modules.variables.values.video_threads = max(args.video_threads, 0)
+    modules.variables.values.hardware_acceleration = args.hardware_acceleration
+    modules.variables.values.frame_cache_size = max(args.frame_cache_size, 0)
+    modules.variables.values.frame_cache_tolerance = args.frame_cache_tolerance
+    modules.variables.values.annotate_timestamps = args.annotate_timestamps
+    modules.variables.values.segmented_output = args.segmented_output
+    modules.variables.values.segment_duration = max(args.segment_duration, 1.0)
+
+
+def decode_size(size: str) -> tuple[int, int]:
+    try:
+        width, height = size.lower().split('x')
+        return int(width), int(height)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{size} is not a size like 1280x720')
+
+
+def decode_session_options(program: argparse.ArgumentParser, session_options: List[str]) -> Dict[str, Dict[str, Any]]:
+    processor_session_options: Dict[str, Dict[str, Any]] = {}
+    for session_option in session_options:
+        try:
+            key, value = session_option.split('=', 1)
+            processor, option = key.split('.', 1)
+        except ValueError:
+            program.error(f'invalid session option {session_option}, expected processor.option=value')
+        if processor not in SESSION_PROCESSORS:
+            program.error(f'invalid session option processor {processor}, expected one of {", ".join(SESSION_PROCESSORS)}')
+        if option not in SESSION_OPTION_KEYS:
+            program.error(f'invalid session option {option}, expected one of {", ".join(SESSION_OPTION_KEYS)}')
+        choices = {'graph_optimization_level': modules.variables.values.graph_optimization_levels,
+                   'execution_mode': modules.variables.values.execution_modes}.get(option)
+        if choices and value not in choices:
+            program.error(f'invalid {option} {value}, expected one of {", ".join(choices)}')
+        if option.endswith('_threads'):
+            try:
+                value = max(int(value), 0)
+            except ValueError:
+                program.error(f'invalid {option} {value}, expected a number of threads')
+        processor_session_options.setdefault(processor, {})[option] = value
+    return processor_session_options
 
 
 def encode_execution_providers(execution_providers: List[str]) -> List[str]:
@@ -59,7 +213,8 @@ def decode_execution_providers(execution_providers: List[str]) -> List[str]:
 def suggest_max_memory() -> int:
     if platform.system().lower() == 'darwin':
         return 4
-    return 16
+    # leave a quarter of the physical memory to the system
+    return max(int(psutil.virtual_memory().total * 0.75 / 1024 ** 3), 1)
 
 
 def suggest_execution_providers() -> List[str]:
@@ -118,15 +273,29 @@ def update_status(message: str, scope: str = 'REACTOR.CORE') -> None:
 
 
 def process(process: Literal["process", "debug"]) -> None:
+    result_cache_path = None
+    if has_image_extension(modules.variables.values.target_path):
+        restored, result_cache_path = restore_cached_result(process)
+        if restored:
+            return
     for frame_processor in get_frame_processors_modules(modules.variables.values.frame_processors):
         if not frame_processor.pre_start():
             return
+    metrics.reset(mode=process,
+                  target_path=modules.variables.values.target_path,
+                  output_path=modules.variables.values.output_path,
+                  frame_processors=list(modules.variables.values.frame_processors),
+                  execution_providers=modules.variables.values.execution_providers,
+                  execution_threads=modules.variables.values.execution_threads)
+    profiler.start()
     if has_image_extension(modules.variables.values.target_path):
         if not modules.variables.values.nsfw:
             from modules.predicter import predict_image
-            if predict_image(modules.variables.values.target_path):
-                destroy()
+            with metrics.timer('predict'):
+                if predict_image(modules.variables.values.target_path):
+                    destroy()
         shutil.copy2(modules.variables.values.target_path, modules.variables.values.output_path)
+        metrics.increment('frames')
         for frame_processor in get_frame_processors_modules(modules.variables.values.frame_processors):
             update_status('Progressing...', frame_processor.NAME)
             method = getattr(frame_processor, process + "_image")
@@ -135,41 +304,73 @@ def process(process: Literal["process", "debug"]) -> None:
                    modules.variables.values.subject_path,
                    modules.variables.values.output_path)
             release_resources()
+        # an error caught by a processor leaves the image as it was, not the result of these options
+        if result_cache_path and is_image(modules.variables.values.output_path) and not metrics.get_counter('errors'):
+            result_cache.store(result_cache_path, modules.variables.values.output_path)
         clean_temp(modules.variables.values.target_path)
         if is_image(modules.variables.values.output_path):
             update_status('Processing to image succeed!')
         else:
             update_status('Processing to image failed!')
+        write_job_report()
         return
     # process image to videos
     if not modules.variables.values.nsfw:
         from modules.predicter import predict_video
-        if predict_video(modules.variables.values.target_path):
-            destroy()
+        with metrics.timer('predict'):
+            if predict_video(modules.variables.values.target_path):
+                destroy()
+    if process == 'debug':
+        # scores of the faces of every frame from the face index, instead of rendering a debug video
+        from modules.score_analysis import analyse_scores
+        analyse_scores(modules.variables.values.target_path,
+                       modules.variables.values.subject_path,
+                       modules.variables.values.output_path,
+                       modules.variables.values.annotate_timestamps)
+        write_job_report()
+        return
 
     if modules.variables.values.decompose_video:
         update_status('Creating temp resources...')
         create_temp(modules.variables.values.target_path)
         update_status('Extracting frames...')
-        extract_frames(modules.variables.values.target_path)
+        try:
+            with metrics.timer('extract'):
+                extract_frames(modules.variables.values.target_path)
+        except FFmpegError as exception:
+            update_status(f'Extracting frames failed: {exception}')
+            return
     else:
         update_status('Keeping frames existing.')
 
     temp_frame_paths = get_temp_frame_paths(modules.variables.values.target_path)
-    for frame_processor in get_frame_processors_modules(modules.variables.values.frame_processors):
+    metrics.increment('frames', len(temp_frame_paths))
+    # the index describes the original frames, only the first processor sees them
+    face_index.activate(modules.variables.values.target_path, len(temp_frame_paths), record=modules.variables.values.decompose_video)
+    frame_processors = get_frame_processors_modules(modules.variables.values.frame_processors)
+    for frame_processor in frame_processors:
+        if modules.variables.values.segmented_output and modules.variables.values.recompose_video and frame_processor is frame_processors[-1]:
+            # frames written by the last processor are final, segments are encoded as they complete
+            segmenter.activate(modules.variables.values.target_path, modules.variables.values.output_path, len(temp_frame_paths))
         update_status('Progressing... source_path={}'.format(modules.variables.values.source_path),
                       frame_processor.NAME)
         method = getattr(frame_processor, process + "_video")
         method(source_path=modules.variables.values.source_path,
                temp_frame_paths=temp_frame_paths,
                subject_path=modules.variables.values.subject_path)
+        face_index.deactivate()
+        segmenter.deactivate()
         release_resources()
 
     update_status(f'Creating video...')
 
     if modules.variables.values.recompose_video:
-        utilities.create_video(target_path=modules.variables.values.target_path,
-                               output_path=modules.variables.values.output_path)
+        try:
+            with metrics.timer('encode'):
+                utilities.create_video(target_path=modules.variables.values.target_path,
+                                       output_path=modules.variables.values.output_path)
+        except FFmpegError as exception:
+            update_status(f'Creating video failed: {exception}')
     else:
         update_status("Not recomposing video.")
     # clean and validate
@@ -178,6 +379,55 @@ def process(process: Literal["process", "debug"]) -> None:
         update_status('Processing to video succeed!')
     else:
         update_status('Processing to video failed!')
+    write_job_report()
+
+
+def get_result_cache_path(process: str) -> str:
+    return result_cache.get_cache_path(process,
+                                       modules.variables.values.source_path,
+                                       modules.variables.values.target_path,
+                                       modules.variables.values.subject_path,
+                                       modules.variables.values.output_path)
+
+
+def restore_cached_result(process: str) -> Tuple[bool, Optional[str]]:
+    """
+    Output of an image job already done with the same inputs and options, copied from the result cache.
+    :return: whether the output was restored, and the cache path to store the output of the job at, None without a cache.
+    The path is computed before the job runs, clean_temp may remove the target once it is done.
+    """
+    if not modules.variables.values.result_cache_size:
+        return False, None
+    try:
+        cache_path = get_result_cache_path(process)
+    except OSError:
+        # missing inputs, left to the checks of the processors
+        return False, None
+    if not result_cache.restore(cache_path, modules.variables.values.output_path):
+        return False, cache_path
+    metrics.reset(mode=process,
+                  target_path=modules.variables.values.target_path,
+                  output_path=modules.variables.values.output_path,
+                  result_cache=True)
+    profiler.start()
+    metrics.increment('frames')
+    update_status('Processing to image succeed! (from the result cache)')
+    write_job_report()
+    return True, cache_path
+
+
+def write_job_report() -> None:
+    for output_path in profiler.stop():
+        update_status(f'Profile saved to {output_path}')
+    if not modules.variables.values.job_report and not modules.variables.values.metrics_textfile:
+        return
+    report = metrics.get_report(model_load_seconds=model_manager.get_load_times())
+    if modules.variables.values.job_report:
+        report_path = os.path.splitext(modules.variables.values.output_path)[0] + '.report.json'
+        metrics.write_report(report_path, report)
+        update_status(f'Job report saved to {report_path} ({report["frames_per_second"]} frames/s)')
+    if modules.variables.values.metrics_textfile:
+        metrics.write_prometheus_textfile(modules.variables.values.metrics_textfile, report)
 
 
 def start() -> None:
@@ -198,5 +448,40 @@ def run() -> None:
         print("pre_check KO")
         return
     limit_resources()
+    update_status(f'ffmpeg decoding with {get_hwaccel() or "cpu"}, encoding with {get_video_encoder()}')
+    if modules.variables.values.autotune:
+        autotune.autotune()
+        return
+    if modules.variables.values.benchmark_compare:
+        from modules.benchmark import compare
+        compare(*modules.variables.values.benchmark_compare)
+        return
+    if modules.variables.values.benchmark:
+        from modules.benchmark import benchmark
+        benchmark(modules.variables.values.benchmark, modules.variables.values.benchmark_face)
+        return
+    if modules.variables.values.precision_report:
+        from modules.model_variants import compare_precisions
+        compare_precisions(modules.variables.values.precision_report)
+        return
+    if modules.variables.values.bulk_targets:
+        from modules.bulk import bulk, get_default_output_directory_path
+        bulk(modules.variables.values.bulk_targets,
+             modules.variables.values.bulk_output or get_default_output_directory_path(modules.variables.values.bulk_targets),
+             modules.variables.values.source_path,
+             modules.variables.values.subject_path)
+        return
+    if modules.variables.values.live_source:
+        from modules.live import live
+        live(modules.variables.values.live_source,
+             modules.variables.values.live_output,
+             modules.variables.values.source_path,
+             modules.variables.values.subject_path)
+        return
+    if modules.variables.values.enhancer_report is not None:
+        from modules.processors.frame.face_enhancer import compare_cpu_modes
+        compare_cpu_modes(modules.variables.values.enhancer_report or None)
+        return
+    model_manager.preload_models(model_manager.get_enabled_frame_processors())
     window = ui.App(start=start, debug=debug)
     window.mainloop()
@@ -1,24 +1,70 @@
-from typing import Any
+import glob
+import os
+import threading
+from typing import Any, List
 import insightface
 import numpy
+import onnxruntime
+from insightface.utils.storage import ensure_available
 
+import modules.face_index as face_index
+import modules.metrics as metrics
 import modules.variables.values
+from modules.inference_session import load_model
 from modules.variables.typing import Face, Frame
 
 FACE_ANALYSER = None
+THREAD_LOCK = threading.Lock()
+MODEL_NAME = 'buffalo_l'
+DETECTION_SIZE = (640, 640)
+
+
+class FaceAnalyser(insightface.app.FaceAnalysis):
+    """
+    insightface FaceAnalysis, with its models loaded through modules.inference_session to apply our session options.
+    """
+
+    def __init__(self, name: str, root: str = '~/.insightface') -> None:
+        onnxruntime.set_default_logger_severity(3)
+        self.models = {}
+        self.model_dir = ensure_available('models', name, root=root)
+        for onnx_file in sorted(glob.glob(os.path.join(self.model_dir, '*.onnx'))):
+            model = load_model(onnx_file, 'face_analyser')
+            if model is not None and model.taskname not in self.models:
+                self.models[model.taskname] = model
+        self.det_model = self.models['detection']
 
 
 def get_face_analyser() -> Any:
     global FACE_ANALYSER
 
-    if FACE_ANALYSER is None:
-        FACE_ANALYSER = insightface.app.FaceAnalysis(name='buffalo_l', providers=modules.variables.values.execution_providers)
-        FACE_ANALYSER.prepare(ctx_id=0, det_size=(640, 640))
+    with THREAD_LOCK:
+        if FACE_ANALYSER is None:
+            face_analyser = FaceAnalyser(name=MODEL_NAME)
+            face_analyser.prepare(ctx_id=0, det_size=DETECTION_SIZE)
+            FACE_ANALYSER = face_analyser
     return FACE_ANALYSER
 
 
+def warm_up() -> None:
+    get_face_analyser().get(numpy.zeros((640, 640, 3), dtype=numpy.uint8))
+
+
+def detect_faces(frame: Frame) -> List[Face]:
+    """ Faces of the frame, from the face index of the video when it already has them. """
+    faces = face_index.lookup_faces()
+    if faces is not None:
+        metrics.increment('faces_indexed', len(faces))
+        return faces
+    with metrics.timer('detect'):
+        faces = get_face_analyser().get(frame)
+    metrics.increment('faces_detected', len(faces))
+    face_index.record_faces(faces)
+    return faces
+
+
 def get_one_face(frame: Frame) -> Any:
-    face = get_face_analyser().get(frame)
+    face = detect_faces(frame)
     try:
         return min(face, key=lambda x: x.bbox[0])
     except ValueError:
@@ -37,7 +83,7 @@ def extract_best_one_face(source_frame: Frame, ref_embedding: Frame) -> Frame:
 
 def extract_all_faces(source_frame: Frame) -> list[tuple[tuple, Frame]]:
     output = []
-    faces = get_face_analyser().get(source_frame)
+    faces = detect_faces(source_frame)
     for face in faces:
         bbox = face.bbox[:4].astype(int)  # Les coordonnées de la boîte englobante
         top, left, bottom, right = bbox[1], bbox[0], bbox[3], bbox[2]
@@ -53,7 +99,7 @@ def get_best_one_face(source_frame: Frame, ref_embedding: Frame) -> Face:
     :param ref_frame: face to search
     :return:
     """
-    faces_from_frame = get_face_analyser().get(source_frame)
+    faces_from_frame = detect_faces(source_frame)
     if faces_from_frame:
         best_score = modules.variables.values.distance_score
         selected_face = None
@@ -69,6 +115,6 @@ def get_best_one_face(source_frame: Frame, ref_embedding: Frame) -> Face:
 
 def get_many_faces(frame: Frame) -> Any:
     try:
-        return get_face_analyser().get(frame)
+        return detect_faces(frame)
     except IndexError:
         return None
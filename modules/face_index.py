@@ -0,0 +1,241 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import numpy
+
+from modules.utilities import resolve_relative_path
+from modules.variables.typing import Face
+from modules.video_metadata import get_cache_key
+
+INDEX_DIRECTORY = resolve_relative_path('../analysis')
+INDEX_VERSION = 1
+COLUMNS = ['offsets', 'bboxes', 'kps', 'scores', 'embeddings']
+FACE_INDEX: Optional['FaceIndex'] = None
+# the index of the video previewed by the ui, apart from the one of the running job
+PREVIEW_FACE_INDEX: Optional['FaceIndex'] = None
+CONTENT_HASHES: Dict[Tuple[str, int, int], str] = {}
+THREAD_LOCK = threading.Lock()
+THREAD_LOCAL = threading.local()
+
+
+class FaceIndex:
+    """
+    Faces of every frame of a video, as columns : the faces of frame i are rows offsets[i]:offsets[i + 1]
+    of bboxes (n, 4), kps (n, 5, 2), scores (n) and embeddings (n, 512). Saved as .npy files and memory-mapped
+    when loaded, a new index is filled frame by frame while the video is analysed.
+    """
+
+    def __init__(self, directory_path: str, frame_total: int, columns: Optional[Dict[str, numpy.ndarray[Any, Any]]] = None) -> None:
+        self.directory_path = directory_path
+        self.frame_total = frame_total
+        self.columns = columns
+        self.recorded_faces: Dict[int, List[Face]] = {}
+        self.lock = threading.Lock()
+
+    @property
+    def complete(self) -> bool:
+        return self.columns is not None
+
+    @classmethod
+    def load(cls, directory_path: str) -> Optional['FaceIndex']:
+        index_path = os.path.join(directory_path, 'index.json')
+        if not os.path.isfile(index_path):
+            return None
+        with open(index_path) as index_file:
+            index = json.load(index_file)
+        if index.get('version') != INDEX_VERSION:
+            return None
+        columns = {column: numpy.load(os.path.join(directory_path, f'{column}.npy'), mmap_mode='r') for column in COLUMNS}
+        return cls(directory_path, index['frame_total'], columns)
+
+    def get_faces(self, frame_index: int) -> Optional[List[Face]]:
+        if self.columns is None:
+            with self.lock:
+                return self.recorded_faces.get(frame_index)
+        if not 0 <= frame_index < self.frame_total:
+            return None
+        start, end = self.columns['offsets'][frame_index:frame_index + 2]
+        return [Face(bbox=numpy.array(self.columns['bboxes'][row]),
+                     kps=numpy.array(self.columns['kps'][row]),
+                     det_score=float(self.columns['scores'][row]),
+                     embedding=numpy.array(self.columns['embeddings'][row]))
+                for row in range(start, end)]
+
+    def record_faces(self, frame_index: int, faces: List[Face]) -> None:
+        if self.columns is None and 0 <= frame_index < self.frame_total:
+            with self.lock:
+                self.recorded_faces.setdefault(frame_index, faces)
+
+    def save(self) -> bool:
+        """ Write the recorded faces once every frame was analysed, aside then renamed so a partial index is never loaded. """
+        with self.lock:
+            if self.columns is not None or len(self.recorded_faces) < self.frame_total:
+                return False
+            faces = [face for frame_index in range(self.frame_total) for face in self.recorded_faces[frame_index]]
+            counts = [len(self.recorded_faces[frame_index]) for frame_index in range(self.frame_total)]
+            columns = {
+                'offsets': numpy.concatenate([[0], numpy.cumsum(counts)]).astype(numpy.int64),
+                'bboxes': numpy.array([face.bbox for face in faces], dtype=numpy.float32).reshape(-1, 4),
+                'kps': numpy.array([face.kps for face in faces], dtype=numpy.float32).reshape(-1, 5, 2),
+                'scores': numpy.array([face.det_score for face in faces], dtype=numpy.float32),
+                'embeddings': numpy.array([face.embedding for face in faces], dtype=numpy.float32).reshape(-1, 512)
+            }
+            temp_directory_path = self.directory_path + '.tmp'
+            shutil.rmtree(temp_directory_path, ignore_errors=True)
+            os.makedirs(temp_directory_path)
+            for column, values in columns.items():
+                numpy.save(os.path.join(temp_directory_path, f'{column}.npy'), values)
+            with open(os.path.join(temp_directory_path, 'index.json'), 'w') as index_file:
+                json.dump({'version': INDEX_VERSION, 'frame_total': self.frame_total, 'face_total': len(faces)}, index_file)
+            shutil.rmtree(self.directory_path, ignore_errors=True)
+            os.replace(temp_directory_path, self.directory_path)
+            self.columns = columns
+            self.recorded_faces.clear()
+            return True
+
+    def get_face_frames(self) -> numpy.ndarray[Any, Any]:
+        """ Frame index of every face row. """
+        assert self.columns is not None
+        return numpy.repeat(numpy.arange(self.frame_total), numpy.diff(self.columns['offsets']))
+
+    def get_match_distances(self, subject_embedding: numpy.ndarray[Any, Any]) -> numpy.ndarray[Any, Any]:
+        """ Distance of every face to the subject, the score get_best_one_face compares to distance_score. """
+        assert self.columns is not None
+        return numpy.linalg.norm(numpy.asarray(self.columns['embeddings']) - subject_embedding, axis=1)
+
+    def get_best_faces(self, subject_embedding: numpy.ndarray[Any, Any], distance_score: float) -> numpy.ndarray[Any, Any]:
+        """
+        Row, within its frame, of the face get_best_one_face selects in every frame, -1 where none is close enough.
+        """
+        assert self.columns is not None
+        face_frames = self.get_face_frames()
+        distances = self.get_match_distances(subject_embedding)
+        best_distances = numpy.full(self.frame_total, numpy.inf)
+        numpy.minimum.at(best_distances, face_frames, distances)
+        rows = numpy.flatnonzero((distances == best_distances[face_frames]) & (distances < distance_score))
+        best_faces = numpy.full(self.frame_total, -1, dtype=numpy.int64)
+        # reversed so that the first face wins between equal distances, like the strict comparison of get_best_one_face
+        best_faces[face_frames[rows][::-1]] = (rows - self.columns['offsets'][face_frames[rows]])[::-1]
+        return best_faces
+
+    def get_face_counts(self) -> numpy.ndarray[Any, Any]:
+        assert self.columns is not None
+        return numpy.diff(self.columns['offsets'])
+
+
+def get_content_hash(video_path: str) -> str:
+    """ Hash of the video content, cached until the file changes. """
+    key = get_cache_key(video_path)
+    with THREAD_LOCK:
+        if key in CONTENT_HASHES:
+            return CONTENT_HASHES[key]
+    content_hash = hashlib.blake2b(digest_size=16)
+    with open(video_path, 'rb') as video_file:
+        for chunk in iter(lambda: video_file.read(1 << 20), b''):
+            content_hash.update(chunk)
+    with THREAD_LOCK:
+        CONTENT_HASHES[key] = content_hash.hexdigest()
+    return CONTENT_HASHES[key]
+
+
+def get_detector_settings() -> Dict[str, Any]:
+    """ Everything that changes the detected faces or their embeddings. """
+    import insightface
+    from modules.face_analyser import DETECTION_SIZE, MODEL_NAME
+    from modules.model_variants import get_model_precision
+
+    return {'model': MODEL_NAME, 'detection_size': DETECTION_SIZE, 'precision': get_model_precision(), 'insightface': insightface.__version__}
+
+
+def get_index_directory_path(video_path: str) -> str:
+    settings_hash = hashlib.blake2b(json.dumps(get_detector_settings(), sort_keys=True).encode(), digest_size=8).hexdigest()
+    return os.path.join(INDEX_DIRECTORY, f'{get_content_hash(video_path)}-{settings_hash}')
+
+
+def activate(video_path: str, frame_total: int, record: bool, preview: bool = False) -> Optional[FaceIndex]:
+    """
+    Serve the faces of the video from its index. Without an index, record one while the video is analysed
+    when record is set, from frames which have not been processed yet.
+    :param preview: index of the ui preview, served to the frames entered with current_frame(preview=True) only.
+    """
+    global FACE_INDEX, PREVIEW_FACE_INDEX
+
+    directory_path = get_index_directory_path(video_path)
+    face_index = FaceIndex.load(directory_path)
+    if face_index and face_index.frame_total != frame_total:
+        face_index = None
+    if face_index is None and record:
+        face_index = FaceIndex(directory_path, frame_total)
+    with THREAD_LOCK:
+        if preview:
+            PREVIEW_FACE_INDEX = face_index
+        else:
+            FACE_INDEX = face_index
+    return face_index
+
+
+def save_index() -> None:
+    """ Save the index being recorded, if every frame was analysed. """
+    face_index = FACE_INDEX
+    if face_index and face_index.save():
+        print(f'[REACTOR.FACE-INDEX] Face index saved to {face_index.directory_path}')
+
+
+def deactivate(preview: bool = False) -> None:
+    global FACE_INDEX, PREVIEW_FACE_INDEX
+
+    if preview:
+        with THREAD_LOCK:
+            PREVIEW_FACE_INDEX = None
+        return
+    save_index()
+    with THREAD_LOCK:
+        FACE_INDEX = None
+
+
+def get_face_index() -> Optional[FaceIndex]:
+    return FACE_INDEX
+
+
+def is_recording() -> bool:
+    face_index = FACE_INDEX
+    return face_index is not None and not face_index.complete
+
+
+@contextmanager
+def current_frame(frame_index: int, preview: bool = False) -> Iterator[None]:
+    """ Frame analysed by this thread, the faces detected meanwhile belong to it, in the preview index when preview is set. """
+    THREAD_LOCAL.frame_index = frame_index
+    THREAD_LOCAL.preview = preview
+    try:
+        yield
+    finally:
+        THREAD_LOCAL.frame_index = None
+        THREAD_LOCAL.preview = False
+
+
+def get_current_frame() -> Optional[int]:
+    return getattr(THREAD_LOCAL, 'frame_index', None)
+
+
+def get_thread_face_index() -> Optional[FaceIndex]:
+    return PREVIEW_FACE_INDEX if getattr(THREAD_LOCAL, 'preview', False) else FACE_INDEX
+
+
+def lookup_faces() -> Optional[List[Face]]:
+    face_index = get_thread_face_index()
+    frame_index = getattr(THREAD_LOCAL, 'frame_index', None)
+    if face_index is None or frame_index is None:
+        return None
+    return face_index.get_faces(frame_index)
+
+
+def record_faces(faces: List[Face]) -> None:
+    face_index = get_thread_face_index()
+    frame_index = getattr(THREAD_LOCAL, 'frame_index', None)
+    if face_index is not None and frame_index is not None:
+        face_index.record_faces(frame_index, faces)
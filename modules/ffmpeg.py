@@ -0,0 +1,269 @@
+import collections
+import json
+import os
+import platform
+import shutil
+import subprocess
+import threading
+from typing import Any, Callable, Dict, IO, List, Optional
+from tqdm import tqdm
+
+import modules.metrics as metrics
+import modules.profiler as profiler
+import modules.variables.values
+
+STDERR_TAIL_SIZE = 20
+CAPABILITIES: Optional[Dict[str, Any]] = None
+THREAD_LOCK = threading.Lock()
+# fastest first, each one is only used once a device was actually opened on this host
+HWACCELS = ['cuda', 'd3d11va', 'videotoolbox', 'qsv', 'vaapi', 'dxva2']
+HARDWARE_ENCODERS = {
+    'libx264': ['h264_nvenc', 'h264_qsv', 'h264_videotoolbox', 'h264_amf'],
+    'libx265': ['hevc_nvenc', 'hevc_qsv', 'hevc_videotoolbox', 'hevc_amf'],
+    'libvpx-vp9': ['vp9_qsv']
+}
+SOFTWARE_ENCODERS = ['libx264', 'libx265', 'libvpx-vp9', 'mpeg4']
+NVENC_PRESETS = {'ultrafast': 'p1', 'superfast': 'p1', 'veryfast': 'p2', 'faster': 'p3', 'fast': 'p4',
+                 'medium': 'p5', 'slow': 'p6', 'slower': 'p7', 'veryslow': 'p7'}
+QSV_PRESETS = ['veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow']
+
+
+class FFmpegError(Exception):
+    """
+    ffmpeg exited with a non-zero code, the end of its stderr tells why.
+    """
+
+    def __init__(self, commands: List[str], return_code: int, stderr_tail: List[str]) -> None:
+        self.commands = commands
+        self.return_code = return_code
+        self.stderr_tail = stderr_tail
+        super().__init__(f'ffmpeg exited with code {return_code}: {" ".join(stderr_tail[-3:]) or "no output"}')
+
+
+def to_number(value: Optional[str]) -> float:
+    # ffmpeg writes N/A until a value is known
+    try:
+        return float((value or '0').rstrip('x'))
+    except ValueError:
+        return 0.0
+
+
+def parse_progress(progress: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Typed values of one block of -progress output, each block ending with its progress=continue|end line.
+    """
+    return {
+        'frame': int(to_number(progress.get('frame'))),
+        'fps': to_number(progress.get('fps')),
+        'speed': to_number(progress.get('speed')),
+        # out_time_ms is in microseconds as well, older ffmpeg only write this one
+        'out_time': max(to_number(progress.get('out_time_us') or progress.get('out_time_ms')), 0) / 1e6,
+        'total_size': int(to_number(progress.get('total_size'))),
+        'progress': progress.get('progress', 'continue')
+    }
+
+
+def read_stderr(stderr: IO[str], stderr_tail: collections.deque[str]) -> None:
+    for line in stderr:
+        line = line.rstrip()
+        if line:
+            stderr_tail.append(line)
+            print(line, flush=True)
+
+
+def create_progress_bar(stage: str) -> Callable[[Dict[str, Any]], None]:
+    """ Progress callback showing the frames done, fps and speed of ffmpeg in a tqdm bar, closed on the last event. """
+    progress_bar = tqdm(desc=stage.capitalize(), unit='frame', dynamic_ncols=True)
+
+    def update(event: Dict[str, Any]) -> None:
+        progress_bar.update(event['frame'] - progress_bar.n)
+        progress_bar.set_postfix({'fps': event['fps'], 'speed': f'{event["speed"]}x', 'out_time': round(event['out_time'], 2)})
+        if event['progress'] == 'end':
+            progress_bar.close()
+
+    return update
+
+
+def run_probe(args: List[str]) -> subprocess.CompletedProcess[str]:
+    return subprocess.run(['ffmpeg', '-hide_banner', '-nostdin', *args], capture_output=True, text=True, timeout=30)
+
+
+def list_hwaccels() -> List[str]:
+    lines = run_probe(['-hwaccels']).stdout.splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.strip().endswith(':')]
+
+
+def list_encoders() -> List[str]:
+    # lines look like " V....D libx264              libx264 H.264 / AVC ...", after a legend ending with " ------"
+    lines = run_probe(['-encoders']).stdout.splitlines()
+    start = next((index + 1 for index, line in enumerate(lines) if line.strip().startswith('---')), 0)
+    return [line.split()[1] for line in lines[start:] if len(line.split()) > 1]
+
+
+def test_hwaccel(hwaccel: str) -> bool:
+    """ A listed hwaccel is only compiled in, opening its device tells whether this host has one. """
+    try:
+        return run_probe(['-init_hw_device', hwaccel, '-f', 'lavfi', '-i', 'nullsrc=size=64x64', '-frames:v', '1', '-f', 'null', '-']).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+def test_encoder(encoder: str) -> bool:
+    try:
+        return run_probe(['-f', 'lavfi', '-i', 'color=size=256x256:rate=1', '-frames:v', '1', '-pix_fmt', 'yuv420p',
+                          '-c:v', encoder, '-f', 'null', '-']).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+def test_fps_mode() -> bool:
+    """ -fps_mode replaced -vsync in ffmpeg 5.1, older builds only know -vsync. """
+    try:
+        return run_probe(['-f', 'lavfi', '-i', 'nullsrc=size=64x64', '-frames:v', '1', '-fps_mode', 'passthrough', '-f', 'null', '-']).returncode == 0
+    except (OSError, subprocess.TimeoutExpired):
+        return False
+
+
+def get_capabilities_path() -> str:
+    from modules.autotune import PROFILES_DIRECTORY
+
+    return os.path.join(PROFILES_DIRECTORY, f'ffmpeg-{platform.node() or "default"}.json')
+
+
+def get_ffmpeg_fingerprint() -> str:
+    ffmpeg_path = shutil.which('ffmpeg') or 'ffmpeg'
+    ffmpeg_stat = os.stat(ffmpeg_path) if os.path.isfile(ffmpeg_path) else None
+    return f'{ffmpeg_path}:{ffmpeg_stat.st_size}:{int(ffmpeg_stat.st_mtime)}' if ffmpeg_stat else ffmpeg_path
+
+
+def probe_capabilities() -> Dict[str, Any]:
+    """
+    Hardware accelerations, encoders and options which work on this host, probed once then cached on disk for this ffmpeg binary.
+    """
+    global CAPABILITIES
+
+    with THREAD_LOCK:
+        if CAPABILITIES is not None:
+            return CAPABILITIES
+        fingerprint = get_ffmpeg_fingerprint()
+        capabilities_path = get_capabilities_path()
+        if os.path.isfile(capabilities_path):
+            with open(capabilities_path) as capabilities_file:
+                capabilities = json.load(capabilities_file)
+            # profiles cached before an option was probed are probed again
+            if capabilities.get('ffmpeg') == fingerprint and 'fps_mode' in capabilities:
+                CAPABILITIES = capabilities
+                return CAPABILITIES
+        hwaccels = list_hwaccels()
+        encoders = list_encoders()
+        hardware_encoders = [encoder for encoders_of_codec in HARDWARE_ENCODERS.values() for encoder in encoders_of_codec]
+        CAPABILITIES = {
+            'ffmpeg': fingerprint,
+            'hwaccels': [hwaccel for hwaccel in HWACCELS if hwaccel in hwaccels and test_hwaccel(hwaccel)],
+            'encoders': [encoder for encoder in SOFTWARE_ENCODERS if encoder in encoders]
+                        + [encoder for encoder in hardware_encoders if encoder in encoders and test_encoder(encoder)],
+            'fps_mode': test_fps_mode()
+        }
+        os.makedirs(os.path.dirname(capabilities_path), exist_ok=True)
+        with open(capabilities_path, 'w') as capabilities_file:
+            json.dump(CAPABILITIES, capabilities_file, indent=2)
+        return CAPABILITIES
+
+
+def get_hwaccel() -> Optional[str]:
+    """ Fastest decoding acceleration working on this host, None decodes on cpu. """
+    if not modules.variables.values.hardware_acceleration:
+        return None
+    hwaccels = probe_capabilities()['hwaccels']
+    return hwaccels[0] if hwaccels else None
+
+
+def get_hwaccel_args() -> List[str]:
+    hwaccel = get_hwaccel()
+    return ['-hwaccel', hwaccel] if hwaccel else []
+
+
+def get_passthrough_args() -> List[str]:
+    """ Output every decoded frame once, with its own timestamp, in the option name this ffmpeg understands. """
+    return ['-fps_mode' if probe_capabilities()['fps_mode'] else '-vsync', 'passthrough']
+
+
+def get_video_encoder() -> str:
+    """
+    Working hardware encoder of the selected codec, else the selected software encoder, else the first software one available.
+    """
+    video_encoder = modules.variables.values.video_encoder
+    encoders = probe_capabilities()['encoders']
+    if modules.variables.values.hardware_acceleration:
+        hardware_encoder = next((encoder for encoder in HARDWARE_ENCODERS.get(video_encoder, []) if encoder in encoders), None)
+        if hardware_encoder:
+            return hardware_encoder
+    if video_encoder in encoders:
+        return video_encoder
+    return next((encoder for encoder in SOFTWARE_ENCODERS if encoder in encoders), video_encoder)
+
+
+def get_video_encoder_args() -> List[str]:
+    """
+    Codec, quality, speed preset and threads, in the options of the chosen encoder.
+    """
+    video_encoder = get_video_encoder()
+    video_quality = str(modules.variables.values.video_quality)
+    video_preset = modules.variables.values.video_preset
+    args = ['-c:v', video_encoder]
+    if video_encoder in ('libx264', 'libx265'):
+        args += ['-crf', video_quality, '-preset', video_preset]
+    elif video_encoder == 'libvpx-vp9':
+        args += ['-crf', video_quality, '-b:v', '0', '-deadline', 'realtime' if video_preset in ('ultrafast', 'superfast', 'veryfast') else 'good']
+    elif video_encoder.endswith('_nvenc'):
+        args += ['-cq', video_quality, '-preset', NVENC_PRESETS.get(video_preset, 'p4')]
+    elif video_encoder.endswith('_qsv'):
+        args += ['-global_quality', video_quality, '-preset', video_preset if video_preset in QSV_PRESETS else 'veryfast']
+    elif video_encoder.endswith('_videotoolbox'):
+        args += ['-q:v', str(max(100 - int(video_quality) * 2, 1))]
+    elif video_encoder.endswith('_amf'):
+        args += ['-rc', 'cqp', '-qp_i', video_quality, '-qp_p', video_quality]
+    else:
+        args += ['-q:v', str(max(int(video_quality) // 6, 2))]
+    if modules.variables.values.video_threads:
+        args += ['-threads', str(modules.variables.values.video_threads)]
+    return args
+
+
+def run_ffmpeg(args: List[str], stage: str = 'ffmpeg', progress: Optional[Callable[[Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """
+    Run ffmpeg on an argument list, without a shell, and report its -progress output as events.
+    :param stage: name of the step in the progress bar, the trace and the job report.
+    :param progress: called with every progress event, a tqdm bar by default.
+    :return: the last progress event.
+    :raise FFmpegError: on a non-zero exit code.
+    """
+    commands = ['ffmpeg', '-hide_banner', '-nostdin', '-nostats', '-progress', 'pipe:1',
+                *get_hwaccel_args(), '-loglevel', modules.variables.values.log_level, *args]
+    print(' '.join(commands))
+    progress = progress or create_progress_bar(stage)
+    stderr_tail: collections.deque[str] = collections.deque(maxlen=STDERR_TAIL_SIZE)
+    event: Dict[str, Any] = parse_progress({})
+    with profiler.span('ffmpeg', category='ffmpeg', stage=stage, command=' '.join(commands)):
+        process = subprocess.Popen(commands, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        # stderr is drained aside, a full pipe would block ffmpeg while we wait on the progress
+        stderr_thread = threading.Thread(target=read_stderr, args=(process.stderr, stderr_tail), daemon=True)
+        stderr_thread.start()
+        block: Dict[str, str] = {}
+        for line in process.stdout or []:
+            key, _, value = line.strip().partition('=')
+            if not key:
+                continue
+            block[key] = value.strip()
+            if key == 'progress':
+                event = parse_progress(block)
+                progress(event)
+                block = {}
+        return_code = process.wait()
+        stderr_thread.join()
+    if event['progress'] != 'end':
+        progress({**event, 'progress': 'end'})
+    if return_code != 0:
+        raise FFmpegError(commands, return_code, list(stderr_tail))
+    metrics.annotate('ffmpeg', stage, {key: event[key] for key in ('frame', 'fps', 'speed', 'out_time')})
+    return event
@@ -0,0 +1,88 @@
+import json
+import os
+import threading
+from typing import Dict, Optional
+import numpy
+
+from modules.variables.typing import Frame
+
+FRAME_STORE_FILE = 'frames.raw'
+FRAME_STORE_INDEX = 'frames.json'
+FRAME_STORES: Dict[str, 'FrameStore'] = {}
+THREAD_LOCK = threading.Lock()
+
+
+class FrameStore:
+    """
+    Decoded frames of a video kept in a single raw bgr24 file, one frame every `stride` bytes,
+    and mapped in memory : frames are read and written in place by index, in exact order.
+    """
+
+    def __init__(self, directory_path: str) -> None:
+        with open(os.path.join(directory_path, FRAME_STORE_INDEX)) as index_file:
+            index = json.load(index_file)
+        self.directory_path = directory_path
+        self.width = index['width']
+        self.height = index['height']
+        self.count = index['count']
+        self.frames = numpy.memmap(os.path.join(directory_path, FRAME_STORE_FILE),
+                                   dtype=numpy.uint8,
+                                   mode='r+',
+                                   shape=(self.count, self.height, self.width, 3))
+
+    @property
+    def stride(self) -> int:
+        return self.width * self.height * 3
+
+    @staticmethod
+    def exists(directory_path: str) -> bool:
+        return os.path.isfile(os.path.join(directory_path, FRAME_STORE_INDEX)) \
+            and os.path.isfile(os.path.join(directory_path, FRAME_STORE_FILE))
+
+    @staticmethod
+    def get_file_path(directory_path: str) -> str:
+        return os.path.join(directory_path, FRAME_STORE_FILE)
+
+    @staticmethod
+    def write_index(directory_path: str, width: int, height: int) -> int:
+        """
+        Index a raw file freshly decoded by ffmpeg, dropping a truncated last frame if any.
+        :return: frame count
+        """
+        store_path = FrameStore.get_file_path(directory_path)
+        stride = width * height * 3
+        count = os.path.getsize(store_path) // stride
+        if os.path.getsize(store_path) != count * stride:
+            os.truncate(store_path, count * stride)
+        with open(os.path.join(directory_path, FRAME_STORE_INDEX), 'w') as index_file:
+            json.dump({'width': width, 'height': height, 'count': count}, index_file)
+        return count
+
+    def read(self, frame_index: int) -> Frame:
+        """ Zero-copy view on the frame, writes to it go straight to the store. """
+        return numpy.asarray(self.frames[frame_index])
+
+    def write(self, frame_index: int, frame: Frame) -> None:
+        # frames read from the store and modified in place are already written
+        if not numpy.may_share_memory(frame, self.frames[frame_index]):
+            self.frames[frame_index] = frame
+
+    def flush(self) -> None:
+        self.frames.flush()
+
+
+def get_frame_store(directory_path: str) -> Optional[FrameStore]:
+    with THREAD_LOCK:
+        if directory_path not in FRAME_STORES:
+            if not FrameStore.exists(directory_path):
+                return None
+            FRAME_STORES[directory_path] = FrameStore(directory_path)
+        return FRAME_STORES[directory_path]
+
+
+def release_frame_store(directory_path: str) -> None:
+    with THREAD_LOCK:
+        frame_store = FRAME_STORES.pop(directory_path, None)
+    if frame_store:
+        frame_store.flush()
+        del frame_store
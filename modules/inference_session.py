@@ -0,0 +1,126 @@
+import os
+from typing import Any, Dict
+import onnxruntime
+from insightface.model_zoo.arcface_onnx import ArcFaceONNX
+from insightface.model_zoo.attribute import Attribute
+from insightface.model_zoo.inswapper import INSwapper
+from insightface.model_zoo.landmark import Landmark
+from insightface.model_zoo.model_zoo import PickableInferenceSession
+from insightface.model_zoo.retinaface import RetinaFace
+
+import modules.variables.values
+from modules.model_variants import get_model_precision, get_model_variant
+from modules.utilities import resolve_relative_path
+
+OPTIMIZED_MODELS_DIRECTORY = resolve_relative_path('../models/optimized')
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+}
+EXECUTION_MODES = {
+    'sequential': onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    'parallel': onnxruntime.ExecutionMode.ORT_PARALLEL
+}
+SESSION_OPTION_KEYS = ['graph_optimization_level', 'intra_op_threads', 'inter_op_threads', 'execution_mode']
+SESSION_PROCESSORS = ['face_analyser', 'face_swapper']
+# providers compiling nodes into their own engines, onnxruntime cannot save such a graph
+COMPILING_EXECUTION_PROVIDERS = ['TensorrtExecutionProvider', 'CoreMLExecutionProvider', 'OpenVINOExecutionProvider', 'MIGraphXExecutionProvider']
+
+
+def get_session_config(processor: str) -> Dict[str, Any]:
+    """
+    Global session settings, overridden by the ones given for this processor.
+    """
+    session_config = {
+        'graph_optimization_level': modules.variables.values.graph_optimization_level,
+        'intra_op_threads': modules.variables.values.intra_op_threads,
+        'inter_op_threads': modules.variables.values.inter_op_threads,
+        'execution_mode': modules.variables.values.execution_mode
+    }
+    session_config.update(modules.variables.values.processor_session_options.get(processor, {}))
+    return session_config
+
+
+def suggest_intra_op_threads() -> int:
+    # every execution thread runs its own inference, share the cores between them instead of oversubscribing
+    return max((os.cpu_count() or 1) // max(modules.variables.values.execution_threads or 1, 1), 1)
+
+
+def create_session_options(processor: str) -> onnxruntime.SessionOptions:
+    session_config = get_session_config(processor)
+    session_options = onnxruntime.SessionOptions()
+    session_options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[session_config['graph_optimization_level']]
+    session_options.execution_mode = EXECUTION_MODES[session_config['execution_mode']]
+    session_options.intra_op_num_threads = session_config['intra_op_threads'] or suggest_intra_op_threads()
+    if session_config['inter_op_threads']:
+        session_options.inter_op_num_threads = session_config['inter_op_threads']
+    return session_options
+
+
+def get_optimized_model_path(model_path: str, processor: str) -> str:
+    """
+    Optimized graphs depend on the onnxruntime version, the providers, the optimization level, the precision
+    and the model file itself, its size and modification time telling when it was replaced.
+    """
+    providers = '-'.join(execution_provider.replace('ExecutionProvider', '').lower()
+                         for execution_provider in modules.variables.values.execution_providers) or 'default'
+    graph_optimization_level = get_session_config(processor)['graph_optimization_level']
+    model_name, model_extension = os.path.splitext(os.path.basename(model_path))
+    model_stat = os.stat(model_path)
+    return os.path.join(OPTIMIZED_MODELS_DIRECTORY,
+                        f'{onnxruntime.__version__}-{providers}-{graph_optimization_level}-{get_model_precision()}',
+                        processor,
+                        f'{model_name}-{model_stat.st_size}-{model_stat.st_mtime_ns}{model_extension}')
+
+
+def create_session(model_path: str, processor: str) -> PickableInferenceSession:
+    """
+    Create the session of a model, in the selected precision. The optimized graph is written to disk the first time,
+    then loaded directly with graph optimizations disabled on the next starts.
+    """
+    session_options = create_session_options(processor)
+    providers = modules.variables.values.execution_providers
+    model_path = get_model_variant(model_path)
+    if not modules.variables.values.optimized_model_cache \
+            or session_options.graph_optimization_level == onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL \
+            or any(execution_provider in COMPILING_EXECUTION_PROVIDERS for execution_provider in providers):
+        return PickableInferenceSession(model_path, sess_options=session_options, providers=providers)
+    optimized_model_path = get_optimized_model_path(model_path, processor)
+    if os.path.isfile(optimized_model_path):
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+        return PickableInferenceSession(optimized_model_path, sess_options=session_options, providers=providers)
+    os.makedirs(os.path.dirname(optimized_model_path), exist_ok=True)
+    # written aside then renamed, so an interrupted start never leaves a truncated model in the cache
+    session_options.optimized_model_filepath = optimized_model_path + '.tmp'
+    try:
+        session = PickableInferenceSession(model_path, sess_options=session_options, providers=providers)
+    except Exception as exception:
+        # some providers refuse to save the graph they optimized, load the model without the cache
+        print(f'[REACTOR.INFERENCE-SESSION] Saving the optimized graph of {model_path} failed, not cached: {exception}')
+        return PickableInferenceSession(model_path, sess_options=create_session_options(processor), providers=providers)
+    if os.path.isfile(session_options.optimized_model_filepath):
+        os.replace(session_options.optimized_model_filepath, optimized_model_path)
+    return session
+
+
+def load_model(model_path: str, processor: str) -> Any:
+    """
+    Same routing as insightface.model_zoo.get_model, which does not forward session options.
+    Models keep the original model_file, insightface reads their preprocessing and emap from the original graph.
+    """
+    session = create_session(model_path, processor)
+    inputs = session.get_inputs()
+    input_shape = inputs[0].shape
+    if len(session.get_outputs()) >= 5:
+        return RetinaFace(model_file=model_path, session=session)
+    elif input_shape[2] == 192 and input_shape[3] == 192:
+        return Landmark(model_file=model_path, session=session)
+    elif input_shape[2] == 96 and input_shape[3] == 96:
+        return Attribute(model_file=model_path, session=session)
+    elif len(inputs) == 2 and input_shape[2] == 128 and input_shape[3] == 128:
+        return INSwapper(model_file=model_path, session=session)
+    elif input_shape[2] == input_shape[3] and input_shape[2] >= 112 and input_shape[2] % 16 == 0:
+        return ArcFaceONNX(model_file=model_path, session=session)
+    return None
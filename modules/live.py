@@ -0,0 +1,263 @@
+import collections
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+import cv2
+import numpy
+
+import modules.metrics as metrics
+import modules.variables.values
+from modules.bulk import check_options, process_images
+from modules.face_analyser import get_face_analyser, get_one_face
+from modules.ffmpeg import FFmpegError, read_stderr
+from modules.processors.frame.core import get_frame_processors_modules
+from modules.variables.typing import Frame
+
+STREAM_FORMATS = {'udp': 'mpegts', 'tcp': 'mpegts', 'srt': 'mpegts', 'rtp': 'rtp_mpegts', 'rtmp': 'flv', 'rtmps': 'flv'}
+
+
+class LiveSource:
+    """
+    Frames of a live feed : raw bgr24 frames on stdin ('-'), a capture device (its index or /dev/videoN),
+    or a video file played at its native rate, which stands in for a camera.
+    """
+
+    def __init__(self, source: str, size: Optional[Tuple[int, int]] = None, fps: Optional[float] = None) -> None:
+        self.source = source
+        self.capture = None
+        self.paced = False
+        if source == '-':
+            if size is None:
+                raise ValueError('the size of the frames read from stdin is required')
+            self.width, self.height = size
+            self.fps = fps or 30.0
+        else:
+            self.capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+            if not self.capture.isOpened():
+                raise ValueError(f'cannot open live source {source}')
+            if size:
+                self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, size[0])
+                self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, size[1])
+            self.width = int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+            self.height = int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            self.fps = fps or self.capture.get(cv2.CAP_PROP_FPS) or 30.0
+            # a device delivers frames at its own rate, a file would be read as fast as it decodes
+            self.paced = not source.isdigit() and not source.startswith('/dev/')
+        self.start = time.perf_counter()
+        self.frame_number = 0
+
+    def read(self) -> Optional[Frame]:
+        if self.capture is None:
+            frame_bytes = sys.stdin.buffer.read(self.width * self.height * 3)
+            if len(frame_bytes) < self.width * self.height * 3:
+                return None
+            frame = numpy.frombuffer(frame_bytes, dtype=numpy.uint8).reshape((self.height, self.width, 3)).copy()
+        else:
+            has_frame, frame = self.capture.read()
+            if not has_frame:
+                return None
+        if self.paced:
+            delay = self.start + self.frame_number / self.fps - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        self.frame_number += 1
+        return frame
+
+    def release(self) -> None:
+        if self.capture is not None:
+            self.capture.release()
+
+
+class LiveSink:
+    """
+    Output of the live mode : raw bgr24 frames on stdout ('-'), or encoded by ffmpeg with low latency settings
+    into a file or a stream url (udp://, tcp://, srt://, rtmp://...).
+    """
+
+    def __init__(self, target: str, width: int, height: int, fps: float) -> None:
+        self.target = target
+        self.process: Optional[subprocess.Popen[bytes]] = None
+        self.stderr_tail: collections.deque[str] = collections.deque(maxlen=20)
+        if target == '-':
+            # the real stdout, status messages are sent to stderr in live mode
+            self.stream = sys.__stdout__.buffer
+            return
+        self.commands = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+                         '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-video_size', f'{width}x{height}', '-framerate', f'{fps:g}', '-i', '-',
+                         '-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'zerolatency', '-g', str(max(int(round(fps)), 1)),
+                         '-pix_fmt', 'yuv420p', '-flush_packets', '1']
+        scheme = target.split('://', 1)[0] if '://' in target else ''
+        if scheme in STREAM_FORMATS:
+            self.commands.extend(['-f', STREAM_FORMATS[scheme]])
+        self.commands.append(target)
+        self.process = subprocess.Popen(self.commands, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        threading.Thread(target=read_stderr, args=(self.process.stderr, self.stderr_tail), daemon=True).start()
+        self.stream = self.process.stdin
+
+    def write(self, frame: Frame) -> None:
+        self.stream.write(frame.tobytes())
+
+    def close(self) -> None:
+        if self.process is None:
+            self.stream.flush()
+            return
+        self.stream.close()
+        if self.process.wait() != 0:
+            raise FFmpegError(self.commands, self.process.returncode, list(self.stderr_tail))
+
+
+def get_latency_report(latencies: List[float], counts: Dict[str, int], budget: float) -> Dict[str, Any]:
+    """
+    Latency from capture to output of the frames shown. Every captured frame not shown was dropped : replaced by a newer
+    one while waiting, over the budget when a worker took it (stale) or processed after a newer one.
+    """
+    dropped = counts['captured'] - counts['shown']
+    report: Dict[str, Any] = {'budget_ms': round(budget * 1000, 1), **counts, 'dropped': dropped,
+                              'drop_rate': round(dropped / max(counts['captured'], 1), 4),
+                              'reuse_rate': round(counts['reused'] / max(counts['shown'] + counts['reused'], 1), 4)}
+    if latencies:
+        latencies_ms = numpy.array(latencies) * 1000
+        report.update({'latency_ms': {name: round(float(value), 1) for name, value in
+                                      (('p50', numpy.percentile(latencies_ms, 50)), ('p95', numpy.percentile(latencies_ms, 95)),
+                                       ('p99', numpy.percentile(latencies_ms, 99)), ('max', latencies_ms.max()))},
+                       'within_budget': round(float(numpy.mean(latencies_ms <= budget * 1000)), 4)})
+    return report
+
+
+def live(source: str, target: str, source_path: str, subject_path: str) -> Dict[str, Any]:
+    """
+    Swap the faces of a live feed, frame by frame, under a latency budget. Only the newest captured frame waits
+    for a worker, older ones are dropped, and so are frames older than the budget when a worker takes them.
+    The output runs at the source rate and repeats the last processed frame when no new one is ready.
+    :return: the latency and drop report, also added to the metrics report.
+    """
+    from modules.core import update_status
+    from modules.model_manager import get_load_times, preload_models
+
+    check_options(modules.variables.values.frame_processors or ['face_swapper'])
+    frame_processors = get_frame_processors_modules(modules.variables.values.frame_processors or ['face_swapper'])
+    source_face = get_one_face(cv2.imread(source_path)) if source_path else None
+    if source_face is None and 'face_swapper' in (modules.variables.values.frame_processors or ['face_swapper']):
+        raise Exception("Source face does not contain face...")
+    subject_faces = get_face_analyser().get(cv2.imread(subject_path)) if subject_path else []
+    if not subject_faces:
+        raise Exception("Subject face does not contain face...")
+    subject_embedding = subject_faces[0].embedding
+    # models are loaded before the first frame is captured, so that it does not wait for them
+    preload_models(modules.variables.values.frame_processors or ['face_swapper'])
+    failed_models = [name for name, load_time in get_load_times().items() if load_time < 0]
+    if failed_models:
+        raise Exception(f"Loading {', '.join(failed_models)} failed...")
+
+    budget = modules.variables.values.live_latency_budget / 1000
+    live_source = LiveSource(source, modules.variables.values.live_size, modules.variables.values.live_fps)
+    sink = LiveSink(target, live_source.width, live_source.height, live_source.fps)
+    metrics.reset(mode='live', target_path=source, output_path=target,
+                  frame_processors=list(modules.variables.values.frame_processors or ['face_swapper']),
+                  execution_providers=modules.variables.values.execution_providers)
+    update_status(f'Live from {source} ({live_source.width}x{live_source.height} at {live_source.fps:g} fps) to {target}, '
+                  f'latency budget {budget * 1000:g} ms', 'REACTOR.LIVE')
+
+    condition = threading.Condition()
+    # newest captured frame waiting for a worker, and newest processed frame waiting for the output
+    pending: List[Any] = [None]
+    processed: List[Any] = [None]
+    done = threading.Event()
+    counts = {'captured': 0, 'processed': 0, 'stale': 0, 'shown': 0, 'reused': 0, 'errors': 0}
+    latencies: List[float] = []
+
+    def capture_frames() -> None:
+        while not done.is_set():
+            frame = live_source.read()
+            if frame is None:
+                break
+            with condition:
+                counts['captured'] += 1
+                pending[0] = (counts['captured'], time.perf_counter(), frame)
+                condition.notify_all()
+        with condition:
+            done.set()
+            condition.notify_all()
+
+    def process_frames() -> None:
+        while True:
+            with condition:
+                while pending[0] is None and not done.is_set():
+                    condition.wait()
+                if pending[0] is None:
+                    return
+                frame_number, captured_at, frame = pending[0]
+                pending[0] = None
+            if time.perf_counter() - captured_at > budget:
+                with condition:
+                    counts['stale'] += 1
+                continue
+            try:
+                result = process_images(frame_processors, source_face, subject_embedding, [frame])[0]
+            except Exception as exception:
+                print(f'[REACTOR.LIVE] {exception}')
+                with condition:
+                    counts['errors'] += 1
+                result = None
+            with condition:
+                counts['processed'] += 1
+                # a worker finishing after a more recent frame was processed is too late to show
+                if processed[0] is not None and processed[0][0] > frame_number:
+                    continue
+                processed[0] = (frame_number, captured_at, result if result is not None else frame)
+
+    def emit_frames() -> None:
+        last_frame: Optional[Frame] = None
+        last_number = 0
+        tick = time.perf_counter()
+        while True:
+            tick += 1 / live_source.fps
+            time.sleep(max(tick - time.perf_counter(), 0))
+            with condition:
+                item = processed[0]
+                finished = done.is_set() and pending[0] is None and all(worker.done() for worker in workers)
+            if item is not None and item[0] != last_number:
+                last_number, captured_at, last_frame = item
+                latencies.append(time.perf_counter() - captured_at)
+                counts['shown'] += 1
+            elif finished:
+                return
+            elif last_frame is not None:
+                counts['reused'] += 1
+            else:
+                continue
+            sink.write(last_frame)
+
+    def stop_on_error(future: Future[None]) -> None:
+        if future.exception():
+            with condition:
+                done.set()
+                condition.notify_all()
+
+    worker_total = max(modules.variables.values.execution_threads or 1, 1)
+    with ThreadPoolExecutor(max_workers=worker_total + 2, thread_name_prefix='live') as executor:
+        capturer = executor.submit(capture_frames)
+        workers = [executor.submit(process_frames) for _ in range(worker_total)]
+        emitter = executor.submit(emit_frames)
+        for future in [capturer, *workers, emitter]:
+            future.add_done_callback(stop_on_error)
+        try:
+            for future in [capturer, *workers, emitter]:
+                future.result()
+        finally:
+            live_source.release()
+            sink.close()
+
+    report = get_latency_report(latencies, counts, budget)
+    for name, value in report.items():
+        metrics.annotate('live', name, value)
+    metrics.increment('frames', counts['captured'])
+    metrics.increment('frames_processed', counts['processed'])
+    metrics.increment('errors', counts['errors'])
+    if modules.variables.values.live_report:
+        metrics.write_report(modules.variables.values.live_report)
+    update_status(f'Live ended: {report}', 'REACTOR.LIVE')
+    return report
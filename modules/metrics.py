@@ -0,0 +1,118 @@
+import json
+import os
+import platform
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+import modules.profiler as profiler
+import modules.variables.metadata
+
+THREAD_LOCK = threading.Lock()
+COUNTERS: Dict[str, int] = {}
+TIMERS: Dict[str, Dict[str, float]] = {}
+JOB: Dict[str, Any] = {}
+ANNOTATIONS: Dict[str, Dict[str, Any]] = {}
+# stages are timed where they happen, counters are totals of the job : frames of the media, frames_processed over all processors
+STAGES = ['predict', 'extract', 'read', 'detect', 'analyse', 'swap', 'enhance', 'write', 'encode', 'segment']
+COUNTER_NAMES = ['frames', 'frames_processed', 'faces_detected', 'faces_indexed', 'faces_swapped', 'faces_enhanced', 'frames_reused', 'errors']
+
+
+def reset(**job: Any) -> None:
+    """ Start the metrics of a new job, job values are copied to the report. """
+    with THREAD_LOCK:
+        COUNTERS.clear()
+        COUNTERS.update({name: 0 for name in COUNTER_NAMES})
+        TIMERS.clear()
+        ANNOTATIONS.clear()
+        JOB.clear()
+        JOB.update(job)
+        JOB['start'] = time.time()
+
+
+def increment(name: str, value: int = 1) -> None:
+    with THREAD_LOCK:
+        COUNTERS[name] = COUNTERS.get(name, 0) + value
+
+
+def get_counter(name: str) -> int:
+    with THREAD_LOCK:
+        return COUNTERS.get(name, 0)
+
+
+def record(stage: str, seconds: float) -> None:
+    with THREAD_LOCK:
+        stage_timer = TIMERS.setdefault(stage, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+        stage_timer['count'] += 1
+        stage_timer['seconds'] += seconds
+        stage_timer['max_seconds'] = max(stage_timer['max_seconds'], seconds)
+
+
+def annotate(section: str, name: str, value: Any) -> None:
+    """ Extra value reported as report[section][name], like the throughput ffmpeg gives for its stages. """
+    with THREAD_LOCK:
+        ANNOTATIONS.setdefault(section, {})[name] = value
+
+
+@contextmanager
+def timer(stage: str, **args: Any) -> Iterator[None]:
+    """ Time a stage, also recorded as a span of the trace when profiling. """
+    start = time.perf_counter()
+    try:
+        with profiler.span(stage, **args):
+            yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def get_report(**extra: Any) -> Dict[str, Any]:
+    with THREAD_LOCK:
+        elapsed = time.time() - JOB.get('start', time.time())
+        frames = COUNTERS.get('frames', 0)
+        return {
+            'application': f'{modules.variables.metadata.name} {modules.variables.metadata.version}',
+            'host': platform.node(),
+            **JOB,
+            'elapsed_seconds': round(elapsed, 3),
+            'frames_per_second': round(frames / elapsed, 3) if elapsed and frames else 0.0,
+            'counters': dict(COUNTERS),
+            'stages': {stage: {'count': int(stage_timer['count']),
+                               'seconds': round(stage_timer['seconds'], 3),
+                               'mean_seconds': round(stage_timer['seconds'] / stage_timer['count'], 5),
+                               'max_seconds': round(stage_timer['max_seconds'], 5)}
+                       for stage, stage_timer in TIMERS.items()},
+            **{section: dict(values) for section, values in ANNOTATIONS.items()},
+            **extra
+        }
+
+
+def write_report(report_path: str, report: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    report = report or get_report()
+    with open(report_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    return report
+
+
+def write_prometheus_textfile(textfile_path: str, report: Optional[Dict[str, Any]] = None) -> None:
+    """
+    Write the job metrics for the node_exporter textfile collector, replaced atomically so it is never read half written.
+    """
+    report = report or get_report()
+    labels = f'host="{report["host"]}"'
+    lines = ['# HELP reactor_job_frames_per_second Frames per second of the last job.',
+             '# TYPE reactor_job_frames_per_second gauge',
+             f'reactor_job_frames_per_second{{{labels}}} {report["frames_per_second"]}',
+             '# HELP reactor_job_elapsed_seconds Duration of the last job.',
+             '# TYPE reactor_job_elapsed_seconds gauge',
+             f'reactor_job_elapsed_seconds{{{labels}}} {report["elapsed_seconds"]}',
+             '# HELP reactor_job_count Counters of the last job.',
+             '# TYPE reactor_job_count gauge']
+    lines += [f'reactor_job_count{{{labels},name="{name}"}} {value}' for name, value in report['counters'].items()]
+    lines += ['# HELP reactor_job_stage_seconds Time spent in each stage of the last job, summed over threads.',
+              '# TYPE reactor_job_stage_seconds gauge']
+    lines += [f'reactor_job_stage_seconds{{{labels},stage="{stage}"}} {stage_timer["seconds"]}' for stage, stage_timer in report['stages'].items()]
+    temp_textfile_path = textfile_path + '.tmp'
+    with open(temp_textfile_path, 'w') as textfile:
+        textfile.write('\n'.join(lines) + '\n')
+    os.replace(temp_textfile_path, textfile_path)
@@ -0,0 +1,56 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+import modules.variables.values
+import modules.face_analyser
+from modules.processors.frame.core import load_frame_processor_module
+
+EXECUTOR = ThreadPoolExecutor(thread_name_prefix='model-manager')
+PRELOADS: Dict[str, Future[float]] = {}
+THREAD_LOCK = threading.Lock()
+
+
+def get_enabled_frame_processors() -> List[str]:
+    return list(dict.fromkeys(modules.variables.values.frame_processors
+                              + [frame_processor for frame_processor, state in modules.variables.values.fp_ui.items() if state]))
+
+
+def load_model(name: str, warm_up: Callable[[], None]) -> float:
+    start = time.perf_counter()
+    try:
+        warm_up()
+    except Exception as exception:
+        print(f'[REACTOR.MODEL-MANAGER] {name} failed to load: {exception}')
+        raise
+    load_time = time.perf_counter() - start
+    print(f'[REACTOR.MODEL-MANAGER] {name} loaded and warmed up in {load_time:.2f}s')
+    return load_time
+
+
+def warm_up_frame_processor(frame_processor: str) -> None:
+    frame_processor_module = load_frame_processor_module(frame_processor)
+    frame_processor_module.pre_check()
+    if hasattr(frame_processor_module, 'warm_up'):
+        frame_processor_module.warm_up()
+
+
+def preload_models(frame_processors: List[str]) -> None:
+    """
+    Load and warm up, concurrently and in the background, the face analyser and the models of the given frame processors.
+    Each model is loaded once, the getters of the models are locked so a worker asking for a model still loading waits for it.
+    """
+    with THREAD_LOCK:
+        if 'face_analyser' not in PRELOADS:
+            PRELOADS['face_analyser'] = EXECUTOR.submit(load_model, 'face_analyser', modules.face_analyser.warm_up)
+        for frame_processor in frame_processors:
+            if frame_processor not in PRELOADS:
+                PRELOADS[frame_processor] = EXECUTOR.submit(load_model, frame_processor, lambda frame_processor=frame_processor: warm_up_frame_processor(frame_processor))
+
+
+def get_load_times() -> Dict[str, float]:
+    """ Load time of every model, waiting for the ones still loading. A model which failed to load is reported as -1. """
+    with THREAD_LOCK:
+        preloads = dict(PRELOADS)
+    return {name: preload.result() if not preload.exception() else -1.0 for name, preload in preloads.items()}
@@ -0,0 +1,129 @@
+import importlib.util
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List
+import cv2
+import numpy
+import onnx
+from onnxruntime.quantization import QuantType, quantize_dynamic
+
+import modules.variables.values
+from modules.utilities import resolve_relative_path
+from modules.variables.typing import Frame
+
+VARIANTS_DIRECTORY = resolve_relative_path('../models/variants')
+# the swapper and the recognition model of buffalo_l, the detector loses too much recall once quantized
+PRECISION_MODELS = ['inswapper_128.onnx', 'w600k_r50.onnx']
+GPU_EXECUTION_PROVIDERS = ['CUDAExecutionProvider', 'TensorrtExecutionProvider', 'DmlExecutionProvider', 'ROCMExecutionProvider', 'CoreMLExecutionProvider']
+THREAD_LOCK = threading.Lock()
+
+
+def get_model_precision() -> str:
+    """
+    Precision the models actually run in. fp16 only speeds up gpu providers, cpu nodes keep fp32,
+    and converting to fp16 needs onnxconverter-common.
+    """
+    if modules.variables.values.model_precision == 'fp16':
+        if not any(execution_provider in GPU_EXECUTION_PROVIDERS for execution_provider in modules.variables.values.execution_providers):
+            return 'fp32'
+        if importlib.util.find_spec('onnxconverter_common') is None:
+            return 'fp32'
+    return modules.variables.values.model_precision
+
+
+def create_model_variant(model_path: str, variant_path: str, model_precision: str) -> None:
+    os.makedirs(os.path.dirname(variant_path), exist_ok=True)
+    temp_variant_path = variant_path + '.tmp'
+    if model_precision == 'int8':
+        quantize_dynamic(model_path, temp_variant_path, weight_type=QuantType.QInt8)
+    elif model_precision == 'fp16':
+        from onnxconverter_common import float16
+
+        onnx.save(float16.convert_float_to_float16(onnx.load(model_path), keep_io_types=True), temp_variant_path)
+    os.replace(temp_variant_path, variant_path)
+
+
+def get_model_variant(model_path: str) -> str:
+    """
+    Path of the model in the selected precision, produced from the downloaded model and cached the first time.
+    """
+    model_precision = get_model_precision()
+    if model_precision == 'fp32' or os.path.basename(model_path) not in PRECISION_MODELS:
+        return model_path
+    variant_path = os.path.join(VARIANTS_DIRECTORY, model_precision, os.path.basename(model_path))
+    with THREAD_LOCK:
+        if not os.path.isfile(variant_path):
+            try:
+                create_model_variant(model_path, variant_path, model_precision)
+            except ImportError:
+                print(f'[REACTOR.MODEL-VARIANTS] onnxconverter-common is required for {model_precision}, keeping fp32.')
+                return model_path
+    return variant_path
+
+
+def read_reference_frames(clip_path: str, frame_total: int) -> List[Frame]:
+    capture = cv2.VideoCapture(clip_path)
+    frames = []
+    while len(frames) < frame_total:
+        has_frame, frame = capture.read()
+        if not has_frame:
+            break
+        frames.append(frame)
+    capture.release()
+    return frames
+
+
+def compare_precisions(clip_path: str, frame_total: int = 48) -> Dict[str, Any]:
+    """
+    Swap every face of the first frames of a reference clip in each precision, and report the speed
+    against the difference with the fp32 output.
+    """
+    import modules.face_analyser
+    import modules.processors.frame.face_swapper as face_swapper
+    from modules.core import update_status
+
+    face_swapper.pre_check()
+    frames = read_reference_frames(clip_path, frame_total)
+    if not frames:
+        raise ValueError(f'No frame could be read from {clip_path}')
+    model_precision = modules.variables.values.model_precision
+    model_precisions = ['fp32', 'int8']
+    if any(execution_provider in GPU_EXECUTION_PROVIDERS for execution_provider in modules.variables.values.execution_providers):
+        model_precisions.append('fp16')
+    reference_outputs: List[Frame] = []
+    report: Dict[str, Any] = {'clip': clip_path, 'frames': len(frames), 'precisions': {}}
+    for precision in model_precisions:
+        modules.variables.values.model_precision = precision
+        modules.face_analyser.FACE_ANALYSER = None
+        face_swapper.FACE_SWAPPER = None
+        source_face = next((face for frame in frames for face in [modules.face_analyser.get_one_face(frame)] if face), None)
+        if source_face is None:
+            raise ValueError(f'No face found in {clip_path}')
+        face_swapper.swap_faces(source_face, [source_face], frames[0].copy())
+        start = time.perf_counter()
+        outputs = [face_swapper.swap_faces(source_face, modules.face_analyser.get_many_faces(frame) or [], frame.copy()) for frame in frames]
+        frames_per_second = len(frames) / (time.perf_counter() - start)
+        if precision == 'fp32':
+            reference_outputs = outputs
+        differences = numpy.array([numpy.abs(output.astype(numpy.int16) - reference_output).mean()
+                                   for output, reference_output in zip(outputs, reference_outputs)])
+        mean_squared_error = numpy.mean([numpy.mean((output.astype(numpy.float32) - reference_output) ** 2)
+                                         for output, reference_output in zip(outputs, reference_outputs)])
+        report['precisions'][precision] = {
+            'frames_per_second': round(frames_per_second, 2),
+            'speedup': round(frames_per_second / report['precisions']['fp32']['frames_per_second'], 2) if precision != 'fp32' else 1.0,
+            'mean_absolute_difference': round(float(differences.mean()), 3),
+            'max_frame_difference': round(float(differences.max()), 3),
+            'psnr': round(float(10 * numpy.log10(255 ** 2 / mean_squared_error)), 2) if mean_squared_error else None
+        }
+        update_status(f'{precision}: {report["precisions"][precision]}', 'REACTOR.MODEL-VARIANTS')
+    modules.variables.values.model_precision = model_precision
+    modules.face_analyser.FACE_ANALYSER = None
+    face_swapper.FACE_SWAPPER = None
+    report_path = os.path.splitext(clip_path)[0] + '.precision.json'
+    with open(report_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    update_status(f'Precision report saved to {report_path}', 'REACTOR.MODEL-VARIANTS')
+    return report
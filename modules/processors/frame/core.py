@@ -1,17 +1,27 @@
 import importlib
-from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
 from types import ModuleType
-from typing import Any, List, Callable
+from typing import Any, List, Callable, Optional, Iterator
 from tqdm import tqdm
 
 import modules
+import modules.face_index as face_index
+import modules.metrics as metrics
+import modules.profiler as profiler
+import modules.segmenter as segmenter
 import modules.variables.values
+from modules.processors.frame.frame_cache import FrameCache
+from modules.utilities import get_temp_frame_number, read_temp_frame, write_temp_frame
+from modules.variables.typing import Frame
 
 FRAME_PROCESSORS_MODULES: List[ModuleType] = []
 FRAME_PROCESSORS_INTERFACE = [
     'pre_check',
     'pre_start',
     'process_frame',
+    'process_batch',
     'process_image',
     'process_video'
 ]
@@ -63,21 +73,156 @@ def multi_process_frame(source_path: str,
                         process_frames: Callable[[str, List[str], str, Any], None],
                         subject_path: str,
                         progress: Any = None) -> None:
-    with ThreadPoolExecutor(max_workers=modules.variables.values.execution_threads) as executor:
-        futures = []
-        for path in temp_frame_paths:
-            future = executor.submit(process_frames, source_path, [path], subject_path, progress)
-            futures.append(future)
-        for future in futures:
+    # process_frames prepares the source and subject faces once, then hands the frames to process_frame_paths
+    process_frames(source_path, temp_frame_paths, subject_path, progress)
+
+
+def put_until_aborted(target_queue: queue.Queue[Any], item: Any, abort: threading.Event) -> None:
+    while not abort.is_set():
+        try:
+            target_queue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def get_until_aborted(source_queue: queue.Queue[Any], abort: threading.Event) -> Any:
+    while not abort.is_set():
+        try:
+            return source_queue.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return None
+
+
+def run_pipeline(items: List[Any],
+                 read_item: Callable[[Any], Any],
+                 compute_items: Callable[[List[Any]], List[Any]],
+                 write_item: Callable[[Any], None],
+                 batch_size: int = 1) -> None:
+    """
+    Read-ahead and write-behind I/O threads around the compute workers. Reader threads call read_item on the items
+    in order into a bounded queue, execution_threads workers call compute_items on what was read, by batches of up to
+    batch_size without waiting for a batch to fill, and writer threads call write_item on every result in the background.
+    :param compute_items: returns one result per value read.
+    """
+    io_threads = max(modules.variables.values.io_threads, 1)
+    execution_threads = max(modules.variables.values.execution_threads or 1, 1)
+    batch_size = max(batch_size, 1)
+    read_queue: queue.Queue[Any] = queue.Queue(maxsize=max(modules.variables.values.io_queue_size, batch_size))
+    write_queue: queue.Queue[Any] = queue.Queue(maxsize=max(modules.variables.values.io_queue_size, batch_size))
+    item_iterator: Iterator[Any] = iter(items)
+    items_lock = threading.Lock()
+    abort = threading.Event()
+    # items are wrapped, a None item is not taken for the stop marker of a stage
+    end = object()
+
+    def read_items() -> None:
+        while not abort.is_set():
+            with items_lock:
+                item = next(item_iterator, end)
+            if item is end:
+                return
+            put_until_aborted(read_queue, (read_item(item),), abort)
+
+    def compute() -> None:
+        with profiler.profile_thread():
+            while True:
+                entry = get_until_aborted(read_queue, abort)
+                if entry is None:
+                    return
+                batch = [entry[0]]
+                while len(batch) < batch_size:
+                    try:
+                        entry = read_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if entry is None:
+                        # stop marker of this worker, handled once the batch is done
+                        read_queue.put(None)
+                        break
+                    batch.append(entry[0])
+                for result in compute_items(batch):
+                    put_until_aborted(write_queue, (result,), abort)
+
+    def write_items() -> None:
+        while True:
+            entry = get_until_aborted(write_queue, abort)
+            if entry is None:
+                return
+            write_item(entry[0])
+
+    def stop_on_error(future: Future[None]) -> None:
+        if future.exception():
+            abort.set()
+
+    with ThreadPoolExecutor(max_workers=2 * io_threads + execution_threads) as executor:
+        readers = [executor.submit(read_items) for _ in range(io_threads)]
+        workers = [executor.submit(compute) for _ in range(execution_threads)]
+        writers = [executor.submit(write_items) for _ in range(io_threads)]
+        for future in readers + workers + writers:
+            future.add_done_callback(stop_on_error)
+        # each stage is stopped by one None per thread once the previous stage is done
+        for stage, next_queue, next_stage in ((readers, read_queue, workers), (workers, write_queue, writers)):
+            for future in stage:
+                future.exception()
+            for _ in next_stage:
+                put_until_aborted(next_queue, None, abort)
+        for future in readers + workers + writers:
             future.result()
 
 
+def process_frame_paths(temp_frame_paths: List[str],
+                        process_frame: Callable[[Frame], Optional[Frame]],
+                        progress: Any = None,
+                        frame_cache: Optional[FrameCache] = None) -> None:
+    """
+    Run process_frame on every frame in the run_pipeline threads : frames are decoded ahead of the workers,
+    and the results encoded behind them.
+    :param process_frame: returns the processed frame, or None to leave the frame untouched.
+    """
+    if face_index.is_recording():
+        # every frame has to be analysed once for the index to be complete
+        frame_cache = None
+
+    def read_frame(temp_frame_path: str) -> tuple[str, Frame]:
+        with metrics.timer('read', frame=temp_frame_path):
+            return temp_frame_path, read_temp_frame(temp_frame_path)
+
+    def compute_frames(batch: List[tuple[str, Frame]]) -> List[tuple[str, Optional[Frame]]]:
+        temp_frame_path, temp_frame = batch[0]
+        signature, result = frame_cache.lookup(temp_frame) if frame_cache else (None, None)
+        if result is None:
+            with profiler.span('process_frame', frame=temp_frame_path), face_index.current_frame(get_temp_frame_number(temp_frame_path) - 1):
+                result = process_frame(temp_frame)
+            if frame_cache and result is not None:
+                frame_cache.put(signature, result)
+        else:
+            metrics.increment('frames_reused')
+        return [(temp_frame_path, result)]
+
+    def write_frame(item: tuple[str, Optional[Frame]]) -> None:
+        temp_frame_path, result = item
+        if result is not None:
+            with metrics.timer('write', frame=temp_frame_path):
+                write_temp_frame(temp_frame_path, result)
+        segmenter.complete_frames([temp_frame_path])
+        metrics.increment('frames_processed')
+        if progress:
+            progress.update(1)
+
+    run_pipeline(temp_frame_paths, read_frame, compute_frames, write_frame)
+
+
 def process_video(source_path: str,
                   temp_frame_paths: list[str],
                   process_frames: Callable[[str, List[str], str, Any], None],
-                  subject_path: str) -> None:
+                  subject_path: str,
+                  frame_cache: Optional[FrameCache] = None) -> None:
     progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
     total = len(temp_frame_paths)
+    if frame_cache:
+        frame_cache.reset()
     with tqdm(total=total,
               desc='Processing',
               unit='frame',
@@ -85,12 +230,17 @@ def process_video(source_path: str,
               bar_format=progress_bar_format) as progress:
         progress.set_postfix({'execution_providers': modules.variables.values.execution_providers,
                               'execution_threads': modules.variables.values.execution_threads,
+                              'io_threads': modules.variables.values.io_threads,
                               'max_memory': modules.variables.values.max_memory})
         multi_process_frame(source_path,
                             temp_frame_paths,
                             process_frames,
                             subject_path,
                             progress)
+    if frame_cache:
+        if frame_cache.enabled:
+            print(f'[REACTOR.FRAME-CACHE] {frame_cache.report()}')
+        frame_cache.reset()
 
 
 def debug_video(source_path: str,
@@ -106,6 +256,7 @@ def debug_video(source_path: str,
               bar_format=progress_bar_format) as progress:
         progress.set_postfix({'execution_providers': modules.variables.values.execution_providers,
                               'execution_threads': modules.variables.values.execution_threads,
+                              'io_threads': modules.variables.values.io_threads,
                               'max_memory': modules.variables.values.max_memory})
         multi_process_frame(source_path,
                             temp_frame_paths,
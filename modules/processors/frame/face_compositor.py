@@ -0,0 +1,67 @@
+from typing import Any, List, Optional
+import cv2
+import numpy
+
+from modules.variables.typing import Frame
+
+ROI_PADDING = 2
+
+
+def get_roi(inverse_matrix: numpy.ndarray[Any, Any], face_size: tuple[int, int], frame_shape: tuple[int, ...]) -> Optional[tuple[int, int, int, int]]:
+    """
+    Bounding box (left, top, right, bottom) in the frame of a face crop warped back with inverse_matrix,
+    padded and clipped to the frame.
+    """
+    face_height, face_width = face_size
+    corners = numpy.array([[0, 0], [face_width, 0], [0, face_height], [face_width, face_height]], dtype=numpy.float32)
+    corners = corners @ inverse_matrix[:, :2].T + inverse_matrix[:, 2]
+    height, width = frame_shape[:2]
+    left, top = numpy.maximum(numpy.floor(corners.min(axis=0)).astype(int) - ROI_PADDING, 0)
+    right, bottom = numpy.minimum(numpy.ceil(corners.max(axis=0)).astype(int) + ROI_PADDING, (width, height))
+    if right <= left or bottom <= top:
+        return None
+    return int(left), int(top), int(right), int(bottom)
+
+
+def soften_mask(mask: numpy.ndarray[Any, Any]) -> numpy.ndarray[Any, Any]:
+    """
+    Same erosion and blur as INSwapper's paste back, sized on the warped face.
+    """
+    mask[mask > 20 / 255] = 1
+    mask_h_inds, mask_w_inds = numpy.where(mask == 1)
+    if not len(mask_h_inds):
+        return mask
+    mask_size = int(numpy.sqrt((mask_h_inds.max() - mask_h_inds.min()) * (mask_w_inds.max() - mask_w_inds.min())))
+    k = max(mask_size // 10, 10)
+    mask = cv2.erode(mask, numpy.ones((k, k), numpy.uint8), iterations=1)
+    k = max(mask_size // 20, 5)
+    return cv2.GaussianBlur(mask, (2 * k + 1, 2 * k + 1), 0)
+
+
+def paste_faces(temp_frame: Frame,
+                faces: List[tuple[Frame, numpy.ndarray[Any, Any]]],
+                face_mask: Optional[numpy.ndarray[Any, Any]] = None) -> Frame:
+    """
+    Paste every (face crop, alignment matrix) of a frame back in one pass.
+    Each face and its mask are warped together in a single warp, and only inside the face bounding box,
+    instead of warping and blending over the full frame for every face.
+    :param face_mask: blending mask in crop space (0-1). If None, the INSwapper mask is rebuilt from the crop square.
+    """
+    for face_frame, matrix in faces:
+        inverse_matrix = cv2.invertAffineTransform(matrix)
+        roi = get_roi(inverse_matrix, face_frame.shape[:2], temp_frame.shape)
+        if roi is None:
+            continue
+        left, top, right, bottom = roi
+        inverse_matrix[:, 2] -= (left, top)
+        mask = face_mask if face_mask is not None else numpy.ones(face_frame.shape[:2], dtype=numpy.float32)
+        face_and_mask = numpy.dstack((face_frame.astype(numpy.float32), mask))
+        face_and_mask = cv2.warpAffine(face_and_mask, inverse_matrix, (right - left, bottom - top), borderValue=0)
+        warped_mask = face_and_mask[:, :, 3]
+        if face_mask is None:
+            warped_mask = soften_mask(warped_mask)
+        warped_mask = warped_mask[:, :, numpy.newaxis]
+        roi_frame = temp_frame[top:bottom, left:right].astype(numpy.float32)
+        merged = warped_mask * face_and_mask[:, :, :3] + (1 - warped_mask) * roi_frame
+        temp_frame[top:bottom, left:right] = merged.clip(0, 255).astype(numpy.uint8)
+    return temp_frame
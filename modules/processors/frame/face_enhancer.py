@@ -1,19 +1,38 @@
-from typing import Any, List
+import contextlib
+import os
+import time
+from typing import Any, Dict, List, Optional
 import cv2
+import numpy
 import threading
+import torch
 import gfpgan
+from basicsr.utils import img2tensor, tensor2img
+from torchvision.transforms.functional import normalize
 
+import modules.metrics as metrics
 import modules.variables.values
 import modules.processors.frame.core
-from modules.face_analyser import get_one_face, get_face_analyser, extract_best_one_face, extract_all_faces
-from modules.variables.typing import Frame
+from modules.processors.frame.frame_cache import FrameCache
+from modules.processors.frame.face_compositor import paste_faces
+from modules.face_analyser import get_one_face, get_many_faces, get_best_one_face, get_face_analyser, extract_best_one_face, extract_all_faces
+from modules.variables.typing import Face, Frame
 from modules.utilities import conditional_download, resolve_relative_path, is_image, is_video
 
 FACE_ENHANCER = None
+FRAME_CACHE = FrameCache()
 THREAD_SEMAPHORE = threading.Semaphore()
 THREAD_LOCK = threading.Lock()
 SHORTNAME = "FACE-ENHANCER"
 NAME = f'REACTOR.{SHORTNAME}'
+# 5 points (eyes, nose, mouth corners) of the FFHQ 512x512 face GFPGAN was trained on, as in facexlib
+FFHQ_TEMPLATE = numpy.array([[192.98138, 239.94708],
+                             [318.90277, 240.1936],
+                             [256.63416, 314.01935],
+                             [201.26117, 371.41043],
+                             [313.08905, 371.15118]], dtype=numpy.float32)
+ALIGNED_SIZE = 512
+PASTE_MASK = None
 
 
 def pre_check() -> bool:
@@ -37,14 +56,139 @@ def get_face_enhancer() -> Any:
             model_path = resolve_relative_path('../models/GFPGANv1.4.pth')
             # todo: set models path https://github.com/TencentARC/GFPGAN/issues/399
             FACE_ENHANCER = gfpgan.GFPGANer(model_path=model_path, upscale=1)  # type: ignore[attr-defined]
+            if FACE_ENHANCER.device.type == 'cpu' and modules.variables.values.enhancer_cpu_mode:
+                prepare_cpu_inference(FACE_ENHANCER)
     return FACE_ENHANCER
 
 
+def warm_up() -> None:
+    restore_face(numpy.zeros((ALIGNED_SIZE, ALIGNED_SIZE, 3), dtype=numpy.uint8))
+
+
+def suggest_torch_threads() -> int:
+    # enhancements are serialized by THREAD_SEMAPHORE, leave the other half of the cores to the onnxruntime detection of the other workers
+    return max((os.cpu_count() or 1) // 2, 1)
+
+
+def prepare_cpu_inference(face_enhancer: Any) -> None:
+    """
+    Explicit torch thread budget, channels-last layout and, for int8, dynamic quantization of the linear layers.
+    """
+    torch.set_num_threads(modules.variables.values.torch_threads or suggest_torch_threads())
+    face_enhancer.gfpgan = face_enhancer.gfpgan.eval().to(memory_format=torch.channels_last)
+    if modules.variables.values.enhancer_precision == 'int8':
+        face_enhancer.gfpgan = torch.ao.quantization.quantize_dynamic(face_enhancer.gfpgan, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def get_inference_context() -> contextlib.ExitStack:
+    context = contextlib.ExitStack()
+    if get_face_enhancer().device.type == 'cpu' and modules.variables.values.enhancer_cpu_mode:
+        context.enter_context(torch.inference_mode())
+        if modules.variables.values.enhancer_precision == 'bf16':
+            context.enter_context(torch.autocast('cpu', dtype=torch.bfloat16))
+    else:
+        context.enter_context(torch.no_grad())
+    return context
+
+
+def get_paste_mask() -> numpy.ndarray[Any, Any]:
+    global PASTE_MASK
+
+    if PASTE_MASK is None:
+        mask = numpy.zeros((ALIGNED_SIZE, ALIGNED_SIZE), dtype=numpy.float32)
+        border = ALIGNED_SIZE // 16
+        mask[border:-border, border:-border] = 1
+        PASTE_MASK = cv2.GaussianBlur(mask, (0, 0), border / 2)
+    return PASTE_MASK
+
+
+def align_face(temp_frame: Frame, face: Face) -> tuple[Optional[Frame], Optional[numpy.ndarray[Any, Any]]]:
+    matrix, _ = cv2.estimateAffinePartial2D(face.kps.astype(numpy.float32), FFHQ_TEMPLATE, method=cv2.LMEDS)
+    if matrix is None:
+        return None, None
+    aligned_face = cv2.warpAffine(temp_frame, matrix, (ALIGNED_SIZE, ALIGNED_SIZE),
+                                  borderMode=cv2.BORDER_CONSTANT, borderValue=(135, 133, 132))
+    return aligned_face, matrix
+
+
+def restore_face(aligned_face: Frame) -> Frame:
+    """
+    Run only the GFPGAN restoration network on an aligned 512x512 face, skipping GFPGANer's own detection.
+    """
+    face_enhancer = get_face_enhancer()
+    face_tensor = img2tensor(aligned_face / 255., bgr2rgb=True, float32=True)
+    normalize(face_tensor, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
+    face_tensor = face_tensor.unsqueeze(0).to(face_enhancer.device)
+    if face_enhancer.device.type == 'cpu' and modules.variables.values.enhancer_cpu_mode:
+        face_tensor = face_tensor.contiguous(memory_format=torch.channels_last)
+    with THREAD_SEMAPHORE, get_inference_context(), metrics.timer('enhance'):
+        output = face_enhancer.gfpgan(face_tensor, return_rgb=False, weight=0.5)[0]
+    metrics.increment('faces_enhanced')
+    return tensor2img(output.squeeze(0).float(), rgb2bgr=True, min_max=(-1, 1)).astype(numpy.uint8)
+
+
+def compare_cpu_modes(image_path: Optional[str] = None, repeat: int = 5) -> Dict[str, Any]:
+    """
+    Time the restoration of an aligned face in each cpu mode, against the default fp32 eager mode.
+    The face is the first one of image_path, or a synthetic one.
+    """
+    global FACE_ENHANCER
+
+    pre_check()
+    aligned_face = None
+    if image_path:
+        image = cv2.imread(image_path)
+        face = get_one_face(image)
+        if face:
+            aligned_face, _ = align_face(image, face)
+    if aligned_face is None:
+        aligned_face = numpy.random.default_rng(0).integers(0, 256, (ALIGNED_SIZE, ALIGNED_SIZE, 3), dtype=numpy.uint8)
+    cpu_mode, precision = modules.variables.values.enhancer_cpu_mode, modules.variables.values.enhancer_precision
+    report: Dict[str, Any] = {}
+    reference_face = None
+    for mode_name, mode_cpu, mode_precision in (('eager', False, 'fp32'), ('fp32', True, 'fp32'), ('bf16', True, 'bf16'), ('int8', True, 'int8')):
+        modules.variables.values.enhancer_cpu_mode, modules.variables.values.enhancer_precision = mode_cpu, mode_precision
+        FACE_ENHANCER = None
+        restored_face = restore_face(aligned_face)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            restore_face(aligned_face)
+        seconds = (time.perf_counter() - start) / repeat
+        if reference_face is None:
+            reference_face = restored_face
+        report[mode_name] = {'seconds_per_face': round(seconds, 4),
+                             'speedup': round(report['eager']['seconds_per_face'] / seconds, 2) if report else 1.0,
+                             'mean_absolute_difference': round(float(numpy.abs(restored_face.astype(numpy.int16) - reference_face).mean()), 3)}
+        print(f'[{NAME}] {mode_name}: {report[mode_name]}')
+    modules.variables.values.enhancer_cpu_mode, modules.variables.values.enhancer_precision = cpu_mode, precision
+    FACE_ENHANCER = None
+    return report
+
+
+def enhance_aligned_faces(temp_frame: Frame, faces: List[Face]) -> Frame:
+    restored_faces = []
+    for face in faces:
+        aligned_face, matrix = align_face(temp_frame, face)
+        if aligned_face is None:
+            continue
+        try:
+            restored_faces.append((restore_face(aligned_face), matrix))
+        except Exception as e:
+            metrics.increment('errors')
+    return paste_faces(temp_frame, restored_faces, get_paste_mask())
+
+
 def enhance_face(temp_frame: Frame, ref_embedding: Frame) -> Frame:
-    if modules.variables.values.enhancer_option == modules.variables.values.enhancer_faces_only:
+    if modules.variables.values.enhancer_aligned and modules.variables.values.enhancer_option == modules.variables.values.enhancer_faces_only:
+        temp_frame = enhance_aligned_faces(temp_frame, get_many_faces(temp_frame) or [])
+    elif modules.variables.values.enhancer_aligned and modules.variables.values.enhancer_option == modules.variables.values.enhancer_best_face_only:
+        best_one_face = get_best_one_face(temp_frame, ref_embedding)
+        if best_one_face:
+            temp_frame = enhance_aligned_faces(temp_frame, [best_one_face])
+    elif modules.variables.values.enhancer_option == modules.variables.values.enhancer_faces_only:
         for (top, left, bottom, right), face in extract_all_faces(temp_frame):
             try:
-                with THREAD_SEMAPHORE:
+                with THREAD_SEMAPHORE, get_inference_context(), metrics.timer('enhance'):
                     _, _, face = get_face_enhancer().enhance(
                         face,
                         paste_back=True
@@ -52,13 +196,13 @@ def enhance_face(temp_frame: Frame, ref_embedding: Frame) -> Frame:
                 face = cv2.resize(face, (right - left, bottom - top))
                 temp_frame[top:bottom, left:right] = face
             except Exception as e:
-                pass
+                metrics.increment('errors')
     elif modules.variables.values.enhancer_option == modules.variables.values.enhancer_best_face_only:
         face = extract_best_one_face(temp_frame, ref_embedding)
         if face:
             top, left, bottom, right, face_frame = extract_best_one_face(temp_frame, ref_embedding)
             try:
-                with THREAD_SEMAPHORE:
+                with THREAD_SEMAPHORE, get_inference_context(), metrics.timer('enhance'):
                     _, _, face_frame = get_face_enhancer().enhance(
                         face_frame,
                         paste_back=True
@@ -66,16 +210,16 @@ def enhance_face(temp_frame: Frame, ref_embedding: Frame) -> Frame:
                 face_frame = cv2.resize(face_frame, (right - left, bottom - top))
                 temp_frame[top:bottom, left:right] = face_frame
             except Exception as e:
-                pass
+                metrics.increment('errors')
     elif modules.variables.values.enhancer_option == modules.variables.values.enhancer_all:
         try:
-            with THREAD_SEMAPHORE:
+            with THREAD_SEMAPHORE, get_inference_context(), metrics.timer('enhance'):
                 _, _, temp_frame = get_face_enhancer().enhance(
                     temp_frame,
                     paste_back=True
                 )
         except Exception as e:
-            pass
+            metrics.increment('errors')
     else:
         pass
 
@@ -83,6 +227,9 @@ def enhance_face(temp_frame: Frame, ref_embedding: Frame) -> Frame:
 
 
 def process_frame(temp_frame: Frame, ref_embedding: Frame) -> Frame:
+    if modules.variables.values.enhancer_aligned and modules.variables.values.enhancer_option != modules.variables.values.enhancer_all:
+        # the aligned path detects faces only once and skips frames without any
+        return enhance_face(temp_frame, ref_embedding)
     target_face = get_one_face(temp_frame)
     if target_face:
         temp_frame = enhance_face(temp_frame, ref_embedding)
@@ -95,12 +242,14 @@ def process_frames(source_path: str, temp_frame_paths: List[str], subject_path:
         subject_embedding = subject_face[0].embedding
     else:
         raise Exception("Subject face does not contain face...")
-    for temp_frame_path in temp_frame_paths:
-        temp_frame = cv2.imread(temp_frame_path)
-        result = process_frame(temp_frame, subject_embedding)
-        cv2.imwrite(temp_frame_path, result)
-        if progress:
-            progress.update(1)
+    modules.processors.frame.core.process_frame_paths(temp_frame_paths,
+                                                      lambda temp_frame: process_frame(temp_frame, subject_embedding),
+                                                      progress,
+                                                      FRAME_CACHE)
+
+
+def process_batch(source_face: Face, temp_frames: List[Frame], subject_embedding: Frame) -> List[Optional[Frame]]:
+    return [process_frame(temp_frame, subject_embedding) for temp_frame in temp_frames]
 
 
 def process_image(source_path: str, target_path: str, subject_path: str, output_path: str) -> None:
@@ -118,4 +267,5 @@ def process_video(source_path: str, temp_frame_paths: List[str], subject_path: s
     modules.processors.frame.core.process_video(source_path=None,
                                                 temp_frame_paths=temp_frame_paths,
                                                 process_frames=process_frames,
-                                                subject_path=subject_path)
+                                                subject_path=subject_path,
+                                                frame_cache=FRAME_CACHE)
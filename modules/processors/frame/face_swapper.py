@@ -1,18 +1,30 @@
-from typing import Any, List
+import hashlib
+import json
+import os
+from typing import Any, List, Optional
 import cv2
-import insightface
 from insightface.model_zoo.inswapper import INSwapper
+from insightface.utils import face_align
 import numpy
 import threading
 
+import modules.face_index as face_index
+import modules.metrics as metrics
+import modules.segmenter as segmenter
 import modules.variables.values
 import modules.processors.frame.core
+from modules.processors.frame.frame_cache import FrameCache
+from modules.processors.frame.face_compositor import paste_faces
+from modules.capturer import VideoDecoder
 from modules.core import update_status
+from modules.inference_session import load_model
+from modules.result_cache import get_options_fingerprint
 from modules.face_analyser import get_one_face, get_many_faces, get_best_one_face, get_face_analyser, extract_all_faces
 from modules.variables.typing import Face, Frame
-from modules.utilities import conditional_download, resolve_relative_path, is_image, is_video
+from modules.utilities import conditional_download, resolve_relative_path, is_image, is_video, get_temp_directory_path, get_temp_frame_number
 
 FACE_SWAPPER = None
+FRAME_CACHE = FrameCache()
 THREAD_LOCK = threading.Lock()
 SHORTNAME = "FACE-SWAPPER"
 NAME = f'REACTOR.{SHORTNAME}'
@@ -43,12 +55,62 @@ def get_face_swapper() -> INSwapper:
     with THREAD_LOCK:
         if FACE_SWAPPER is None:
             model_path = resolve_relative_path('../models/inswapper_128.onnx')
-            FACE_SWAPPER = insightface.model_zoo.get_model(model_path, providers=modules.variables.values.execution_providers)
+            FACE_SWAPPER = load_model(model_path, 'face_swapper')
     return FACE_SWAPPER
 
 
+def warm_up() -> None:
+    face_swapper = get_face_swapper()
+    face_swapper.session.run(face_swapper.output_names, {
+        face_swapper.input_names[0]: numpy.zeros((1, 3, *face_swapper.input_size), dtype=numpy.float32),
+        face_swapper.input_names[1]: numpy.zeros((1, face_swapper.emap.shape[1]), dtype=numpy.float32)
+    })
+
+
 def swap_face(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
-    return get_face_swapper().get(temp_frame, target_face, source_face, paste_back=True)
+    return swap_faces(source_face, [target_face], temp_frame)
+
+
+def swap_faces(source_face: Face, target_faces: List[Face], temp_frame: Frame) -> Frame:
+    """
+    Swap every target face on the original frame, then paste them all back in one pass, each limited to its bounding box.
+    """
+    batch_size = max(modules.variables.values.swap_batch_size, 1)
+    swapped_faces = []
+    with metrics.timer('swap', faces=len(target_faces)):
+        for start in range(0, len(target_faces), batch_size):
+            swapped_faces.extend(run_face_swapper(source_face, [(temp_frame, target_face) for target_face in target_faces[start:start + batch_size]]))
+        temp_frame = paste_faces(temp_frame, swapped_faces)
+    metrics.increment('faces_swapped', len(swapped_faces))
+    return temp_frame
+
+
+def has_dynamic_batch(face_swapper: INSwapper) -> bool:
+    return all(not isinstance(model_input.shape[0], int) or model_input.shape[0] < 1
+               for model_input in face_swapper.session.get_inputs())
+
+
+def run_face_swapper(source_face: Face, targets: List[tuple[Frame, Face]]) -> List[tuple[Frame, numpy.ndarray[Any, Any]]]:
+    """
+    Same inference as INSwapper.get(paste_back=False), with all the (frame, target face), of one or several frames,
+    in a single run when the model allows it.
+    """
+    face_swapper = get_face_swapper()
+    if len(targets) == 1 or not has_dynamic_batch(face_swapper):
+        return [face_swapper.get(temp_frame, target_face, source_face, paste_back=False) for temp_frame, target_face in targets]
+    aligned_faces = [face_align.norm_crop2(temp_frame, target_face.kps, face_swapper.input_size[0]) for temp_frame, target_face in targets]
+    blob = cv2.dnn.blobFromImages([aligned_face for aligned_face, _ in aligned_faces],
+                                  1.0 / face_swapper.input_std,
+                                  face_swapper.input_size,
+                                  (face_swapper.input_mean, face_swapper.input_mean, face_swapper.input_mean),
+                                  swapRB=True)
+    latent = numpy.dot(source_face.normed_embedding.reshape((1, -1)), face_swapper.emap)
+    latent /= numpy.linalg.norm(latent)
+    latent = numpy.repeat(latent, len(targets), axis=0)
+    prediction = face_swapper.session.run(face_swapper.output_names, {face_swapper.input_names[0]: blob,
+                                                                      face_swapper.input_names[1]: latent})[0]
+    fake_faces = numpy.clip(255 * prediction.transpose((0, 2, 3, 1)), 0, 255).astype(numpy.uint8)[:, :, :, ::-1]
+    return [(fake_face, matrix) for fake_face, (_, matrix) in zip(fake_faces, aligned_faces)]
 
 
 def process_frame(source_face: Face, temp_frame: Frame, subject_embedding: Face) -> Frame:
@@ -58,18 +120,40 @@ def process_frame(source_face: Face, temp_frame: Frame, subject_embedding: Face)
     :param subject_frame: cv2.imread(subject_frame_path)
     :return:
     """
+    target_faces = get_target_faces(temp_frame, subject_embedding)
+    if target_faces:
+        temp_frame = swap_faces(source_face, target_faces, temp_frame)
+    return temp_frame
+
+
+def get_target_faces(temp_frame: Frame, subject_embedding: Face) -> List[Face]:
+    """ Faces of the frame to swap, according to face_option. """
     if modules.variables.values.face_option == modules.variables.values.faces_all:
-        many_faces = get_many_faces(temp_frame)
-        if many_faces:
-            for target_face in many_faces:
-                temp_frame = swap_face(source_face, target_face, temp_frame)
-    elif modules.variables.values.face_option == modules.variables.values.faces_best_one:
+        return get_many_faces(temp_frame) or []
+    if modules.variables.values.face_option == modules.variables.values.faces_best_one:
         target_face = get_best_one_face(temp_frame, subject_embedding)
-        if target_face:
-            temp_frame = swap_face(source_face, target_face, temp_frame)
-    else:
-        pass
-    return temp_frame
+        return [target_face] if target_face else []
+    return []
+
+
+def process_batch(source_face: Face, temp_frames: List[Frame], subject_embedding: Face) -> List[Optional[Frame]]:
+    """
+    process_frame on several frames, their target faces filling the same swap_batch_size inference runs.
+    :return: the swapped frames, None for the frames without a face to swap.
+    """
+    targets = [(frame_index, target_face) for frame_index, temp_frame in enumerate(temp_frames)
+               for target_face in get_target_faces(temp_frame, subject_embedding)]
+    batch_size = max(modules.variables.values.swap_batch_size, 1)
+    swapped_faces: List[List[tuple[Frame, numpy.ndarray[Any, Any]]]] = [[] for _ in temp_frames]
+    with metrics.timer('swap', faces=len(targets)):
+        for start in range(0, len(targets), batch_size):
+            batch = targets[start:start + batch_size]
+            swapped = run_face_swapper(source_face, [(temp_frames[frame_index], target_face) for frame_index, target_face in batch])
+            for (frame_index, _), swapped_face in zip(batch, swapped):
+                swapped_faces[frame_index].append(swapped_face)
+        results = [paste_faces(temp_frame, faces) if faces else None for temp_frame, faces in zip(temp_frames, swapped_faces)]
+    metrics.increment('faces_swapped', len(targets))
+    return results
 
 
 def debug_frame(source_frame: Face, temp_frame: Frame, subject_embedding: Face) -> Frame:
@@ -85,6 +169,68 @@ def debug_frame(source_frame: Face, temp_frame: Frame, subject_embedding: Face)
                     cv2.FONT_HERSHEY_SIMPLEX, 0.9, (36, 255, 12), 2)
     return temp_frame
 
+def get_swap_decisions(subject_embedding: numpy.ndarray[Any, Any], video_face_index: Optional[face_index.FaceIndex] = None,
+                       distance_score: Optional[float] = None) -> Optional[numpy.ndarray[Any, Any]]:
+    """
+    What process_frame swaps in every frame, from the face index of the video : -1 nothing, the number of faces
+    with faces_all, the row of the selected face with faces_best_one. None without a complete index.
+    :param video_face_index: the active face index by default.
+    :param distance_score: the selected distance_score by default.
+    """
+    video_face_index = video_face_index or face_index.get_face_index()
+    if video_face_index is None or not video_face_index.complete:
+        return None
+    if modules.variables.values.face_option == modules.variables.values.faces_all:
+        face_counts = video_face_index.get_face_counts()
+        return numpy.where(face_counts > 0, face_counts, -1)
+    if modules.variables.values.face_option == modules.variables.values.faces_best_one:
+        return video_face_index.get_best_faces(subject_embedding, modules.variables.values.distance_score if distance_score is None else distance_score)
+    return numpy.full(video_face_index.frame_total, -1, dtype=numpy.int64)
+
+
+def get_decisions_path(target_path: str) -> str:
+    return os.path.join(get_temp_directory_path(target_path), 'swap_decisions.npz')
+
+
+def get_render_hash(source_face: Face) -> str:
+    """
+    Everything which changes the pixels of a swapped frame besides the decisions : the source face, the processors,
+    their models, precision and options. face_option and distance_score are left out, the decisions follow them.
+    """
+    options = {name: value for name, value in get_options_fingerprint('process').items() if name not in ('face_option', 'distance_score')}
+    render_key = source_face.embedding.tobytes() + json.dumps(options, sort_keys=True).encode()
+    return hashlib.blake2b(render_key, digest_size=16).hexdigest()
+
+
+def select_frames_to_render(temp_frame_paths: List[str], decisions: numpy.ndarray[Any, Any], render_hash: str) -> tuple[List[str], bool]:
+    """
+    Frames which need the swapper. Freshly extracted frames without anything to swap are already the output.
+    Frames kept from a previous run are only rendered again, from the original video, where the decision changed,
+    or wherever there is a decision when the previous run rendered with another source face, models or options.
+    :return: the frames to render and whether they have to be read from the original video.
+    """
+    frame_indexes = numpy.array([get_temp_frame_number(temp_frame_path) - 1 for temp_frame_path in temp_frame_paths], dtype=numpy.int64)
+    frame_decisions = decisions[numpy.clip(frame_indexes, 0, len(decisions) - 1)]
+    decisions_path = get_decisions_path(modules.variables.values.target_path)
+    if modules.variables.values.decompose_video:
+        render = frame_decisions != -1
+        from_original = False
+    elif os.path.isfile(decisions_path):
+        previous = numpy.load(decisions_path)
+        previous_decisions = previous['decisions']
+        if len(previous_decisions) != len(decisions):
+            return temp_frame_paths, False
+        previous_frame_decisions = previous_decisions[numpy.clip(frame_indexes, 0, len(decisions) - 1)]
+        if 'render_hash' in previous.files and str(previous['render_hash']) == render_hash:
+            render = frame_decisions != previous_frame_decisions
+        else:
+            render = (frame_decisions != -1) | (previous_frame_decisions != -1)
+        from_original = True
+    else:
+        return temp_frame_paths, False
+    return [temp_frame_path for temp_frame_path, rendered in zip(temp_frame_paths, render) if rendered], from_original
+
+
 def process_frames(source_path: str,
                    temp_frame_paths: List[str],
                    subject_path: str,
@@ -97,16 +243,43 @@ def process_frames(source_path: str,
     else:
         raise Exception("Subject face does not contain face...")
 
-    for temp_frame_path in temp_frame_paths:
-        temp_frame = cv2.imread(temp_frame_path)
+    from_original = False
+    decisions = get_swap_decisions(subject_embedding)
+    render_hash = get_render_hash(source_face)
+    if decisions is not None:
+        frame_total = len(temp_frame_paths)
+        all_temp_frame_paths = temp_frame_paths
+        temp_frame_paths, from_original = select_frames_to_render(temp_frame_paths, decisions, render_hash)
+        # the frames left out are final already
+        segmenter.complete_frames(sorted(set(all_temp_frame_paths) - set(temp_frame_paths)))
+        update_status(f'Face index: rendering {len(temp_frame_paths)} of {frame_total} frames', NAME)
+        if progress:
+            progress.update(frame_total - len(temp_frame_paths))
+
+    # a decoder of its own, the one of the preview is replaced whenever another video is previewed
+    decoder = VideoDecoder(modules.variables.values.target_path) if from_original else None
+
+    def process(temp_frame: Frame) -> Optional[Frame]:
         try:
-            result = process_frame(source_face, temp_frame, subject_embedding)
-            cv2.imwrite(temp_frame_path, result)
+            if decoder:
+                temp_frame = decoder.read(face_index.get_current_frame())
+            return process_frame(source_face, temp_frame, subject_embedding)
         except Exception as exception:
+            metrics.increment('errors')
             print(exception)
-            pass
-        if progress:
-            progress.update(1)
+        return None
+
+    try:
+        modules.processors.frame.core.process_frame_paths(temp_frame_paths, process, progress, FRAME_CACHE)
+    finally:
+        if decoder:
+            decoder.release()
+    if decisions is None:
+        # the index recorded by this run tells what it swapped
+        face_index.save_index()
+        decisions = get_swap_decisions(subject_embedding)
+    if decisions is not None:
+        numpy.savez(get_decisions_path(modules.variables.values.target_path), decisions=decisions, render_hash=render_hash)
 
 
 def debug_frames(source_path: str,
@@ -121,16 +294,15 @@ def debug_frames(source_path: str,
     else:
         raise Exception("Subject face does not contain face...")
 
-    for temp_frame_path in temp_frame_paths:
-        temp_frame = cv2.imread(temp_frame_path)
+    def debug(temp_frame: Frame) -> Optional[Frame]:
         try:
-            result = debug_frame(source_face, temp_frame, subject_embedding)
-            cv2.imwrite(temp_frame_path, result)
+            return debug_frame(source_face, temp_frame, subject_embedding)
         except Exception as exception:
+            metrics.increment('errors')
             print(exception)
-            pass
-        if progress:
-            progress.update(1)
+        return None
+
+    modules.processors.frame.core.process_frame_paths(temp_frame_paths, debug, progress)
 
 
 def process_image(source_path: str, target_path: str, subject_path: str, output_path: str) -> None:
@@ -161,7 +333,8 @@ def process_video(source_path: str, temp_frame_paths: List[str], subject_path: s
     modules.processors.frame.core.process_video(source_path,
                                                 temp_frame_paths,
                                                 process_frames,
-                                                subject_path)
+                                                subject_path,
+                                                frame_cache=FRAME_CACHE)
 
 
 def debug_video(source_path: str, temp_frame_paths: List[str], subject_path: str) -> None:
@@ -0,0 +1,81 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Optional
+import cv2
+import numpy
+
+import modules.variables.values
+from modules.variables.typing import Frame
+
+SIGNATURE_SIZE = (64, 64)
+
+
+class FrameCache:
+    """
+    LRU of the last processed frames, keyed by a perceptual signature of the input frame.
+    The signature is a small grayscale thumbnail : two frames repeat when no thumbnail cell
+    differs by more than `frame_cache_tolerance` (0-255), so the processed output of the
+    earlier one is reused instead of running detection, swap and enhancement again.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[int, tuple[numpy.ndarray[Any, Any], Frame]] = OrderedDict()
+        self.next_key = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(modules.variables.values.frame_cache_size)
+
+    def reset(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    @staticmethod
+    def signature(frame: Frame) -> numpy.ndarray[Any, Any]:
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return cv2.resize(gray, SIGNATURE_SIZE, interpolation=cv2.INTER_AREA).astype(numpy.int16)
+
+    def get(self, signature: Optional[numpy.ndarray[Any, Any]]) -> Optional[Frame]:
+        if signature is None:
+            return None
+        with self.lock:
+            for key, (cached_signature, result) in reversed(self.entries.items()):
+                if cached_signature.shape == signature.shape \
+                        and numpy.abs(cached_signature - signature).max() <= modules.variables.values.frame_cache_tolerance:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return result
+            self.misses += 1
+        return None
+
+    def put(self, signature: Optional[numpy.ndarray[Any, Any]], result: Frame) -> None:
+        if signature is None:
+            return
+        with self.lock:
+            self.entries[self.next_key] = (signature, result)
+            self.next_key += 1
+            while len(self.entries) > modules.variables.values.frame_cache_size:
+                self.entries.popitem(last=False)
+
+    def lookup(self, frame: Frame) -> tuple[Optional[numpy.ndarray[Any, Any]], Optional[Frame]]:
+        """
+        Return the signature of frame and the cached result if the frame repeats a recent one.
+        The signature must be computed before processing, as processors may modify the frame in place.
+        """
+        if not self.enabled:
+            return None, None
+        signature = self.signature(frame)
+        return signature, self.get(signature)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def report(self) -> str:
+        return f'Frame cache: {self.hits}/{self.hits + self.misses} frames reused ({self.hit_rate:.1%})'
@@ -11,7 +11,7 @@ import modules.processors.frame.core
 from modules.core import update_status
 from modules.face_analyser import get_one_face, get_many_faces, get_best_one_face, get_face_analyser, extract_all_faces
 from modules.variables.typing import Face, Frame
-from modules.utilities import conditional_download, resolve_relative_path, is_image, is_video
+from modules.utilities import conditional_download, resolve_relative_path, is_image, is_video, read_temp_frame, write_temp_frame
 
 
 class FaceModifier(ABC):
@@ -105,13 +105,13 @@ class FaceModifier(ABC):
             raise Exception("Subject face does not contain face...")
 
         for temp_frame_path in temp_frame_paths:
-            temp_frame = cv2.imread(temp_frame_path)
+            temp_frame = read_temp_frame(temp_frame_path)
             try:
                 result = self.process_frame(source_face=source_face,
                                             temp_frame=temp_frame,
                                             subject_embedding=subject_embedding,
                                             engine_option=engine_option)
-                cv2.imwrite(temp_frame_path, result)
+                write_temp_frame(temp_frame_path, result)
             except Exception as exception:
                 print(exception)
                 pass
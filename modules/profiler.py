@@ -0,0 +1,131 @@
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+import modules.variables.values
+
+THREAD_LOCK = threading.Lock()
+EVENTS: List[Dict[str, Any]] = []
+THREAD_NAMES: Dict[int, str] = {}
+PROFILES: List[cProfile.Profile] = []
+PROFILE_CONFLICT = False
+ENABLED = False
+
+
+def start() -> None:
+    """
+    Start recording the spans of a new job when a trace or a cProfile dump was asked for.
+    """
+    global ENABLED, PROFILE_CONFLICT
+
+    with THREAD_LOCK:
+        EVENTS.clear()
+        THREAD_NAMES.clear()
+        PROFILES.clear()
+        PROFILE_CONFLICT = False
+        ENABLED = bool(modules.variables.values.trace_path or modules.variables.values.cprofile_path)
+
+
+def get_timestamp() -> float:
+    # chrome traces are in microseconds
+    return time.perf_counter() * 1e6
+
+
+@contextmanager
+def span(name: str, category: str = 'reactor', **args: Any) -> Iterator[None]:
+    if not ENABLED:
+        yield
+        return
+    start_timestamp = get_timestamp()
+    try:
+        yield
+    finally:
+        end_timestamp = get_timestamp()
+        thread = threading.current_thread()
+        event = {'name': name, 'cat': category, 'ph': 'X', 'ts': start_timestamp, 'dur': end_timestamp - start_timestamp,
+                 'pid': os.getpid(), 'tid': thread.ident, 'args': args}
+        with THREAD_LOCK:
+            EVENTS.append(event)
+            THREAD_NAMES.setdefault(thread.ident or 0, thread.name)
+
+
+@contextmanager
+def profile_thread() -> Iterator[None]:
+    """
+    Run the body under a cProfile profiler of its own, cProfile only sees the thread which enabled it.
+    From python 3.12 only one profiler can be active at once : the threads starting while another one is profiled
+    run unprofiled, and the dump only covers the profiled ones.
+    """
+    global PROFILE_CONFLICT
+
+    if not ENABLED or not modules.variables.values.cprofile_path:
+        yield
+        return
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError as exception:
+        with THREAD_LOCK:
+            conflict, PROFILE_CONFLICT = PROFILE_CONFLICT, True
+        if not conflict:
+            print(f'[REACTOR.PROFILER] {exception}, only one thread at a time is profiled.')
+        yield
+        return
+    try:
+        yield
+    finally:
+        profile.disable()
+        with THREAD_LOCK:
+            PROFILES.append(profile)
+
+
+def write_trace(trace_path: str) -> None:
+    """
+    Write the spans as a Chrome trace, to open in chrome://tracing or ui.perfetto.dev.
+    """
+    with THREAD_LOCK:
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': thread_id, 'args': {'name': thread_name}}
+                    for thread_id, thread_name in THREAD_NAMES.items()]
+        trace = {'traceEvents': metadata + EVENTS, 'displayTimeUnit': 'ms'}
+    with open(trace_path, 'w') as trace_file:
+        json.dump(trace, trace_file)
+
+
+def write_cprofile(cprofile_path: str) -> bool:
+    """
+    Merge the profiles of the worker threads into one pstats dump, to open with snakeviz or pstats.
+    """
+    with THREAD_LOCK:
+        profiles = list(PROFILES)
+    if not profiles:
+        return False
+    stats: Optional[pstats.Stats] = None
+    for profile in profiles:
+        if stats is None:
+            stats = pstats.Stats(profile)
+        else:
+            stats.add(profile)
+    if stats:
+        stats.dump_stats(cprofile_path)
+    return True
+
+
+def stop() -> List[str]:
+    """ Stop recording and write the asked outputs, returns their paths. """
+    global ENABLED
+
+    if not ENABLED:
+        return []
+    ENABLED = False
+    output_paths = []
+    if modules.variables.values.trace_path:
+        write_trace(modules.variables.values.trace_path)
+        output_paths.append(modules.variables.values.trace_path)
+    if modules.variables.values.cprofile_path and write_cprofile(modules.variables.values.cprofile_path):
+        output_paths.append(modules.variables.values.cprofile_path)
+    return output_paths
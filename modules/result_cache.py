@@ -0,0 +1,92 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import threading
+from typing import Any, Dict, List, Optional
+
+import modules.variables.values
+from modules.face_index import get_content_hash, get_detector_settings
+from modules.model_variants import get_model_precision
+from modules.utilities import resolve_relative_path
+
+RESULT_CACHE_DIRECTORY = resolve_relative_path('../cache/results')
+MODELS_DIRECTORY = resolve_relative_path('../models')
+THREAD_LOCK = threading.Lock()
+
+
+def get_models_fingerprint() -> List[List[Any]]:
+    """ Name, size and modification time of the model files, enough to notice a model was replaced. """
+    model_paths = sorted(glob.glob(os.path.join(MODELS_DIRECTORY, '*.onnx')) + glob.glob(os.path.join(MODELS_DIRECTORY, '*.pth')))
+    return [[os.path.basename(model_path), os.stat(model_path).st_size, os.stat(model_path).st_mtime_ns] for model_path in model_paths]
+
+
+def get_options_fingerprint(process: str) -> Dict[str, Any]:
+    """ Everything besides the inputs that changes the output image, every option the processors read. """
+    # the processors the job will run once the ui toggles are applied
+    frame_processors = [frame_processor for frame_processor in dict.fromkeys(modules.variables.values.frame_processors + list(modules.variables.values.fp_ui))
+                        if modules.variables.values.fp_ui.get(frame_processor, frame_processor in modules.variables.values.frame_processors)]
+    return {
+        'process': process,
+        'frame_processors': frame_processors,
+        'face_option': modules.variables.values.face_option,
+        'distance_score': modules.variables.values.distance_score,
+        'enhancer_option': modules.variables.values.enhancer_option,
+        'nsfw': modules.variables.values.nsfw,
+        'enhancer_aligned': modules.variables.values.enhancer_aligned,
+        'enhancer_cpu_mode': modules.variables.values.enhancer_cpu_mode,
+        'enhancer_precision': modules.variables.values.enhancer_precision,
+        'model_precision': get_model_precision(),
+        'execution_providers': modules.variables.values.execution_providers,
+        'detector': get_detector_settings(),
+        'models': get_models_fingerprint()
+    }
+
+
+def get_cache_path(process: str, source_path: str, target_path: str, subject_path: Optional[str], output_path: str) -> str:
+    """ Path of the cached output, named after the content of the inputs and the options. """
+    key = {
+        'inputs': [get_content_hash(path) if path else None for path in (source_path, target_path, subject_path)],
+        'options': get_options_fingerprint(process)
+    }
+    key_hash = hashlib.blake2b(json.dumps(key, sort_keys=True).encode(), digest_size=16).hexdigest()
+    return os.path.join(RESULT_CACHE_DIRECTORY, key_hash + os.path.splitext(output_path)[1].lower())
+
+
+def restore(cache_path: str, output_path: str) -> bool:
+    """ Copy the cached output to output_path, marking it as recently used. """
+    try:
+        shutil.copyfile(cache_path, output_path)
+        os.utime(cache_path)
+    except OSError:
+        return False
+    return True
+
+
+def store(cache_path: str, output_path: str) -> None:
+    """ Keep a copy of the output, aside then renamed so a partial copy is never restored, and evict the least recently used ones. """
+    os.makedirs(RESULT_CACHE_DIRECTORY, exist_ok=True)
+    temp_cache_path = f'{cache_path}.{threading.get_ident()}.tmp'
+    shutil.copyfile(output_path, temp_cache_path)
+    os.replace(temp_cache_path, cache_path)
+    evict(modules.variables.values.result_cache_size * 1024 * 1024)
+
+
+def evict(max_size: int) -> None:
+    """ Remove the least recently used outputs until the cache fits max_size bytes. """
+    with THREAD_LOCK:
+        entries = []
+        for entry in os.scandir(RESULT_CACHE_DIRECTORY):
+            if entry.is_file() and not entry.name.endswith('.tmp'):
+                entry_stat = entry.stat()
+                entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+        cache_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if cache_size <= max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            cache_size -= size
@@ -0,0 +1,197 @@
+import csv
+import json
+import os
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+import cv2
+import numpy
+
+import modules.face_index as face_index
+import modules.metrics as metrics
+import modules.variables.values
+from modules.face_analyser import detect_faces, get_one_face
+from modules.processors.frame.core import get_until_aborted, put_until_aborted
+from modules.variables.typing import Frame
+from modules.video_metadata import get_video_metadata
+
+HISTOGRAM_BINS = 64
+CHART_SIZE = (1200, 300)
+
+
+def build_face_index(target_path: str) -> face_index.FaceIndex:
+    """
+    Face index of the video, loaded when it exists, else analysed frame by frame : a decoder thread reads the frames
+    in order into a bounded queue, ahead of the execution_threads workers detecting their faces.
+    """
+    from modules.capturer import get_video_decoder
+
+    frame_total = get_video_metadata(target_path).frame_total
+    video_face_index = face_index.activate(target_path, frame_total, record=True)
+    assert video_face_index is not None
+    try:
+        if video_face_index.complete:
+            return video_face_index
+        decoder = get_video_decoder(target_path)
+        execution_threads = max(modules.variables.values.execution_threads or 1, 1)
+        frames: queue.Queue[Any] = queue.Queue(maxsize=execution_threads * 4)
+        abort = threading.Event()
+
+        def decode_frames() -> None:
+            try:
+                for frame_index in range(frame_total):
+                    put_until_aborted(frames, (frame_index, decoder.read(frame_index)), abort)
+            finally:
+                for _ in range(execution_threads):
+                    put_until_aborted(frames, None, abort)
+
+        def analyse_frames() -> None:
+            while True:
+                item = get_until_aborted(frames, abort)
+                if item is None:
+                    return
+                frame_index, frame = item
+                if frame is None:
+                    video_face_index.record_faces(frame_index, [])
+                    continue
+                with face_index.current_frame(frame_index):
+                    detect_faces(frame)
+                metrics.increment('frames_processed')
+
+        def stop_on_error(future: Future[None]) -> None:
+            if future.exception():
+                abort.set()
+
+        with ThreadPoolExecutor(max_workers=execution_threads + 1) as executor:
+            futures = [executor.submit(decode_frames), *[executor.submit(analyse_frames) for _ in range(execution_threads)]]
+            for future in futures:
+                future.add_done_callback(stop_on_error)
+            for future in futures:
+                future.result()
+    finally:
+        face_index.deactivate()
+    if not video_face_index.complete:
+        raise Exception(f'Face index of {target_path} is incomplete')
+    return video_face_index
+
+
+def suggest_threshold(distances: numpy.ndarray[Any, Any]) -> Optional[float]:
+    """
+    Otsu threshold of the distances : the subject's faces and the others make two groups, the threshold maximizes the
+    variance between them.
+    """
+    if len(distances) < 2 or numpy.ptp(distances) == 0:
+        return None
+    histogram, edges = numpy.histogram(distances, HISTOGRAM_BINS)
+    centers = (edges[:-1] + edges[1:]) / 2
+    weights = numpy.cumsum(histogram)
+    sums = numpy.cumsum(histogram * centers)
+    lower_means = sums / numpy.maximum(weights, 1)
+    upper_means = (sums[-1] - sums) / numpy.maximum(weights[-1] - weights, 1)
+    between_variances = weights * (weights[-1] - weights) * (lower_means - upper_means) ** 2
+    return float(edges[int(numpy.argmax(between_variances)) + 1])
+
+
+def draw_charts(distances: numpy.ndarray[Any, Any], best_distances: numpy.ndarray[Any, Any], thresholds: Dict[str, Optional[float]]) -> Frame:
+    """
+    Histogram of the distances of every face, above the timeline of the best distance of each frame,
+    both with the threshold lines.
+    """
+    width, height = CHART_SIZE
+    chart = numpy.full((height * 2, width, 3), 255, dtype=numpy.uint8)
+    finite_best_distances = best_distances[numpy.isfinite(best_distances)]
+    max_distance = max(float(distances.max()) if len(distances) else 1.0, *[threshold for threshold in thresholds.values() if threshold]) * 1.05
+    histogram, _ = numpy.histogram(distances, HISTOGRAM_BINS, (0, max_distance))
+    bin_width = width / HISTOGRAM_BINS
+    for index, count in enumerate(histogram):
+        bar_height = int((height - 20) * count / max(histogram.max(), 1))
+        cv2.rectangle(chart, (int(index * bin_width), height - bar_height), (int((index + 1) * bin_width) - 1, height), (180, 130, 70), -1)
+    if len(finite_best_distances):
+        points = [(int(frame_index * (width - 1) / max(len(best_distances) - 1, 1)), int(2 * height - 1 - (height - 20) * distance / max_distance))
+                  for frame_index, distance in enumerate(best_distances) if numpy.isfinite(distance)]
+        for point in points:
+            cv2.circle(chart, point, 1, (180, 130, 70), -1)
+    for (name, threshold), color in zip(thresholds.items(), ((0, 160, 0), (0, 0, 220))):
+        if threshold is None:
+            continue
+        x = int(threshold / max_distance * width)
+        y = int(2 * height - 1 - (height - 20) * threshold / max_distance)
+        cv2.line(chart, (x, 0), (x, height), color, 1)
+        cv2.line(chart, (0, y), (width, y), color, 1)
+        cv2.putText(chart, f'{name} {threshold:.2f}', (x + 4, 16), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
+    cv2.line(chart, (0, height), (width, height), (0, 0, 0), 1)
+    return chart
+
+
+def annotate_frame(frame: Frame, faces: List[Any], distances: numpy.ndarray[Any, Any], decision: int) -> Frame:
+    """ Faces the swapper selects, as decided by get_swap_decisions, in green and the others in red, with their distance. """
+    for row, (face, distance) in enumerate(zip(faces, distances)):
+        bbox = face.bbox[:4].astype(int)
+        selected = decision != -1 and (modules.variables.values.face_option == modules.variables.values.faces_all or row == decision)
+        cv2.rectangle(frame, (bbox[0], bbox[1]), (bbox[2], bbox[3]), (0, 255, 0) if selected else (0, 0, 255), 2)
+        cv2.putText(frame, f'Score: {distance:.2f}', (max(bbox[0], 0), max(bbox[1] - 10, 20)), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (36, 255, 12), 2)
+    return frame
+
+
+def analyse_scores(target_path: str, subject_path: str, output_path: str, timestamps: Optional[List[float]] = None) -> Dict[str, Any]:
+    """
+    Distance to the subject of every face of every frame, written as a per-frame table (.scores.csv), a histogram and
+    timeline (.scores.png) and a summary with a suggested distance_score (.scores.json) next to output_path.
+    Annotated frames are only rendered at the given timestamps, in seconds. The frames swapped are the ones the
+    swapper selects with the current face_option.
+    """
+    from modules.capturer import get_video_decoder
+    from modules.core import update_status
+    from modules.processors.frame.face_swapper import get_swap_decisions
+
+    subject_face = get_one_face(cv2.imread(subject_path))
+    if not subject_face:
+        raise Exception("Subject face does not contain face...")
+    subject_embedding = subject_face.embedding
+    video_metadata = get_video_metadata(target_path)
+    metrics.increment('frames', video_metadata.frame_total)
+    with metrics.timer('analyse'):
+        video_face_index = build_face_index(target_path)
+    face_frames = video_face_index.get_face_frames()
+    distances = video_face_index.get_match_distances(subject_embedding)
+    best_distances = numpy.full(video_face_index.frame_total, numpy.inf)
+    numpy.minimum.at(best_distances, face_frames, distances)
+    face_counts = video_face_index.get_face_counts()
+    # the suggested threshold first, the chart draws it in green
+    thresholds = {'suggested': suggest_threshold(distances), 'current': float(modules.variables.values.distance_score)}
+    decisions = {name: get_swap_decisions(subject_embedding, video_face_index, threshold) for name, threshold in thresholds.items() if threshold is not None}
+
+    output_base_path = os.path.splitext(output_path)[0]
+    with open(output_base_path + '.scores.csv', 'w', newline='') as table_file:
+        writer = csv.writer(table_file)
+        writer.writerow(['frame', 'time', 'faces', 'best_distance', 'swapped'])
+        for frame_index, (face_count, best_distance) in enumerate(zip(face_counts, best_distances)):
+            writer.writerow([frame_index + 1, round(frame_index / float(video_metadata.fps), 3), int(face_count),
+                             round(float(best_distance), 4) if face_count else '', int(decisions['current'][frame_index] != -1)])
+    cv2.imwrite(output_base_path + '.scores.png', draw_charts(distances, best_distances, thresholds))
+    annotated_paths = []
+    for timestamp in timestamps or []:
+        frame_index = min(max(int(round(timestamp * float(video_metadata.fps))), 0), video_face_index.frame_total - 1)
+        frame = get_video_decoder(target_path).read(frame_index)
+        if frame is None:
+            continue
+        start, end = video_face_index.columns['offsets'][frame_index:frame_index + 2]
+        annotated_path = f'{output_base_path}.frame-{frame_index + 1:06d}.png'
+        cv2.imwrite(annotated_path, annotate_frame(frame, video_face_index.get_faces(frame_index) or [], distances[start:end], int(decisions['current'][frame_index])))
+        annotated_paths.append(annotated_path)
+    summary = {
+        'target_path': target_path,
+        'frames': int(video_face_index.frame_total),
+        'faces': int(len(distances)),
+        'frames_with_faces': int(numpy.count_nonzero(face_counts)),
+        'thresholds': thresholds,
+        'face_option': modules.variables.values.face_option,
+        'frames_swapped': {name: int(numpy.count_nonzero(frame_decisions != -1)) for name, frame_decisions in decisions.items()},
+        'distance_percentiles': {str(percentile): round(float(numpy.percentile(distances, percentile)), 4) for percentile in (1, 5, 25, 50, 75, 95, 99)} if len(distances) else {},
+        'annotated_frames': annotated_paths
+    }
+    with open(output_base_path + '.scores.json', 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    update_status(f'Score analysis saved to {output_base_path}.scores.*, suggested distance_score {thresholds["suggested"]}', 'REACTOR.SCORE-ANALYSIS')
+    return summary
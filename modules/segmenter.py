@@ -0,0 +1,141 @@
+import math
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+import numpy
+
+import modules.variables.values
+from modules.ffmpeg import FFmpegError, get_video_encoder_args, run_ffmpeg
+from modules.utilities import get_temp_frame_number, get_temp_frame_range_input_args
+from modules.video_metadata import get_keyframe_index, get_video_metadata
+
+PLAYLIST_NAME = 'playlist.m3u8'
+SEGMENT_NAME = 'segment_%05d.ts'
+SEGMENTER: Optional['Segmenter'] = None
+THREAD_LOCK = threading.Lock()
+
+
+class Segmenter:
+    """
+    HLS output written while the last processor runs : the frames are cut in segments of segment_duration seconds,
+    each one encoded in the background, in order, as soon as all its frames are written, and the playlist is
+    replaced after every segment. Segments start at the timestamp of their first frame, the frames of a variable
+    frame rate video are not evenly spaced.
+    """
+
+    def __init__(self, target_path: str, directory_path: str, frame_total: int) -> None:
+        self.target_path = target_path
+        self.directory_path = directory_path
+        self.frame_total = frame_total
+        self.fps = float(get_video_metadata(target_path).fps) or 30.0
+        self.segment_frames = max(int(round(modules.variables.values.segment_duration * self.fps)), 1)
+        self.segment_total = math.ceil(frame_total / self.segment_frames)
+        self.completed = bytearray(frame_total)
+        self.remaining = [self.get_segment_range(segment)[1] for segment in range(self.segment_total)]
+        self.segment_times = self.get_segment_times(get_keyframe_index(target_path).frame_times)
+        self.next_segment = 0
+        self.durations: List[float] = []
+        self.failed = False
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='segmenter')
+        shutil.rmtree(directory_path, ignore_errors=True)
+        os.makedirs(directory_path)
+
+    def get_segment_range(self, segment: int) -> tuple[int, int]:
+        """ First frame and frame count of the segment. """
+        start_frame = segment * self.segment_frames
+        return start_frame, min(self.segment_frames, self.frame_total - start_frame)
+
+    def get_segment_times(self, frame_times: numpy.ndarray[Any, Any]) -> List[float]:
+        """
+        Start of every segment and end of the last one, in seconds from the first frame. Without the timestamps of
+        every frame, the frames are taken as evenly spaced.
+        """
+        start_frames = [segment * self.segment_frames for segment in range(self.segment_total)]
+        even_times = [start_frame / self.fps for start_frame in start_frames] + [self.frame_total / self.fps]
+        if len(frame_times) != self.frame_total or not numpy.all(numpy.isfinite(frame_times)):
+            return even_times
+        # the last frame lasts one average frame interval
+        end_time = float(frame_times[-1]) + 1 / self.fps
+        segment_times = [float(frame_times[start_frame] - frame_times[0]) for start_frame in start_frames] + [end_time - float(frame_times[0])]
+        return segment_times if all(start < end for start, end in zip(segment_times, segment_times[1:])) else even_times
+
+    def complete_frames(self, frame_indexes: List[int]) -> None:
+        with self.lock:
+            for frame_index in frame_indexes:
+                if 0 <= frame_index < self.frame_total and not self.completed[frame_index]:
+                    self.completed[frame_index] = 1
+                    self.remaining[frame_index // self.segment_frames] -= 1
+            while self.next_segment < self.segment_total and self.remaining[self.next_segment] == 0:
+                self.executor.submit(self.encode_segment, self.next_segment)
+                self.next_segment += 1
+
+    def encode_segment(self, segment: int) -> None:
+        if self.failed:
+            return
+        start_frame, frame_count = self.get_segment_range(segment)
+        start_time = self.segment_times[segment]
+        duration = self.segment_times[segment + 1] - start_time
+        try:
+            # the frames at their average rate within the segment, so that the video ends with the audio of the segment
+            run_ffmpeg([*get_temp_frame_range_input_args(self.target_path, start_frame, frame_count / duration),
+                        '-ss', f'{start_time:.6f}', '-t', f'{duration:.6f}', '-i', self.target_path,
+                        '-map', '0:v:0', '-map', '1:a?', '-frames:v', str(frame_count),
+                        *get_video_encoder_args(), '-pix_fmt', 'yuv420p', '-c:a', 'aac',
+                        '-output_ts_offset', f'{start_time:.6f}', '-f', 'mpegts',
+                        '-y', os.path.join(self.directory_path, SEGMENT_NAME % segment)], 'segment')
+        except FFmpegError as exception:
+            print(f'[REACTOR.SEGMENTER] Encoding segment {segment} failed, no more segments are written: {exception}')
+            self.failed = True
+            return
+        self.durations.append(duration)
+        self.write_playlist(ended=len(self.durations) == self.segment_total)
+
+    def write_playlist(self, ended: bool) -> None:
+        """ Replace the playlist at once, players never read it half written. """
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-PLAYLIST-TYPE:EVENT',
+                 f'#EXT-X-TARGETDURATION:{math.ceil(max(self.durations))}', '#EXT-X-MEDIA-SEQUENCE:0']
+        for segment, duration in enumerate(self.durations):
+            lines += [f'#EXTINF:{duration:.6f},', SEGMENT_NAME % segment]
+        if ended:
+            lines.append('#EXT-X-ENDLIST')
+        playlist_path = os.path.join(self.directory_path, PLAYLIST_NAME)
+        with open(playlist_path + '.tmp', 'w') as playlist_file:
+            playlist_file.write('\n'.join(lines) + '\n')
+        os.replace(playlist_path + '.tmp', playlist_path)
+
+    def close(self) -> None:
+        """ Wait for the segments being encoded. Segments whose frames were never all written are left out. """
+        self.executor.shutdown(wait=True)
+
+
+def get_directory_path(output_path: str) -> str:
+    return os.path.splitext(output_path)[0] + '.hls'
+
+
+def activate(target_path: str, output_path: str, frame_total: int) -> None:
+    """ Segment the frames of target_path written from now on, into the .hls directory next to output_path. """
+    global SEGMENTER
+
+    segmenter = Segmenter(target_path, get_directory_path(output_path), frame_total) if frame_total else None
+    with THREAD_LOCK:
+        SEGMENTER = segmenter
+
+
+def deactivate() -> None:
+    global SEGMENTER
+
+    with THREAD_LOCK:
+        segmenter, SEGMENTER = SEGMENTER, None
+    if segmenter:
+        segmenter.close()
+        print(f'[REACTOR.SEGMENTER] {len(segmenter.durations)} of {segmenter.segment_total} segments in {os.path.join(segmenter.directory_path, PLAYLIST_NAME)}')
+
+
+def complete_frames(temp_frame_paths: List[str]) -> None:
+    """ The frames are written in their final state. """
+    segmenter = SEGMENTER
+    if segmenter:
+        segmenter.complete_frames([get_temp_frame_number(temp_frame_path) - 1 for temp_frame_path in temp_frame_paths])
@@ -1,5 +1,6 @@
 import os
 os.add_dll_directory("C:\\Program Files\\NVIDIA\\CUDNN\\v9.7\\bin\\12.8")
+import threading
 import webbrowser
 from typing import Tuple, Callable
 
@@ -11,6 +12,8 @@ from idlelib.tooltip import Hovertip
 import modules.capturer
 import modules.core
 import modules.face_analyser
+import modules.face_index
+import modules.model_manager
 import modules.utilities
 import modules.variables.metadata as metadata
 import modules.variables.values as values
@@ -269,6 +272,7 @@ class App(ctk.CTk):
         values.face_option = self.faces_value.get()
         if values.face_option != values.faces_none:
             values.fp_ui['face_swapper'] = True
+            modules.model_manager.preload_models(['face_swapper'])
         else:
             values.fp_ui['face_swapper'] = False
 
@@ -276,6 +280,7 @@ class App(ctk.CTk):
         values.enhancer_option = self.enhancer_value.get()
         if values.enhancer_option != values.enhancer_none:
             values.fp_ui['face_enhancer'] = True
+            modules.model_manager.preload_models(['face_enhancer'])
         else:
             values.fp_ui['face_enhancer'] = False
 
@@ -392,7 +397,7 @@ class App(ctk.CTk):
         self.preview_label = ctk.CTkLabel(preview, text=None)
         self.preview_label.pack(fill='both', expand=True)
 
-        self.preview_slider = ctk.CTkSlider(preview, from_=0, to=0, command=lambda frame_value: self.update_preview(frame_value))
+        self.preview_slider = ctk.CTkSlider(preview, from_=1, to=2, command=lambda frame_value: self.update_preview(int(frame_value)))
 
         return preview
 
@@ -409,11 +414,14 @@ class App(ctk.CTk):
                     subject_embedding = subject_face[0].embedding
                 else:
                     raise Exception("Subject face does not contain face...")
-                temp_frame = frame_processor.process_frame(
-                    modules.face_analyser.get_one_face(cv2.imread(values.source_path)),
-                    temp_frame,
-                    subject_embedding
-                )
+                source_face = modules.face_analyser.get_one_face(cv2.imread(values.source_path))
+                # faces of the frame come from the face index of the video, when it has one
+                with modules.face_index.current_frame(max(frame_number - 1, 0), preview=True):
+                    temp_frame = frame_processor.process_frame(
+                        source_face,
+                        temp_frame,
+                        subject_embedding
+                    )
             image = Image.fromarray(cv2.cvtColor(temp_frame, cv2.COLOR_BGR2RGB))
             image = ImageOps.contain(image, (self.PREVIEW_MAX_WIDTH, self.PREVIEW_MAX_HEIGHT), Image.LANCZOS)
             image = ctk.CTkImage(image, size=image.size)
@@ -421,12 +429,32 @@ class App(ctk.CTk):
 
     def init_preview(self) -> None:
         if modules.utilities.is_image(values.target_path):
+            # the faces of a video previewed before must not be served for the image
+            modules.face_index.deactivate(preview=True)
             self.preview_slider.pack_forget()
         if modules.utilities.is_video(values.target_path):
-            video_frame_total = modules.capturer.get_video_frame_total(values.target_path)
-            self.preview_slider.configure(to=video_frame_total)
+            modules.face_index.deactivate(preview=True)
+            self.configure_preview_slider(modules.capturer.get_video_frame_total(values.target_path, exact=False))
             self.preview_slider.pack(fill='x')
-            self.preview_slider.set(0)
+            self.preview_slider.set(1)
+            # counting the frames and hashing the video for its face index read the whole file, away from the ui thread
+            threading.Thread(target=self.activate_face_index, args=(values.target_path,), daemon=True).start()
+
+    def configure_preview_slider(self, video_frame_total: int) -> None:
+        # one step per frame, frame numbers start at 1 like the extracted frames
+        self.preview_slider.configure(from_=1, to=max(video_frame_total, 2), number_of_steps=max(video_frame_total - 1, 1))
+
+    def activate_face_index(self, video_path: str) -> None:
+        """ Serve the faces of the previewed video from its index, which is keyed on the same frame count as the jobs. """
+        video_frame_total = modules.capturer.get_video_frame_total(video_path)
+        if values.target_path != video_path:
+            return
+        modules.face_index.activate(video_path, video_frame_total, record=False, preview=True)
+        # another target was picked meanwhile
+        if values.target_path != video_path:
+            modules.face_index.deactivate(preview=True)
+            return
+        self.preview_slider.after(0, self.configure_preview_slider, video_frame_total)
 
     def toggle_preview(self) -> None:
         if self.PREVIEW.state() == 'normal':
@@ -448,19 +476,12 @@ class App(ctk.CTk):
     def render_video_preview(video_path: str,
                              size: Tuple[int, int],
                              frame_number: int = 0) -> ctk.CTkImage:
-        capture = cv2.VideoCapture(video_path)
-        if frame_number:
-            capture.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
-        has_frame, frame = capture.read()
-        if has_frame:
+        frame = modules.capturer.get_video_frame(video_path, frame_number + 1)
+        if frame is not None:
             image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
             if size:
                 image = ImageOps.fit(image, size, Image.LANCZOS)
-            capture.release()
-            cv2.destroyAllWindows()
             return ctk.CTkImage(image, size=image.size)
-        capture.release()
-        cv2.destroyAllWindows()
 
     def infos(self):
         return f"""
@@ -1,105 +1,179 @@
-import glob
 import mimetypes
 import os
 import platform
+import re
 import shutil
 import ssl
-import subprocess
+import threading
 import urllib
 from pathlib import Path
-from typing import List, Any
+from typing import List, Any, Optional
+import cv2
 from tqdm import tqdm
 
 import modules.variables.values
+from modules.ffmpeg import FFmpegError, get_passthrough_args, get_video_encoder_args, run_ffmpeg
+from modules.frame_store import FrameStore, get_frame_store, release_frame_store
+from modules.video_metadata import get_video_metadata
+from modules.variables.typing import Frame
 
-TEMP_FILE = 'temp.mp4'
 TEMP_DIRECTORY = 'temp'
+TEMP_FRAME_NAME = '%04d'
+# stderr of ffmpeg when a copied audio or subtitle codec does not fit the output container
+STREAM_MAPPING_ERRORS = ['not currently supported in container', 'could not find tag for codec', 'subtitle codec',
+                         'subtitle encoding currently only possible']
 
 # monkey patch ssl for mac
 if platform.system().lower() == 'darwin':
     ssl._create_default_https_context = ssl._create_unverified_context
 
 
-def run_ffmpeg(args: List[str]) -> bool:
-    print(modules.variables.values.execution_providers)
-    if 'CUDAExecutionProvider' in modules.variables.values.execution_providers:
-        execution_provider = "cuda"
-    else:
-        execution_provider = "d3d11va"
-    commands = ['ffmpeg', '-hwaccel', execution_provider, '-loglevel', modules.variables.values.log_level]
-    commands.extend(args)
-    print(" ".join(commands))
-    try:
-        process = subprocess.Popen(commands,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT,
-                                   text=True,
-                                   shell=True)
-        while True:
-            output = process.stdout.readline()
-            if output == '' and process.poll() is not None:
-                break
-            if output:
-                print(output.strip(), flush=True)
-        try:
-            error = process.stderr.read()
-            if error:
-                print(error.strip())
-        except:
-            pass
-        return True
-    except Exception as e:
-        print(e)
-    return False
+def detect_fps(target_path: str) -> float:
+    return float(get_video_metadata(target_path).fps)
 
 
-def detect_fps(target_path: str) -> float:
-    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=r_frame_rate', '-of', 'default=noprint_wrappers=1:nokey=1', target_path]
-    output = subprocess.check_output(command).decode().strip().split('/')
-    try:
-        numerator, denominator = map(int, output)
-        return numerator / denominator
-    except Exception:
-        pass
-    return 30.0
+def get_temp_frame_extension() -> str:
+    return modules.variables.values.temp_frame_format
 
 
-def extract_frames(target_path: str) -> None:
+def get_temp_frame_pattern(target_path: str) -> str:
     temp_directory_path = get_temp_directory_path(target_path)
-    run_ffmpeg(['-i', target_path, '-pix_fmt', 'rgb24', os.path.join(temp_directory_path, '%04d.png')])
+    return os.path.join(temp_directory_path, f'{TEMP_FRAME_NAME}.{get_temp_frame_extension()}')
 
 
-def create_unsound_video(target_path: str, fps: float) -> None:
-    temp_output_path = get_temp_output_path(target_path)
-    temp_directory_path = get_temp_directory_path(target_path)
-    run_ffmpeg(['-r', str(fps),
-                '-i', os.path.join(temp_directory_path, '%04d.png'),
-                '-c:v', modules.variables.values.video_encoder,
-                '-crf', str(modules.variables.values.video_quality),
-                '-pix_fmt',
-                'yuv420p',
-                '-vf',
-                'colorspace=bt709:iall=bt601-6-625:fast=1',
-                '-y',
-                temp_output_path])
+def get_temp_frame_encoder_args() -> List[str]:
+    """
+    ffmpeg output options matching the intermediate frame format, so extraction honours the same codec settings as the processors.
+    """
+    if modules.variables.values.temp_frame_format == 'png':
+        return ['-pix_fmt', 'rgb24', '-compression_level', str(modules.variables.values.temp_frame_png_compression)]
+    if modules.variables.values.temp_frame_format == 'jpg':
+        # ffmpeg mjpeg qscale goes from 2 (best) to 31 (worst)
+        qscale = max(2, round(31 - modules.variables.values.temp_frame_jpeg_quality * 0.29))
+        return ['-pix_fmt', 'yuvj444p', '-q:v', str(qscale)]
+    return ['-pix_fmt', 'bgr24']
+
+
+def get_temp_frame_write_params() -> List[int]:
+    if modules.variables.values.temp_frame_format == 'png':
+        return [cv2.IMWRITE_PNG_COMPRESSION, modules.variables.values.temp_frame_png_compression]
+    if modules.variables.values.temp_frame_format == 'jpg':
+        return [cv2.IMWRITE_JPEG_QUALITY, modules.variables.values.temp_frame_jpeg_quality]
+    return []
+
+
+def get_temp_frame_number(temp_frame_path: str) -> int:
+    return int(os.path.splitext(os.path.basename(temp_frame_path))[0])
+
+
+def read_temp_frame(temp_frame_path: str) -> Frame:
+    if temp_frame_path.endswith('.raw'):
+        return get_frame_store(os.path.dirname(temp_frame_path)).read(get_temp_frame_number(temp_frame_path) - 1)
+    return cv2.imread(temp_frame_path)
+
 
+def write_temp_frame(temp_frame_path: str, temp_frame: Frame) -> None:
+    if temp_frame_path.endswith('.raw'):
+        get_frame_store(os.path.dirname(temp_frame_path)).write(get_temp_frame_number(temp_frame_path) - 1, temp_frame)
+        return
+    cv2.imwrite(temp_frame_path, temp_frame, get_temp_frame_write_params())
 
-def restore_audio(target_path: str, output_path: str) -> None:
-    temp_output_path = get_temp_output_path(target_path)
-    done = run_ffmpeg(['-i', temp_output_path, '-i', target_path, '-c:v', 'copy', '-map', '0:v:0', '-map', '1:a:0?', '-y', output_path])
-    if not done:
-        move_temp(target_path, output_path)
+
+def get_temp_frame_input_args(target_path: str) -> List[str]:
+    if modules.variables.values.temp_frame_format == 'raw':
+        temp_directory_path = get_temp_directory_path(target_path)
+        frame_store = get_frame_store(temp_directory_path)
+        frame_store.flush()
+        return ['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-video_size', f'{frame_store.width}x{frame_store.height}',
+                '-i', FrameStore.get_file_path(temp_directory_path)]
+    return ['-i', get_temp_frame_pattern(target_path)]
+
+
+def get_temp_frame_range_input_args(target_path: str, start_frame: int, fps: Optional[float] = None) -> List[str]:
+    """ Input of the frames from start_frame (0-based) on, at fps or else the frame rate of the target. """
+    fps_args = ['-framerate', f'{fps:.6f}' if fps else get_video_metadata(target_path).fps_rational]
+    if modules.variables.values.temp_frame_format == 'raw':
+        temp_directory_path = get_temp_directory_path(target_path)
+        frame_store = get_frame_store(temp_directory_path)
+        frame_store.flush()
+        return ['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-video_size', f'{frame_store.width}x{frame_store.height}', *fps_args,
+                '-skip_initial_bytes', str(start_frame * frame_store.stride), '-i', FrameStore.get_file_path(temp_directory_path)]
+    return [*fps_args, '-start_number', str(start_frame + 1), '-i', get_temp_frame_pattern(target_path)]
+
+
+def detect_resolution(target_path: str) -> tuple[int, int]:
+    video_metadata = get_video_metadata(target_path)
+    return video_metadata.width, video_metadata.height
+
+
+def extract_frames(target_path: str) -> None:
+    """ One frame per decoded frame of the target, without the duplicates and drops of a constant output rate. """
+    if modules.variables.values.temp_frame_format == 'raw':
+        temp_directory_path = get_temp_directory_path(target_path)
+        release_frame_store(temp_directory_path)
+        run_ffmpeg(['-i', target_path, *get_passthrough_args(), '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-y', FrameStore.get_file_path(temp_directory_path)], 'extract')
+        FrameStore.write_index(temp_directory_path, *detect_resolution(target_path))
+        return
+    run_ffmpeg(['-i', target_path, *get_passthrough_args(), *get_temp_frame_encoder_args(), get_temp_frame_pattern(target_path)], 'extract')
+
+
+def get_stream_mapping_args(output_path: str, audio_codec: str = 'copy', keep_subtitles: bool = True) -> List[str]:
+    """
+    Audio and subtitles of the target (input 1), when it has any. Subtitles are converted to mov_text for the mp4 family
+    which cannot hold the other subtitle formats.
+    """
+    args = ['-map', '0:v:0', '-map', '1:a?', '-c:a', audio_codec]
+    if keep_subtitles:
+        subtitle_codec = 'mov_text' if os.path.splitext(output_path)[1].lower() in ('.mp4', '.m4v', '.mov') else 'copy'
+        args += ['-map', '1:s?', '-c:s', subtitle_codec]
+    return args
+
+
+def is_stream_mapping_error(exception: FFmpegError) -> bool:
+    """
+    ffmpeg failed on the audio or subtitles copied from the target : a codec the container cannot hold, or an output
+    stream after the video one (0:0) which could not be set up.
+    """
+    stderr = '\n'.join(exception.stderr_tail).lower()
+    return any(message in stderr for message in STREAM_MAPPING_ERRORS) or re.search(r'output stream #?0:[1-9]', stderr) is not None
 
 
 def create_video(target_path: str, output_path: str) -> None:
-    fps = detect_fps(modules.variables.values.target_path)
-    create_unsound_video(target_path, fps)
-    restore_audio(target_path, output_path)
+    """
+    Encode the processed frames and mux the audio and subtitles of the target in a single ffmpeg run.
+    When the streams of the target do not fit the output container, the audio is encoded to aac and subtitles are dropped,
+    any other failure is raised without encoding again.
+    """
+    encode_args = ['-r', get_video_metadata(target_path).fps_rational,
+                   *get_temp_frame_input_args(target_path),
+                   '-i', target_path,
+                   *get_video_encoder_args(),
+                   '-pix_fmt', 'yuv420p',
+                   '-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1']
+    try:
+        run_ffmpeg([*encode_args, *get_stream_mapping_args(output_path), '-y', output_path], 'encode')
+    except FFmpegError as exception:
+        if not is_stream_mapping_error(exception):
+            raise
+        print(f'[REACTOR.FFMPEG] Copying the audio and subtitles of the target failed, encoding the audio to aac: {exception}')
+        run_ffmpeg([*encode_args, *get_stream_mapping_args(output_path, 'aac', keep_subtitles=False), '-y', output_path], 'encode')
 
 
 def get_temp_frame_paths(target_path: str) -> List[str]:
+    """
+    Frame paths in frame order. Frames of the raw store are virtual paths named like image frames, mapped to their index.
+    """
     temp_directory_path = get_temp_directory_path(target_path)
-    return glob.glob((os.path.join(glob.escape(temp_directory_path), '*.png')))
+    temp_frame_extension = get_temp_frame_extension()
+    if temp_frame_extension == 'raw':
+        frame_store = get_frame_store(temp_directory_path)
+        frame_total = frame_store.count if frame_store else 0
+        return [os.path.join(temp_directory_path, f'{TEMP_FRAME_NAME % frame_number}.raw') for frame_number in range(1, frame_total + 1)]
+    if not os.path.isdir(temp_directory_path):
+        return []
+    temp_frame_names = [file_name for file_name in os.listdir(temp_directory_path)
+                        if file_name.endswith(f'.{temp_frame_extension}') and os.path.splitext(file_name)[0].isdigit()]
+    return [os.path.join(temp_directory_path, file_name) for file_name in sorted(temp_frame_names, key=lambda file_name: int(os.path.splitext(file_name)[0]))]
 
 
 def get_temp_directory_path(target_path: str) -> str:
@@ -108,11 +182,6 @@ def get_temp_directory_path(target_path: str) -> str:
     return os.path.join(target_directory_path, TEMP_DIRECTORY, target_name)
 
 
-def get_temp_output_path(target_path: str) -> str:
-    temp_directory_path = get_temp_directory_path(target_path)
-    return os.path.join(temp_directory_path, TEMP_FILE)
-
-
 def normalize_output_path(source_path: str, target_path: str, output_path: str) -> Any:
     if source_path and target_path:
         source_name, _ = os.path.splitext(os.path.basename(source_path))
@@ -127,16 +196,9 @@ def create_temp(target_path: str) -> None:
     Path(temp_directory_path).mkdir(parents=True, exist_ok=True)
 
 
-def move_temp(target_path: str, output_path: str) -> None:
-    temp_output_path = get_temp_output_path(target_path)
-    if os.path.isfile(temp_output_path):
-        if os.path.isfile(output_path):
-            os.remove(output_path)
-        shutil.move(temp_output_path, output_path)
-
-
 def clean_temp(target_path: str) -> None:
     temp_directory_path = get_temp_directory_path(target_path)
+    release_frame_store(temp_directory_path)
     parent_directory_path = os.path.dirname(temp_directory_path)
     if not modules.variables.values.keep_frames and os.path.isdir(temp_directory_path):
         shutil.rmtree(temp_directory_path)
@@ -172,8 +234,11 @@ def conditional_download(download_directory_path: str, urls: List[str]) -> None:
         if not os.path.exists(download_file_path):
             request = urllib.request.urlopen(url) # type: ignore[attr-defined]
             total = int(request.headers.get('Content-Length', 0))
+            # downloaded aside then renamed, a model being downloaded in the background is never loaded half written
+            temp_download_file_path = f'{download_file_path}.{threading.get_ident()}.tmp'
             with tqdm(total=total, desc='Downloading', unit='B', unit_scale=True, unit_divisor=1024) as progress:
-                urllib.request.urlretrieve(url, download_file_path, reporthook=lambda count, block_size, total_size: progress.update(block_size)) # type: ignore[attr-defined]
+                urllib.request.urlretrieve(url, temp_download_file_path, reporthook=lambda count, block_size, total_size: progress.update(block_size)) # type: ignore[attr-defined]
+            os.replace(temp_download_file_path, download_file_path)
 
 
 def resolve_relative_path(path: str) -> str:
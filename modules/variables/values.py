@@ -1,5 +1,5 @@
 import os
-from typing import List, Dict
+from typing import Any, List, Dict
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 WORKFLOW_DIR = os.path.join(ROOT_DIR, 'workflow')
@@ -21,6 +21,12 @@ enhancer_options = [enhancer_none,
                     enhancer_faces_only,
                     enhancer_all]
 enhancer_option: str = enhancer_none
+enhancer_aligned = True
+enhancer_cpu_mode = True
+enhancer_precisions = ['fp32', 'bf16', 'int8']
+enhancer_precision = 'fp32'
+torch_threads = 0
+enhancer_report = None
 
 faces_best_one = "Best one"
 faces_all = "All"
@@ -41,14 +47,67 @@ target_path = None
 output_path = None
 frame_processors: List[str] = []
 keep_frames = True
+temp_frame_formats = ['png', 'bmp', 'jpg', 'raw']
+temp_frame_format = 'png'
+temp_frame_png_compression = 1
+temp_frame_jpeg_quality = 95
+video_encoders = ['libx264', 'libx265', 'libvpx-vp9']
 video_encoder = 'libx265'
 video_quality = 18
+video_presets = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow']
+video_preset = 'medium'
+video_threads = 0
+hardware_acceleration = True
 max_memory = None
 distance_score: int = 25
+# seconds of the target video rendered as annotated frames by the score analysis
+annotate_timestamps: List[float] = []
 execution_providers: List[str] = []
 execution_threads = None
+intra_op_threads = 0
+inter_op_threads = 0
+graph_optimization_levels = ['disable', 'basic', 'extended', 'all']
+graph_optimization_level = 'all'
+execution_modes = ['sequential', 'parallel']
+execution_mode = 'sequential'
+processor_session_options: Dict[str, Dict[str, Any]] = {}
+optimized_model_cache = True
+model_precisions = ['fp32', 'fp16', 'int8']
+model_precision = 'fp32'
+precision_report = None
+swap_batch_size = 1
+autotune = False
+io_threads = 2
+io_queue_size = 16
 log_level = 'info'
 fp_ui: Dict[str, bool] = {}
 nsfw = True
 decompose_video = True
 recompose_video = True
+job_report = False
+# megabytes of image outputs kept in cache/results, 0 to disable the cache
+result_cache_size = 0
+metrics_textfile = None
+trace_path = None
+cprofile_path = None
+benchmark = None
+benchmark_face = None
+benchmark_compare = None
+# reusing the output of a near identical recent frame is lossy (small motion like lips can freeze),
+# off by default, for static shots, slideshows or screen recordings with many repeated frames
+frame_cache_size = 0
+frame_cache_tolerance = 2
+bulk_targets = None
+bulk_output = None
+# images processed together, their faces sharing the swapper runs
+bulk_batch_size = 8
+live_source = None
+live_output = '-'
+# milliseconds from capture to output a live frame may take, older frames are dropped
+live_latency_budget = 100
+live_size = None
+live_fps = None
+live_report = None
+# hls segments of the output written while the last processor runs
+segmented_output = False
+segment_duration = 6
@@ -0,0 +1,150 @@
+import json
+import os
+import subprocess
+import threading
+from fractions import Fraction
+from typing import Any, Dict, NamedTuple, Tuple
+import cv2
+import numpy
+
+THREAD_LOCK = threading.Lock()
+METADATA: Dict[Tuple[str, int, int], 'VideoMetadata'] = {}
+ESTIMATED_METADATA: Dict[Tuple[str, int, int], 'VideoMetadata'] = {}
+KEYFRAME_INDEXES: Dict[Tuple[str, int, int], 'KeyframeIndex'] = {}
+
+
+class VideoMetadata(NamedTuple):
+    fps: Fraction
+    frame_total: int
+    # size of the decoded frames, rotation applied since ffmpeg auto-rotates
+    width: int
+    height: int
+    rotation: int
+    duration: float
+    has_audio: bool
+
+    @property
+    def fps_rational(self) -> str:
+        """ fps as ffmpeg expects it, 30000/1001 stays exact where 29.97 drifts on long videos. """
+        return f'{self.fps.numerator}/{self.fps.denominator}'
+
+
+class KeyframeIndex(NamedTuple):
+    # frame numbers (0-based, presentation order) and timestamps in seconds of the keyframes, ascending
+    frames: numpy.ndarray[Any, Any]
+    times: numpy.ndarray[Any, Any]
+    # timestamp in seconds of every frame, ascending, the spacing of variable frame rate videos is uneven
+    frame_times: numpy.ndarray[Any, Any]
+
+    def get_keyframe_before(self, frame_index: int) -> int:
+        """ Last keyframe at or before frame_index, where decoding of this frame has to start. """
+        position = int(numpy.searchsorted(self.frames, frame_index, side='right')) - 1
+        return int(self.frames[position]) if position >= 0 else frame_index
+
+
+def parse_rational(value: str) -> Fraction:
+    try:
+        return Fraction(value)
+    except (ValueError, ZeroDivisionError):
+        return Fraction(0)
+
+
+def probe_with_ffprobe(video_path: str, exact: bool) -> VideoMetadata:
+    """
+    One ffprobe run. When exact, -count_packets demuxes the whole file without decoding it, the exact frame count is
+    its number of video packets, where nb_frames is often missing or estimated. Otherwise the frame count is nb_frames,
+    else the duration times the fps.
+    """
+    command = ['ffprobe', '-v', 'error', *(['-count_packets'] if exact else []),
+               '-show_entries', 'stream=codec_type,width,height,r_frame_rate,avg_frame_rate,nb_frames,nb_read_packets:stream_tags=rotate:stream_side_data=rotation:format=duration',
+               '-of', 'json', video_path]
+    probe: Dict[str, Any] = json.loads(subprocess.check_output(command).decode())
+    streams = probe.get('streams', [])
+    video_stream = next(stream for stream in streams if stream.get('codec_type') == 'video')
+    # frames are extracted with passthrough (-fps_mode or -vsync), every packet becomes one frame and none is duplicated or dropped,
+    # so encoding them back at the average rate keeps the duration of variable frame rate videos
+    fps = parse_rational(video_stream.get('avg_frame_rate', '0/0')) or parse_rational(video_stream.get('r_frame_rate', '0/0')) or Fraction(30)
+    duration = float(probe.get('format', {}).get('duration') or 0)
+    rotation = int(float(video_stream.get('tags', {}).get('rotate')
+                         or next((side_data['rotation'] for side_data in video_stream.get('side_data_list', []) if 'rotation' in side_data), 0)))
+    width, height = int(video_stream['width']), int(video_stream['height'])
+    if abs(rotation) % 180 == 90:
+        width, height = height, width
+    return VideoMetadata(fps=fps,
+                         frame_total=int(video_stream.get('nb_read_packets') or video_stream.get('nb_frames') or round(duration * fps)),
+                         width=width,
+                         height=height,
+                         rotation=rotation,
+                         duration=duration,
+                         has_audio=any(stream.get('codec_type') == 'audio' for stream in streams))
+
+
+def probe_with_opencv(video_path: str) -> VideoMetadata:
+    # without ffprobe the frame count and fps are the container estimates, and audio is unknown
+    capture = cv2.VideoCapture(video_path)
+    fps = Fraction(capture.get(cv2.CAP_PROP_FPS) or 30).limit_denominator(1001)
+    frame_total = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    width, height = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    capture.release()
+    return VideoMetadata(fps=fps, frame_total=frame_total, width=width, height=height, rotation=0,
+                         duration=float(frame_total / fps) if fps else 0.0, has_audio=False)
+
+
+def get_cache_key(video_path: str) -> Tuple[str, int, int]:
+    video_stat = os.stat(video_path)
+    return os.path.abspath(video_path), video_stat.st_mtime_ns, video_stat.st_size
+
+
+def probe_keyframes(video_path: str) -> KeyframeIndex:
+    """
+    Packets are listed in decoding order, their rank by timestamp is their frame number.
+    """
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags', '-of', 'csv=print_section=0', video_path]
+    packets = [line.split(',') for line in subprocess.check_output(command).decode().splitlines() if line]
+    times = numpy.array([float(pts_time) if pts_time not in ('', 'N/A') else numpy.nan for pts_time, *_ in packets], dtype=numpy.float64)
+    keyframes = numpy.array(['K' in ''.join(flags) for _, *flags in packets], dtype=bool)
+    order = numpy.argsort(times, kind='stable')
+    frames = numpy.flatnonzero(keyframes[order])
+    return KeyframeIndex(frames=frames, times=times[order][frames], frame_times=times[order])
+
+
+def get_keyframe_index(video_path: str) -> KeyframeIndex:
+    """
+    Keyframes of a video, listed once (demuxing only, nothing is decoded) and cached until the file changes.
+    Without ffprobe the index is empty and every frame is considered a keyframe.
+    """
+    key = get_cache_key(video_path)
+    with THREAD_LOCK:
+        if key in KEYFRAME_INDEXES:
+            return KEYFRAME_INDEXES[key]
+    try:
+        keyframe_index = probe_keyframes(video_path)
+    except (OSError, subprocess.CalledProcessError, ValueError) as exception:
+        print(f'[REACTOR.VIDEO-METADATA] listing the keyframes of {video_path} failed: {exception}')
+        keyframe_index = KeyframeIndex(frames=numpy.empty(0, dtype=numpy.int64), times=numpy.empty(0, dtype=numpy.float64),
+                                       frame_times=numpy.empty(0, dtype=numpy.float64))
+    with THREAD_LOCK:
+        KEYFRAME_INDEXES[key] = keyframe_index
+    return keyframe_index
+
+
+def get_video_metadata(video_path: str, exact: bool = True) -> VideoMetadata:
+    """
+    Metadata of a video, probed once and cached until the file changes.
+    :param exact: count the frames by demuxing the whole file, else estimate the count from the headers, fast enough
+    for the ui thread. The exact metadata is returned whenever it is known.
+    """
+    key = get_cache_key(video_path)
+    with THREAD_LOCK:
+        if key in METADATA:
+            return METADATA[key]
+        if not exact and key in ESTIMATED_METADATA:
+            return ESTIMATED_METADATA[key]
+    try:
+        video_metadata = probe_with_ffprobe(video_path, exact)
+    except (OSError, subprocess.CalledProcessError, StopIteration, KeyError, ValueError) as exception:
+        print(f'[REACTOR.VIDEO-METADATA] ffprobe failed on {video_path}, falling back to opencv: {exception}')
+        video_metadata = probe_with_opencv(video_path)
+    with THREAD_LOCK:
+        (METADATA if exact else ESTIMATED_METADATA)[key] = video_metadata
+    return video_metadata
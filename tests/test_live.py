@@ -0,0 +1,107 @@
+import io
+import json
+import sys
+import time
+from types import SimpleNamespace
+from typing import Any, List
+
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+numpy = pytest.importorskip('numpy')
+
+import modules.live as live_module
+import modules.model_manager
+import modules.variables.values
+
+FRAME_TOTAL = 30
+FRAME_SIZE = (64, 48)
+PROCESS_SECONDS = 0.05
+LATENCY_BUDGET = 20
+
+
+def create_video(video_path: str) -> None:
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'MJPG'), 30, FRAME_SIZE)
+    for frame_number in range(FRAME_TOTAL):
+        writer.write(numpy.full((FRAME_SIZE[1], FRAME_SIZE[0], 3), frame_number * 8, dtype=numpy.uint8))
+    writer.release()
+
+
+def create_image(image_path: str) -> None:
+    cv2.imwrite(image_path, numpy.zeros((FRAME_SIZE[1], FRAME_SIZE[0], 3), dtype=numpy.uint8))
+
+
+@pytest.fixture
+def live_job(tmp_path: Any, monkeypatch: pytest.MonkeyPatch) -> SimpleNamespace:
+    """ A short video played as the live source, raw frames written to a buffer, and processing slower than the budget. """
+    video_path = str(tmp_path / 'source.avi')
+    face_path = str(tmp_path / 'face.png')
+    create_video(video_path)
+    create_image(face_path)
+    output = io.BytesIO()
+
+    def process_images(frame_processors: List[Any], source_face: Any, subject_embedding: Any, temp_frames: List[Any]) -> List[Any]:
+        time.sleep(PROCESS_SECONDS)
+        return [255 - temp_frame for temp_frame in temp_frames]
+
+    monkeypatch.setattr(live_module, 'get_one_face', lambda frame: SimpleNamespace())
+    monkeypatch.setattr(live_module, 'get_face_analyser', lambda: SimpleNamespace(get=lambda frame: [SimpleNamespace(embedding=numpy.zeros(512))]))
+    monkeypatch.setattr(live_module, 'get_frame_processors_modules', lambda frame_processors: [])
+    monkeypatch.setattr(live_module, 'process_images', process_images)
+    monkeypatch.setattr(modules.model_manager, 'preload_models', lambda frame_processors: None)
+    monkeypatch.setattr(modules.model_manager, 'get_load_times', lambda: {})
+    monkeypatch.setattr(sys, '__stdout__', SimpleNamespace(buffer=output))
+    monkeypatch.setattr(modules.variables.values, 'frame_processors', ['face_swapper'])
+    monkeypatch.setattr(modules.variables.values, 'face_option', modules.variables.values.faces_all)
+    monkeypatch.setattr(modules.variables.values, 'execution_threads', 1)
+    monkeypatch.setattr(modules.variables.values, 'live_latency_budget', LATENCY_BUDGET)
+    monkeypatch.setattr(modules.variables.values, 'live_size', None)
+    monkeypatch.setattr(modules.variables.values, 'live_fps', None)
+    monkeypatch.setattr(modules.variables.values, 'live_report', str(tmp_path / 'live.json'))
+    return SimpleNamespace(video_path=video_path, face_path=face_path, output=output, report_path=str(tmp_path / 'live.json'))
+
+
+def test_live_counts(live_job: SimpleNamespace) -> None:
+    report = live_module.live(live_job.video_path, '-', live_job.face_path, live_job.face_path)
+
+    assert report['captured'] == FRAME_TOTAL
+    assert report['errors'] == 0
+    assert report['budget_ms'] == LATENCY_BUDGET
+    # every frame is either shown or dropped, and only frames taken within the budget are processed
+    assert report['shown'] + report['dropped'] == report['captured']
+    assert report['processed'] + report['stale'] <= report['captured']
+    assert 0 < report['shown'] <= report['processed']
+    # processing takes longer than a frame interval, newer frames replace the waiting ones
+    assert report['dropped'] > 0
+    assert report['drop_rate'] == round(report['dropped'] / report['captured'], 4)
+    assert report['reuse_rate'] == round(report['reused'] / (report['shown'] + report['reused']), 4)
+    assert set(report['latency_ms']) == {'p50', 'p95', 'p99', 'max'}
+    assert report['latency_ms']['p50'] <= report['latency_ms']['max']
+    assert 0 <= report['within_budget'] <= 1
+    # the output runs at the source rate : a processed frame, or the last one repeated
+    assert len(live_job.output.getvalue()) == (report['shown'] + report['reused']) * FRAME_SIZE[0] * FRAME_SIZE[1] * 3
+
+
+def test_live_report_file(live_job: SimpleNamespace) -> None:
+    report = live_module.live(live_job.video_path, '-', live_job.face_path, live_job.face_path)
+
+    with open(live_job.report_path) as report_file:
+        live_report = json.load(report_file)
+    assert live_report['mode'] == 'live'
+    assert live_report['live'] == json.loads(json.dumps(report))
+    assert live_report['counters']['frames'] == report['captured']
+    assert live_report['counters']['frames_processed'] == report['processed']
+
+
+def test_live_refuses_without_faces_to_swap(live_job: SimpleNamespace, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(modules.variables.values, 'face_option', modules.variables.values.faces_none)
+
+    with pytest.raises(Exception, match='--face-option'):
+        live_module.live(live_job.video_path, '-', live_job.face_path, live_job.face_path)
+
+
+def test_live_refuses_when_a_model_failed_to_load(live_job: SimpleNamespace, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(modules.model_manager, 'get_load_times', lambda: {'face_swapper': -1.0})
+
+    with pytest.raises(Exception, match='face_swapper'):
+        live_module.live(live_job.video_path, '-', live_job.face_path, live_job.face_path)